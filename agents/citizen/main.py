@@ -1,73 +1,135 @@
-from dataclasses import dataclass
-import spade
-from spade.agent import Agent
-from spade.behaviour import OneShotBehaviour
-from spade.message import Message
-import json
-
-@dataclass
-class ServiceDemand:
-    localization: tuple[float, float]
-    service_type: str
-    priority: str
-
-# AGENT
-import sys
-import os
-
-
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'database')))
-from system_data import DEFAULT_METADATA
-
-
-class CitizenAgent(Agent):
-    class ServiceDemandRequest(OneShotBehaviour):
-        def __init__(self, service_demand: ServiceDemand):
-            super().__init__()
-            self.service_demand = service_demand
-            self.localization = service_demand.localization
-            self.service_type = service_demand.service_type
-            self.priority = service_demand.priority
-
-        async def run(self):
-            print("ServiceDemandRequest running")
-            msg = Message(
-                to="hub_agent@localhost",
-                metadata={
-                    "performative": "inform",
-                    "conversation_id": "ServiceDemandRequest",
-                    **DEFAULT_METADATA,
-                },
-                body=json.dumps(
-                    {
-                        "localization": self.localization,
-                        "service_type": self.service_type,
-                        "priority": self.priority,
-                    }
-                ),
-            )
-
-            await self.send(msg)
-            print("Message sent!")
-            await self.agent.stop()
-
-    def add_service_demand_request(self, service_demand: ServiceDemand):
-        behavior = self.ServiceDemandRequest(service_demand)
-        self.add_behaviour(behavior)
-
-
-
-def run_citizen_agent(service_demand):
-    spade.run(main(service_demand))
-
-async def main(service_demand):
-    agent = CitizenAgent("citizen_agent@localhost", "citizen_agent_password")
-    await agent.start(auto_register=True)
-    agent.add_service_demand_request(service_demand)
-    await spade.wait_until_finished(agent)
-    await agent.stop()
-
-
-if __name__ == "__main__":
-    service_demand = ServiceDemand(localization=[1.0, 10.2], service_type="Żabka", priority="High")
-    spade.run(main(service_demand))
\ No newline at end of file
+from dataclasses import dataclass
+import spade
+from spade.agent import Agent
+from spade.behaviour import CyclicBehaviour, OneShotBehaviour
+from spade.message import Message
+from concurrent.futures import Future, InvalidStateError
+import asyncio
+import uuid
+
+@dataclass
+class ServiceDemand:
+    localization: tuple[float, float]
+    service_type: str
+    priority: str
+
+# AGENT
+import sys
+import os
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'database')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from agents.common import codec
+from agents.common.loopback import use_loopback
+from agents.common.runtime import AgentRuntime
+from agents.common.shards import ShardMap, default_shards
+
+
+def service_demand_message(service_demand: ServiceDemand, to="hub_agent@localhost") -> Message:
+    return codec.message(
+        to,
+        "ServiceDemandRequest",
+        {
+            "localization": service_demand.localization,
+            "service_type": service_demand.service_type,
+            "priority": service_demand.priority,
+        },
+    )
+
+
+class CitizenAgent(Agent):
+    def __init__(self, jid, password, *args, shards: ShardMap = None, **kwargs):
+        super().__init__(jid, password, *args, **kwargs)
+        self.demands = asyncio.Queue()  # (ServiceDemand, Future) pairs
+        self.shards = shards or default_shards()
+
+    async def send_service_demand(self, behaviour, service_demand: ServiceDemand):
+        # Votes near a shard boundary count at every hub they are close to
+        for hub in self.shards.hubs_near(service_demand.localization):
+            await behaviour.send(service_demand_message(service_demand, hub))
+
+    class ServiceDemandRequest(OneShotBehaviour):
+        def __init__(self, service_demand: ServiceDemand):
+            super().__init__()
+            self.service_demand = service_demand
+
+        async def run(self):
+            print("ServiceDemandRequest running")
+            await self.agent.send_service_demand(self, self.service_demand)
+            print("Message sent!")
+            await self.agent.stop()
+
+    class ServiceDemandSender(CyclicBehaviour):
+        async def run(self):
+            service_demand, delivery = await self.agent.demands.get()
+            try:
+                await self.agent.send_service_demand(self, service_demand)
+            except Exception as e:
+                delivery.set_exception(e)
+            else:
+                delivery.set_result(True)
+
+    async def setup(self):
+        use_loopback(self)
+        self.add_behaviour(self.ServiceDemandSender())
+
+    def add_service_demand_request(self, service_demand: ServiceDemand):
+        behavior = self.ServiceDemandRequest(service_demand)
+        self.add_behaviour(behavior)
+
+
+class CitizenService:
+    """One long-lived citizen agent that sends the demands handed to it.
+
+    ``submit`` returns immediately with a future that resolves to ``True``
+    once the demand has been sent to the hub, or to the sending error. If
+    the agent fails to start, every delivery fails with the start error.
+    """
+
+    def __init__(self, runtime: AgentRuntime = None, agent_id=None, shards: ShardMap = None):
+        self.runtime = runtime or AgentRuntime(loops=1)
+        agent_id = agent_id or f"citizen_{uuid.uuid4().hex[:8]}"
+        self.agent = CitizenAgent(
+            f"{agent_id}@localhost", "citizen_agent_password", shards=shards
+        )
+        self.pending = set()  # deliveries not resolved yet
+        self.started = self.runtime.start(self.agent)
+        self.started.add_done_callback(self._fail_pending)
+
+    def _fail_pending(self, started: Future):
+        if started.cancelled() or started.exception() is None:
+            return
+        for delivery in list(self.pending):
+            try:
+                delivery.set_exception(started.exception())
+            except InvalidStateError:  # sent before the agent failed
+                pass
+
+    def submit(self, service_demand: ServiceDemand) -> Future:
+        delivery = Future()
+        self.pending.add(delivery)
+        delivery.add_done_callback(self.pending.discard)
+        if self.started.done():
+            self._fail_pending(self.started)
+        if not delivery.done():
+            self.runtime.call(
+                self.agent, lambda: self.agent.demands.put_nowait((service_demand, delivery))
+            )
+        return delivery
+
+    def stop(self):
+        return self.runtime.stop(self.agent)
+
+
+async def main(service_demand):
+    agent = CitizenAgent("citizen_agent@localhost", "citizen_agent_password")
+    await agent.start(auto_register=True)
+    agent.add_service_demand_request(service_demand)
+    await spade.wait_until_finished(agent)
+    await agent.stop()
+
+
+if __name__ == "__main__":
+    service_demand = ServiceDemand(localization=[1.0, 10.2], service_type="Żabka", priority="High")
+    spade.run(main(service_demand))
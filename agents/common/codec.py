@@ -0,0 +1,239 @@
+import base64
+import json
+import os
+from dataclasses import MISSING, fields
+from typing import Callable, Optional, Union, get_args, get_origin, get_type_hints
+
+from spade.message import Message
+
+from agents.common.messages import BODIES, MessageBody
+from database.system_data import DEFAULT_METADATA
+
+try:
+    import orjson
+except ImportError:  # plain json is a few times slower but behaves the same
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = "JSON"
+# Base64 of a MessagePack array holding the fields in schema order
+MSGPACK = "msgpack"
+# Language the agents of this process send in; the hub answers in the sender's
+LANGUAGE = os.environ.get("MESSAGE_LANGUAGE", JSON)
+
+
+class MessageError(ValueError):
+    """A message body that cannot be decoded or does not fit its schema."""
+
+
+def _expect(name: str, accepts: Callable) -> Callable:
+    def convert(value):
+        converted = accepts(value)
+        if converted is None:
+            raise MessageError(f"expected {name}, got {type(value).__name__}")
+        return converted
+
+    return convert
+
+
+# Prices and amounts are stored in int64 columns
+INT_MIN, INT_MAX = -(2**63), 2**63 - 1
+
+
+def _int(value):
+    if type(value) is float and value.is_integer():
+        # The frontends read prices from text fields as floats
+        value = int(value)
+    if type(value) is int and INT_MIN <= value <= INT_MAX:
+        return value
+    return None
+
+
+def _float(value):
+    if type(value) in (int, float):
+        return float(value)
+    return None
+
+
+def _str(value):
+    return value if type(value) is str else None
+
+
+def _bool(value):
+    return value if type(value) is bool else None
+
+
+SCALARS = {
+    int: _expect("int", _int),
+    float: _expect("float", _float),
+    str: _expect("str", _str),
+    bool: _expect("bool", _bool),
+}
+
+
+def _converter(annotation, positional: bool) -> Callable:
+    if annotation in SCALARS:
+        return SCALARS[annotation]
+    origin, args = get_origin(annotation), get_args(annotation)
+    if origin is Union:
+        (inner,) = [arg for arg in args if arg is not type(None)]
+        convert_inner = _converter(inner, positional)
+        return lambda value: None if value is None else convert_inner(value)
+    if origin is tuple:
+        items = [_converter(arg, positional) for arg in args]
+
+        def convert_tuple(value):
+            if type(value) not in (list, tuple) or len(value) != len(items):
+                raise MessageError(f"expected {len(items)} items")
+            return tuple(convert(item) for convert, item in zip(items, value))
+
+        return convert_tuple
+    if origin is list:
+        convert_item = _converter(args[0], positional)
+
+        def convert_list(value):
+            if type(value) is not list:
+                raise MessageError(f"expected list, got {type(value).__name__}")
+            return [convert_item(item) for item in value]
+
+        return convert_list
+    if issubclass(annotation, MessageBody):
+        schema = Schema(annotation)
+        return schema.from_list if positional else schema.from_dict
+    raise TypeError(f"No converter for {annotation}")
+
+
+class Schema:
+    """Validation of one body class, compiled once from its annotations.
+
+    Bodies decode from a JSON object (``from_dict``) or from the positional
+    array of the compact encoding (``from_list``). Integral floats are
+    accepted for int fields, keys that are not in the schema are ignored.
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        hints = get_type_hints(cls)
+        self.fields = [
+            (field.name, field.default)
+            for field in fields(cls)
+            if field.metadata.get("wire", True)
+        ]
+        self.required = sum(default is MISSING for _, default in self.fields)
+        self.from_dict_converters = [_converter(hints[name], False) for name, _ in self.fields]
+        self.from_list_converters = [_converter(hints[name], True) for name, _ in self.fields]
+        self.packers = [self._packer(hints[name]) for name, _ in self.fields]
+
+    @staticmethod
+    def _packer(annotation) -> Optional[Callable]:
+        if get_origin(annotation) is list and issubclass(get_args(annotation)[0], MessageBody):
+            schema = Schema(get_args(annotation)[0])
+            return lambda items: [schema.to_list(item) for item in items]
+        return None
+
+    def _build(self, values: list, converters) -> MessageBody:
+        for i, ((name, _), convert) in enumerate(zip(self.fields, converters)):
+            try:
+                values[i] = convert(values[i])
+            except MessageError as error:
+                raise MessageError(f"{name}: {error}") from None
+        return self.cls(*values)
+
+    def from_dict(self, data) -> MessageBody:
+        if type(data) is not dict:
+            raise MessageError(f"expected object, got {type(data).__name__}")
+        values = []
+        for name, default in self.fields:
+            value = data.get(name, default)
+            if value is MISSING:
+                raise MessageError(f"{name}: missing")
+            values.append(value)
+        return self._build(values, self.from_dict_converters)
+
+    def from_list(self, data) -> MessageBody:
+        if type(data) is not list or not self.required <= len(data) <= len(self.fields):
+            raise MessageError(f"expected array of {len(self.fields)} fields")
+        values = data + [default for _, default in self.fields[len(data) :]]
+        return self._build(values, self.from_list_converters)
+
+    def to_list(self, payload) -> list:
+        return [
+            pack(payload.get(name)) if pack else payload.get(name)
+            for (name, _), pack in zip(self.fields, self.packers)
+        ]
+
+
+SCHEMAS = {conversation_id: Schema(cls) for conversation_id, cls in BODIES.items()}
+
+
+def _schema(conversation_id: str) -> Schema:
+    schema = SCHEMAS.get(conversation_id)
+    if schema is None:
+        raise MessageError(f"No schema for {conversation_id}")
+    return schema
+
+
+def dumps(payload) -> str:
+    if orjson:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload, separators=(",", ":"))
+
+
+def loads(body: str):
+    return orjson.loads(body) if orjson else json.loads(body)
+
+
+def encode(conversation_id: str, payload: dict, language: str = JSON) -> str:
+    """Message body for ``payload`` in ``language``."""
+    if language == JSON:
+        return dumps(payload)
+    if language == MSGPACK and msgpack:
+        packed = msgpack.packb(_schema(conversation_id).to_list(payload))
+        return base64.b64encode(packed).decode("ascii")
+    raise MessageError(f"Unsupported language {language}")
+
+
+def decode(conversation_id: str, body: str, language: str = JSON) -> MessageBody:
+    """Typed body of a message, or ``MessageError`` if it is malformed."""
+    schema = _schema(conversation_id)
+    if language == JSON:
+        try:
+            data = loads(body)
+        except (TypeError, ValueError) as error:
+            raise MessageError(f"Invalid JSON: {error}") from None
+        return schema.from_dict(data)
+    if language == MSGPACK and msgpack:
+        try:
+            data = msgpack.unpackb(base64.b64decode(body, validate=True))
+        except Exception as error:
+            raise MessageError(f"Invalid msgpack: {error}") from None
+        return schema.from_list(data)
+    raise MessageError(f"Unsupported language {language}")
+
+
+def language_of(msg) -> str:
+    return msg.get_metadata("language") or JSON
+
+
+def decode_message(msg) -> MessageBody:
+    return decode(msg.get_metadata("conversation-id"), msg.body, language_of(msg))
+
+
+def message(to: str, conversation_id: str, payload: dict, language: Optional[str] = None) -> Message:
+    """An ``inform`` for ``conversation_id`` with ``payload`` encoded in ``language``."""
+    language = language or LANGUAGE
+    return Message(
+        to=to,
+        metadata={
+            "performative": "inform",
+            "conversation-id": conversation_id,
+            **DEFAULT_METADATA,
+            "language": language,
+        },
+        body=encode(conversation_id, payload, language),
+    )
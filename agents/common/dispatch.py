@@ -0,0 +1,90 @@
+import inspect
+import traceback
+from typing import Dict
+
+from spade.behaviour import CyclicBehaviour
+from spade.template import Template
+
+from agents.common.codec import MessageError
+
+
+class MessageHandler(CyclicBehaviour):
+    """Behaviour handling the messages of a single conversation-id.
+
+    On its own it waits for messages matching ``metadata``; in dispatcher mode
+    it is never started and the ``Dispatcher`` calls ``handle`` directly.
+    """
+
+    metadata: dict
+
+    async def run(self):
+        msg = await self.receive(timeout=20)
+        if not msg:
+            return
+        try:
+            await self.handle(msg)
+        except MessageError as error:
+            print(f"Dropped malformed {self.metadata['conversation-id']} from {msg.sender}: {error}")
+        except Exception:
+            # Like the dispatcher, keep handling the conversation after a failure
+            print(f"Handler for {self.metadata['conversation-id']} failed")
+            traceback.print_exc()
+
+    async def handle(self, msg):
+        raise NotImplementedError
+
+
+class Dispatcher(CyclicBehaviour):
+    """Single mailbox for an agent, routing messages on their conversation-id.
+
+    Every wake-up drains the whole mailbox before waiting again.
+    """
+
+    def __init__(self, handlers: Dict[str, MessageHandler]):
+        super().__init__()
+        self.handlers = handlers
+
+    async def run(self):
+        msg = await self.receive(timeout=20)
+        while msg:
+            conversation_id = msg.get_metadata("conversation-id")
+            handler = self.handlers.get(conversation_id)
+            if handler:
+                try:
+                    await handler.handle(msg)
+                except MessageError as error:
+                    print(f"Dropped malformed {conversation_id} from {msg.sender}: {error}")
+                except Exception:
+                    print(f"Handler for {conversation_id} failed")
+                    traceback.print_exc()
+            else:
+                print(f"No handler for {conversation_id}")
+            msg = await self.receive()
+
+
+def message_handlers(agent):
+    return [
+        attr()
+        for attr in (getattr(agent, d) for d in dir(agent) if d != "__class__")
+        if inspect.isclass(attr)
+        and issubclass(attr, MessageHandler)
+        and hasattr(attr, "metadata")
+    ]
+
+
+def add_message_handlers(agent, use_dispatcher=False):
+    handlers = message_handlers(agent)
+    if not use_dispatcher:
+        for handler in handlers:
+            # Any language the codec reads is accepted, see agents.common.codec
+            metadata = {k: v for k, v in handler.metadata.items() if k != "language"}
+            agent.add_behaviour(handler, Template(metadata=metadata))
+        return
+
+    for handler in handlers:
+        handler.set_agent(agent)
+    agent.add_behaviour(
+        Dispatcher(
+            {handler.metadata["conversation-id"]: handler for handler in handlers}
+        )
+    )
@@ -0,0 +1,45 @@
+from typing import Collection, Optional, Tuple
+
+import aioxmpp
+
+
+# Metadata naming the logical agent a gateway's message is from, or a reply is for
+IDENTITY = "identity"
+
+
+def with_identity(msg, identity: Optional[str]):
+    """Marks ``msg`` as sent by ``identity`` of a gateway agent."""
+    if identity is not None:
+        msg.set_metadata(IDENTITY, identity)
+    return msg
+
+
+def sender_of(msg) -> Tuple[str, bool]:
+    """JID the hub knows the sender of ``msg`` by, and whether it is a gateway's identity.
+
+    A gateway's identities are addressed as its bare JID with the identity
+    as resource, so no other client can act for them.
+    """
+    identity = msg.get_metadata(IDENTITY)
+    if not identity:
+        return str(msg.sender), False
+    return f"{aioxmpp.JID.fromstr(str(msg.sender)).bare()}/{identity}", True
+
+
+def route(jid: str) -> Tuple[str, str]:
+    """Gateway JID and identity to send to for an identity's JID."""
+    gateway, identity = jid.split("/", 1)
+    return gateway, identity
+
+
+def identity_of(msg, identities: Collection[str]) -> Optional[str]:
+    """The gateway identity ``msg`` is for, or None if it is for the agent itself.
+
+    Replies sent before the hub learned a route are addressed to the
+    identity's JID and still name the identity in their resource.
+    """
+    identity = msg.get_metadata(IDENTITY)
+    if identity:
+        return identity
+    resource = msg.to.resource if msg.to is not None else None
+    return resource if resource in identities else None
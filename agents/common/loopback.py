@@ -0,0 +1,89 @@
+import asyncio
+import os
+from typing import Dict, Optional, Tuple
+
+import aioxmpp
+
+
+class Loopback:
+    """Delivers messages between the agents of this process without XMPP.
+
+    A drop-in for SPADE's ``Container`` as an agent's ``container``: a message
+    to an agent registered here is handed to its ``dispatch`` as is, on the
+    loop the receiver runs on, so agents on different ``AgentRuntime`` loops
+    can talk. Receivers are looked up by bare JID, normalized like the
+    server does. Messages to any other JID, or to an agent that is not
+    running, go over XMPP.
+    """
+
+    def __init__(self):
+        self.agents: Dict[str, Tuple[object, asyncio.AbstractEventLoop]] = {}
+        self.delivered = 0
+
+    @staticmethod
+    def key(jid) -> str:
+        if not isinstance(jid, aioxmpp.JID):
+            jid = aioxmpp.JID.fromstr(str(jid))
+        return str(jid.bare())
+
+    def register(self, agent):
+        """Routes ``agent``'s messages through the loopback until it stops; call it from ``setup``."""
+        self.agents[self.key(agent.jid)] = (agent, asyncio.get_running_loop())
+        agent.set_container(self)
+        if "stop" not in vars(agent):  # not wrapped by an earlier setup
+            agent.stop = _unregistering(agent, agent.stop)
+
+    def unregister(self, agent):
+        key = self.key(agent.jid)
+        if self.agents.get(key, (None,))[0] is agent:
+            del self.agents[key]
+
+    def local_agent(self, jid):
+        """The running agent of this process with ``jid``, if any."""
+        agent, _ = self.agents.get(self.key(jid), (None, None))
+        return agent if agent is not None and agent.is_alive() else None
+
+    def deliver(self, msg) -> bool:
+        agent, loop = self.agents.get(self.key(msg.to), (None, None))
+        if agent is None or not agent.is_alive():
+            return False
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is running:
+            agent.dispatch(msg)
+        else:
+            try:
+                loop.call_soon_threadsafe(agent.dispatch, msg)
+            except RuntimeError:  # the receiver's loop is closed
+                return False
+        self.delivered += 1
+        return True
+
+    async def send(self, msg, behaviour):
+        if not self.deliver(msg):
+            await behaviour._xmpp_send(msg=msg)
+
+
+def _unregistering(agent, stop):
+    """``agent.stop`` that first drops the agent from the loopback it is registered with."""
+
+    async def unregister_and_stop():
+        if isinstance(agent.container, Loopback):
+            agent.container.unregister(agent)
+        return await stop()
+
+    return unregister_and_stop
+
+
+LOOPBACK = Loopback()
+# "loopback" when the agents talking to each other share a process
+TRANSPORT = os.environ.get("AGENT_TRANSPORT", "xmpp")
+
+
+def use_loopback(agent, loopback: Optional[Loopback] = None):
+    """Registers ``agent`` with the process's loopback if the transport asks for it."""
+    if loopback is None and TRANSPORT != "loopback":
+        return
+    (loopback or LOOPBACK).register(agent)
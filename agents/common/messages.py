@@ -0,0 +1,176 @@
+from collections.abc import Mapping
+from dataclasses import dataclass, field, fields
+from typing import ClassVar, Dict, List, Optional, Tuple, Type
+
+
+class MessageBody(Mapping):
+    """Typed body of one conversation, see ``agents/hub/messages.md``.
+
+    Bodies also read like the dicts they are decoded from, so code indexing
+    ``data["offer_id"]`` works on either.
+    """
+
+    __slots__ = ()
+    conversation_id: ClassVar[str] = ""
+    keys_: ClassVar[Tuple[str, ...]] = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
+
+
+@dataclass(slots=True)
+class InboundBody(MessageBody):
+    # Set by the receiving hub, never sent
+    sender: Optional[str] = field(default=None, kw_only=True, metadata={"wire": False})
+
+
+BODIES: Dict[str, Type[MessageBody]] = {}  # conversation-id -> body class
+
+
+def body(conversation_id: Optional[str] = None):
+    """Registers a body class for its conversation-id; nested bodies have none."""
+
+    def register(cls):
+        cls.keys_ = tuple(f.name for f in fields(cls))
+        if conversation_id is not None:
+            cls.conversation_id = conversation_id
+            BODIES[conversation_id] = cls
+        return cls
+
+    return register
+
+
+Location = Tuple[float, float]
+
+
+# In
+
+
+@body("confirmation-response")
+@dataclass(slots=True)
+class ConfirmationResponse(InboundBody):
+    offer_id: str
+    confirmed: bool
+
+
+@body("bid")
+@dataclass(slots=True)
+class Bid(InboundBody):
+    offer_id: str
+    amount: int
+
+
+@body("proxy-bid")
+@dataclass(slots=True)
+class ProxyBid(InboundBody):
+    offer_id: str
+    max_amount: int
+    increment: int = 1
+
+
+@body("register-rental")
+@dataclass(slots=True)
+class RegisterRental(InboundBody):
+    min_price: int
+    max_price: int
+    location: Location
+    service_type: Optional[str] = None
+
+
+@body("rental-offer")
+@dataclass(slots=True)
+class RentalOffer(InboundBody):
+    starting_price: int
+    location: Location
+
+
+@body()
+@dataclass(slots=True)
+class OfferEntry(MessageBody):
+    starting_price: int
+    location: Location
+
+
+@body("rental-offers")
+@dataclass(slots=True)
+class RentalOffers(InboundBody):
+    offers: List[OfferEntry]
+
+
+@body("ServiceDemandRequest")
+@dataclass(slots=True)
+class ServiceDemandRequest(InboundBody):
+    localization: Location
+    service_type: str
+    priority: Optional[str] = None
+
+
+# Out
+
+
+@body("auction-start")
+@dataclass(slots=True)
+class AuctionStart(MessageBody):
+    offer_id: str
+    starting_price: int
+    location: Location
+    end_time: str
+    current_highest_bid: Optional[int] = None  # only when joining a running auction
+
+
+@body("outbid-notification")
+@dataclass(slots=True)
+class OutbidNotification(MessageBody):
+    offer_id: str
+    current_highest_bid: int
+
+
+@body("auction-stop")
+@dataclass(slots=True)
+class AuctionStop(MessageBody):
+    offer_id: str
+
+
+@body("confirmation-request")
+@dataclass(slots=True)
+class ConfirmationRequest(MessageBody):
+    offer_id: str
+    bid_amount: float  # demand-adjusted, so not always whole
+
+
+@body("auction-lost")
+@dataclass(slots=True)
+class AuctionLost(MessageBody):
+    offer_id: str
+
+
+@body("auction-completed")
+@dataclass(slots=True)
+class AuctionCompleted(MessageBody):
+    offer_id: str
+    final_price: int
+
+
+@body("offer-expired")
+@dataclass(slots=True)
+class OfferExpired(MessageBody):
+    offer_id: str
+    starting_price: int
+    location: Location
+
+
+@body("request-expired")
+@dataclass(slots=True)
+class RequestExpired(MessageBody):
+    min_price: int
+    max_price: int
+    location: Location
@@ -0,0 +1,92 @@
+import os
+import threading
+import uuid
+from collections import deque
+from typing import Callable, Optional
+
+from agents.common.runtime import AgentRuntime
+
+
+class AgentPool:
+    """Agents started ahead of time, so a listing does not wait for XMPP.
+
+    ``size`` agents are kept connected and registered on ``runtime``, named
+    ``<prefix>_<random>@<domain>``. ``claim`` hands one out at once; when no
+    more than ``refill_at`` are left the pool starts new ones up to ``size``
+    in the background. An empty pool claims nothing and the caller starts an
+    agent itself, as without a pool.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[str], object],
+        runtime: AgentRuntime,
+        size: int,
+        refill_at: Optional[int] = None,
+        prefix: str = "agent",
+        domain: str = "localhost",
+    ):
+        self.factory = factory  # JID -> agent, not started yet
+        self.runtime = runtime
+        self.size = size
+        self.refill_at = size - 1 if refill_at is None else refill_at
+        self.prefix = prefix
+        self.domain = domain
+        self.ready = deque()
+        self.starting = 0
+        self.lock = threading.Lock()
+        self.refill()
+
+    def refill(self):
+        with self.lock:
+            missing = max(self.size - len(self.ready) - self.starting, 0)
+            self.starting += missing
+        for _ in range(missing):
+            agent = self.factory(f"{self.prefix}_{uuid.uuid4().hex[:8]}@{self.domain}")
+            self.runtime.start(agent).add_done_callback(
+                lambda future, agent=agent: self._started(agent, future)
+            )
+
+    def _started(self, agent, future):
+        with self.lock:
+            self.starting -= 1
+            if future.exception() is None and self.size:
+                self.ready.append(agent)
+                return
+        if future.exception() is not None:
+            # Not retried here, the next claim refills
+            print(f"Pooled agent {agent.jid} failed to start: {future.exception()!r}")
+        self.runtime.stop(agent)
+
+    def claim(self):
+        """A started agent taken out of the pool, or None if none is ready."""
+        claimed = None
+        with self.lock:
+            while self.ready and claimed is None:
+                agent = self.ready.popleft()
+                if agent.is_alive():
+                    claimed = agent
+                else:
+                    self.runtime.stop(agent)
+            low = len(self.ready) + self.starting <= self.refill_at
+        if low:
+            self.refill()
+        return claimed
+
+    def close(self):
+        with self.lock:
+            agents, self.ready = list(self.ready), deque()
+            self.size = 0
+        for agent in agents:
+            self.runtime.stop(agent)
+
+
+def pool_from_env(name: str, factory, runtime: AgentRuntime, prefix: str) -> Optional[AgentPool]:
+    """Pool sized by ``<name>_POOL_SIZE`` and refilled at ``<name>_POOL_REFILL_AT``, if any."""
+    size = int(os.environ.get(f"{name}_POOL_SIZE", "0"))
+    if size <= 0:
+        return None
+    refill_at = os.environ.get(f"{name}_POOL_REFILL_AT")
+    return AgentPool(
+        factory, runtime, size, int(refill_at) if refill_at else None, prefix=prefix
+    )
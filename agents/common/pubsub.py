@@ -0,0 +1,49 @@
+import os
+
+import aioxmpp.pubsub.xso as pubsub_xso
+import aioxmpp.xso as xso
+from spade.message import Message
+
+from agents.common import codec
+from database.system_data import DEFAULT_METADATA
+
+
+NAMESPACE = "urn:kraken:premise-hub:auction"
+# Tigase's pubsub component, see tigase/config/config.tdsl
+SERVICE = os.environ.get("PUBSUB_SERVICE", "pubsub.localhost")
+
+
+@pubsub_xso.as_payload_class
+class AuctionEvent(xso.XSO):
+    """A hub notification published to the node of an auction."""
+
+    TAG = (NAMESPACE, "event")
+
+    conversation_id = xso.Attr("conversation-id")
+    language = xso.Attr("language", default=codec.JSON)
+    body = xso.Text()
+
+    def __init__(self, conversation_id=None, body=None, language=codec.JSON):
+        super().__init__()
+        self.conversation_id = conversation_id
+        self.body = body
+        self.language = language
+
+
+def auction_node(offer_id: str) -> str:
+    return f"auction/{offer_id}"
+
+
+def event_message(to: str, event: AuctionEvent, sender: str = None) -> Message:
+    """The message ``event`` stands for, to dispatch to the agent's handlers."""
+    return Message(
+        to=str(to),
+        sender=str(sender) if sender else None,
+        metadata={
+            "performative": "inform",
+            "conversation-id": event.conversation_id,
+            **DEFAULT_METADATA,
+            "language": event.language,
+        },
+        body=event.body,
+    )
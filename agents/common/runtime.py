@@ -0,0 +1,57 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+
+class AgentRuntime:
+    """Hosts many agents on a small, fixed set of event loops.
+
+    Each loop runs forever on its own daemon thread and a new agent goes to
+    the loop currently hosting the fewest agents.
+    """
+
+    def __init__(self, loops: Optional[int] = None):
+        self.loops = []
+        self.threads = []
+        for _ in range(loops or os.cpu_count() or 1):
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, daemon=True)
+            thread.start()
+            self.loops.append(loop)
+            self.threads.append(thread)
+        self.load: Dict[asyncio.AbstractEventLoop, int] = {loop: 0 for loop in self.loops}
+        self.placement: Dict[str, asyncio.AbstractEventLoop] = {}  # jid -> loop
+        self.lock = threading.Lock()
+
+    def loop_of(self, agent) -> asyncio.AbstractEventLoop:
+        return self.placement[str(agent.jid)]
+
+    def start(self, agent, auto_register=True) -> Future:
+        with self.lock:
+            loop = min(self.loops, key=self.load.__getitem__)
+            self.load[loop] += 1
+            self.placement[str(agent.jid)] = loop
+        agent.set_loop(loop)
+        return asyncio.run_coroutine_threadsafe(
+            agent.start(auto_register=auto_register), loop
+        )
+
+    def call(self, agent, callback: Callable[[], None]):
+        self.loop_of(agent).call_soon_threadsafe(callback)
+
+    def submit(self, agent, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop_of(agent))
+
+    def stop(self, agent) -> Future:
+        with self.lock:
+            loop = self.placement.pop(str(agent.jid))
+            self.load[loop] -= 1
+        return asyncio.run_coroutine_threadsafe(agent.stop(), loop)
+
+    def shutdown(self):
+        for loop in self.loops:
+            loop.call_soon_threadsafe(loop.stop)
+        for thread in self.threads:
+            thread.join()
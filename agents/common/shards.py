@@ -0,0 +1,70 @@
+import bisect
+import os
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from agents.hub.spatial_index import CLOSE_DISTANCE
+
+
+DEFAULT_HUB = "hub_agent@localhost"
+
+
+class ShardMap:
+    """Splits the city into bands along one coordinate, one hub per band.
+
+    Hub ``i`` owns locations with ``boundaries[i - 1] <= location[axis] <
+    boundaries[i]``. Offer ids are interleaved between the hubs (hub ``i``
+    issues ``i``, ``i + n``, ``i + 2n``...), so the hub running an auction
+    follows from its offer id alone.
+    """
+
+    def __init__(self, hubs: Sequence[str], boundaries: Sequence[float] = (), axis: int = 1):
+        if len(boundaries) != len(hubs) - 1:
+            raise ValueError("A shard map needs one boundary between each pair of hubs")
+        self.hubs = list(hubs)
+        self.boundaries = sorted(boundaries)
+        self.axis = axis
+
+    def __len__(self):
+        return len(self.hubs)
+
+    def index_for(self, location) -> int:
+        return bisect.bisect_right(self.boundaries, location[self.axis])
+
+    def hub_for(self, location) -> str:
+        """The hub that owns ``location``."""
+        return self.hubs[self.index_for(location)]
+
+    def hubs_near(self, location) -> List[str]:
+        """Every hub owning a location close to ``location``.
+
+        Standing requests and demand votes go to all of them, so an offer on
+        the other side of a boundary still matches a request close to it.
+        """
+        coordinate = location[self.axis]
+        first = bisect.bisect_right(self.boundaries, coordinate - CLOSE_DISTANCE)
+        last = bisect.bisect_right(self.boundaries, coordinate + CLOSE_DISTANCE)
+        return self.hubs[first : last + 1]
+
+    def hub_for_offer(self, offer_id) -> str:
+        return self.hubs[int(offer_id) % len(self.hubs)]
+
+    def group_by_hub(self, items: Iterable, location_of) -> Dict[str, list]:
+        groups: Dict[str, list] = {}
+        for item in items:
+            groups.setdefault(self.hub_for(location_of(item)), []).append(item)
+        return groups
+
+
+def default_shards(environ: Optional[dict] = None) -> ShardMap:
+    """Shard map from ``HUB_JIDS`` and ``HUB_SHARD_BOUNDARIES``, both comma separated.
+
+    Without them all messages go to the single ``hub_agent@localhost``.
+    """
+    environ = os.environ if environ is None else environ
+    hubs = [jid.strip() for jid in environ.get("HUB_JIDS", DEFAULT_HUB).split(",")]
+    boundaries = [
+        float(boundary)
+        for boundary in environ.get("HUB_SHARD_BOUNDARIES", "").split(",")
+        if boundary.strip()
+    ]
+    return ShardMap(hubs, boundaries)
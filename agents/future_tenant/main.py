@@ -1,275 +1,377 @@
-import inspect
-import spade
-from spade.agent import Agent
-from spade.behaviour import OneShotBehaviour, CyclicBehaviour
-from spade.template import Template
-from spade.message import Message
-import asyncio
-import json
-import threading
-from dataclasses import dataclass
-import sys
-import os
-
-
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'database')))
-from system_data import DEFAULT_METADATA
-
-@dataclass
-class TenantOfferDetails:
-    min_price: float
-    max_price: float
-    location: tuple[float]
-
-
-class FutureTenantAgent(Agent):
-    def __init__(self, jid, password, event_queue: asyncio.Queue, *args, **kwargs):
-        super().__init__(jid, password, *args, **kwargs)
-        self.event_queue = event_queue
-
-    class RegisterRental(OneShotBehaviour):
-        def __init__(self, tenant_offer_details: TenantOfferDetails):
-            super().__init__()
-            self.tenant_offer_details = tenant_offer_details
-
-        async def run(self):
-            print("RegisterRental running")
-            msg = Message(
-                to="hub_agent@localhost",
-                metadata={
-                    "performative": "inform",
-                    "conversation-id": "register-rental",
-                    **DEFAULT_METADATA,
-                },
-                body=json.dumps(
-                    {
-                        "min_price": self.tenant_offer_details.min_price,
-                        "max_price": self.tenant_offer_details.max_price,
-                        "location": self.tenant_offer_details.location,
-                    }
-                ),
-            )
-            await self.send(msg)
-
-    class AuctionStart(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=20)
-            if not msg:
-                return
-            print("AuctionStart got msg")
-
-            data = json.loads(msg.body)
-            offer_id = data["offer_id"]
-            starting_price = data["starting_price"]
-
-            await self.agent.event_queue.put({"type": "auction-start", "data": {"offer_id": offer_id, "starting_price": starting_price}, "agent": self.agent.jid})
-
-
-        metadata = {"conversation-id": "auction-start"}
-
-    class Bid(OneShotBehaviour):
-        def __init__(self, offer_id, amount):
-            super().__init__()
-            self.offer_id = offer_id
-            self.amount = amount
-
-        async def run(self):
-            await self.send(
-                    Message(
-                        to="hub_agent@localhost",
-                        metadata={
-                            "performative": "inform",
-                            "conversation-id": "bid",
-                            **DEFAULT_METADATA,
-                        },
-                        body=json.dumps({"offer_id": self.offer_id, "amount": self.amount}),
-                    )
-            )
-
-
-    class OutbidNotification(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=20)
-            if not msg:
-                return
-            print("OutbidNotification got msg")
-            data = json.loads(msg.body)
-
-            current_highest_bid = data["current_highest_bid"]
-
-            await self.agent.event_queue.put({"type": "outbid-notification", "data": {"current_highest_bid": current_highest_bid}, "agent": self.agent.jid})
-
-        metadata = {"conversation-id": "outbid-notification"}
-
-    class AuctionStop(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=20)
-            if not msg:
-                return
-            print("AuctionStop got msg")
-
-            # TODO: show popup on frontend
-            await self.agent.event_queue.put({"type": "auction-stop", "agent": self.agent.jid})
-
-        metadata = {
-            "conversation-id": "auction-stop",
-            **DEFAULT_METADATA,
-        }
-
-    class ConfirmationRequest(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=20)
-            if not msg:
-                return
-            print("ConfirmationRequest got msg")
-
-            data = json.loads(msg.body)
-            offer_id = data["offer_id"]
-            bid_amount = data["bid_amount"]
-
-            await self.agent.event_queue.put({"type": "confirmation-request", "data": {"offer_id": offer_id, "bid_amount": bid_amount}, "agent": self.agent.jid})
-
-            # TODO: show popup on frontend
-
-
-        metadata = {
-            "conversation-id": "confirmation-request",
-            **DEFAULT_METADATA,
-        }
-
-    class Confirm(OneShotBehaviour):
-        def __init__(self, offer_id, confirmation):
-            super().__init__()
-            self.offer_id = offer_id
-            self.confirmation = confirmation
-
-        async def run(self):
-            await self.send(
-                Message(
-                    to="hub_agent@localhost",
-                    metadata={
-                        "performative": "inform",
-                        "conversation-id": "confirmation-response",
-                        **DEFAULT_METADATA,
-                    },
-                    body=json.dumps(
-                        {"offer_id": self.offer_id, "confirmed": self.confirmation}
-                    ),
-                )
-            )
-
-    class AuctionLost(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=20)
-            if not msg:
-                return
-            print("AuctionLost got msg")
-
-            await self.agent.event_queue.put({"type": "auction-lost", "agent": self.agent.jid})
-
-        metadata = {
-            "conversation-id": "auction-lost",
-            **DEFAULT_METADATA,
-        }
-
-    async def setup(self):
-        for d in [
-            d
-            for d in dir(self)
-            if inspect.isclass(getattr(self, d)) and d != "__class__"
-        ]:
-            attr = getattr(self, d)
-            if issubclass(attr, CyclicBehaviour) and hasattr(attr, "metadata"):
-                template = Template(metadata=attr.metadata)
-                self.add_behaviour(attr(), template)
-
-    def add_register_rental(self, tenant_offer_details: TenantOfferDetails):
-        behavior = self.RegisterRental(tenant_offer_details)
-        self.add_behaviour(behavior)
-
-    def add_confirm(self, offer_id, confirmation):
-        behavior = self.Confirm(offer_id, confirmation)
-        self.add_behaviour(behavior)
-
-    def add_bid(self, offer_id, amount):
-        behavior = self.Bid(offer_id, amount)
-        self.add_behaviour(behavior)
-
-
-class FutureTenantInterface:
-    def __init__(self, event_queue):
-        self.event_queue = event_queue
-        self.agents = []
-
-    def register_tenant(self, agent_id, tenant_offer_details: TenantOfferDetails):
-        new_jid = f"{agent_id}@localhost"
-        new_password = "some_password"
-        new_agent = FutureTenantAgent(new_jid, new_password, self.event_queue)
-        new_loop = asyncio.new_event_loop()
-
-        def agent_thread_main():
-            asyncio.set_event_loop(new_loop)
-            new_loop.run_until_complete(new_agent.start(auto_register=True))
-            new_loop.run_until_complete(spade.wait_until_finished(new_agent))
-
-        t = threading.Thread(target=agent_thread_main, daemon=True)
-        t.start()
-
-        new_loop.call_soon_threadsafe(lambda: new_agent.add_register_rental(tenant_offer_details))
-
-        self.agents.append({
-            "agent": new_agent,
-            "loop": new_loop,
-            "thread": t,
-            "jid": new_jid,
-        })
-
-    def add_bid_bhv(self, agent_id, offer_id, amount):
-        agent_entry = next(
-            (agent for agent in self.agents if agent["jid"] == f"{agent_id}@localhost"), None
-        )
-        if not agent_entry:
-            print("run bid: Agent not found")
-            return
-
-        agent = agent_entry["agent"]
-        loop: asyncio.AbstractEventLoop = agent_entry["loop"]
-
-        loop.call_soon_threadsafe(lambda: agent.add_bid(offer_id, amount))
-
-    def add_confirm_bhv(self, agent_id, offer_id, confirmation):
-        agent_entry = next(
-            (agent for agent in self.agents if agent["jid"] == f"{agent_id}@localhost"), None
-        )
-        if not agent_entry:
-            print("run confirm: Agent not found")
-            return
-
-        agent = agent_entry["agent"]
-        loop: asyncio.AbstractEventLoop = agent_entry["loop"]
-
-        loop.call_soon_threadsafe(lambda: agent.add_confirm(offer_id, confirmation))
-
-    def stop_all_agents(self):
-        for agent_entry in self.agents:
-            agent = agent_entry["agent"]
-            loop = agent_entry["loop"]
-
-            def stop_agent():
-                loop.create_task(agent.stop())
-
-            loop.call_soon_threadsafe(stop_agent)
-        self.agents = []
-
-async def main():
-    future_tenant = FutureTenantAgent(
-        "future_tenant@localhost", "future_tenant_password"
-    )
-    await future_tenant.start(auto_register=True)
-
-    await spade.wait_until_finished(future_tenant)
-    print("Agents finished")
-
-
-if __name__ == "__main__":
-    spade.run(main())
+import aioxmpp
+import spade
+from spade.agent import Agent
+from spade.behaviour import OneShotBehaviour
+import asyncio
+from dataclasses import dataclass
+from typing import Optional
+import sys
+import os
+
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'database')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from system_data import DEFAULT_METADATA
+from agents.common import codec, gateway
+from agents.common.codec import MessageError
+from agents.common.dispatch import MessageHandler, add_message_handlers
+from agents.common.loopback import use_loopback
+from agents.common.pool import pool_from_env
+from agents.common.pubsub import AuctionEvent, event_message
+from agents.common.runtime import AgentRuntime
+from agents.common.shards import ShardMap, default_shards
+
+@dataclass
+class TenantOfferDetails:
+    min_price: int
+    max_price: int
+    location: tuple[float]
+    service_type: Optional[str] = None
+
+
+class FutureTenantAgent(Agent):
+    """A tenant, or a gateway acting for many tenants over one connection.
+
+    As a gateway, behaviours take the ``identity`` of the tenant they act
+    for and events carry that tenant's JID, see ``agents.common.gateway``.
+    """
+
+    def __init__(self, jid, password, event_queue: asyncio.Queue, *args, use_dispatcher=False, shards: ShardMap = None, **kwargs):
+        super().__init__(jid, password, *args, **kwargs)
+        self.event_queue = event_queue
+        self.use_dispatcher = use_dispatcher
+        self.shards = shards or default_shards()
+        self.standing_bids = {}  # (identity, offer_id) -> own bid, or proxy maximum
+        self.identities = set()  # tenants this agent is a gateway for
+
+    def agent_jid(self, identity=None) -> aioxmpp.JID:
+        """JID the events of ``identity`` are reported under."""
+        return self.jid if identity is None else self.jid.replace(localpart=identity)
+
+    def identity_of(self, msg):
+        return gateway.identity_of(msg, self.identities)
+
+    class RegisterRental(OneShotBehaviour):
+        def __init__(self, tenant_offer_details: TenantOfferDetails, identity=None):
+            super().__init__()
+            self.tenant_offer_details = tenant_offer_details
+            self.identity = identity
+
+        async def run(self):
+            print("RegisterRental running")
+            payload = {
+                "min_price": self.tenant_offer_details.min_price,
+                "max_price": self.tenant_offer_details.max_price,
+                "location": self.tenant_offer_details.location,
+                "service_type": self.tenant_offer_details.service_type,
+            }
+            # Near a shard boundary the request stands at every hub it can match in
+            for hub in self.agent.shards.hubs_near(self.tenant_offer_details.location):
+                await self.send(
+                    gateway.with_identity(
+                        codec.message(hub, "register-rental", payload), self.identity
+                    )
+                )
+
+    class AuctionStart(MessageHandler):
+        async def handle(self, msg):
+            print("AuctionStart got msg")
+
+            data = codec.decode_message(msg)
+            identity = self.agent.identity_of(msg)
+            offer_id = data.offer_id
+            starting_price = data.starting_price
+            # The hub enters the tenant at the starting price
+            self.agent.standing_bids[identity, offer_id] = starting_price
+
+            await self.agent.event_queue.put({"type": "auction-start", "data": {"offer_id": offer_id, "starting_price": starting_price}, "agent": self.agent.agent_jid(identity)})
+
+
+        metadata = {"conversation-id": "auction-start"}
+
+    class Bid(OneShotBehaviour):
+        def __init__(self, offer_id, amount, identity=None):
+            super().__init__()
+            self.offer_id = offer_id
+            self.amount = amount
+            self.identity = identity
+
+        async def run(self):
+            self.agent.raise_standing_bid(self.identity, self.offer_id, self.amount)
+            await self.send(
+                gateway.with_identity(
+                    codec.message(
+                        self.agent.shards.hub_for_offer(self.offer_id),
+                        "bid",
+                        {"offer_id": self.offer_id, "amount": self.amount},
+                    ),
+                    self.identity,
+                )
+            )
+
+
+    class ProxyBid(OneShotBehaviour):
+        def __init__(self, offer_id, max_amount, increment, identity=None):
+            super().__init__()
+            self.offer_id = offer_id
+            self.max_amount = max_amount
+            self.increment = increment
+            self.identity = identity
+
+        async def run(self):
+            self.agent.raise_standing_bid(self.identity, self.offer_id, self.max_amount)
+            await self.send(
+                gateway.with_identity(
+                    codec.message(
+                        self.agent.shards.hub_for_offer(self.offer_id),
+                        "proxy-bid",
+                        {
+                            "offer_id": self.offer_id,
+                            "max_amount": self.max_amount,
+                            "increment": self.increment,
+                        },
+                    ),
+                    self.identity,
+                )
+            )
+
+    class OutbidNotification(MessageHandler):
+        async def handle(self, msg):
+            print("OutbidNotification got msg")
+            data = codec.decode_message(msg)
+
+            current_highest_bid = data.current_highest_bid
+
+            await self.agent.event_queue.put({"type": "outbid-notification", "data": {"current_highest_bid": current_highest_bid}, "agent": self.agent.agent_jid(self.agent.identity_of(msg))})
+
+        metadata = {"conversation-id": "outbid-notification"}
+
+    class AuctionStop(MessageHandler):
+        async def handle(self, msg):
+            print("AuctionStop got msg")
+            identity = self.agent.identity_of(msg)
+            self.agent.standing_bids.pop((identity, codec.decode_message(msg).offer_id), None)
+
+            # TODO: show popup on frontend
+            await self.agent.event_queue.put({"type": "auction-stop", "agent": self.agent.agent_jid(identity)})
+
+        metadata = {
+            "conversation-id": "auction-stop",
+            **DEFAULT_METADATA,
+        }
+
+    class ConfirmationRequest(MessageHandler):
+        async def handle(self, msg):
+            print("ConfirmationRequest got msg")
+
+            data = codec.decode_message(msg)
+            offer_id = data.offer_id
+            bid_amount = data.bid_amount
+
+            await self.agent.event_queue.put({"type": "confirmation-request", "data": {"offer_id": offer_id, "bid_amount": bid_amount}, "agent": self.agent.agent_jid(self.agent.identity_of(msg))})
+
+            # TODO: show popup on frontend
+
+
+        metadata = {
+            "conversation-id": "confirmation-request",
+            **DEFAULT_METADATA,
+        }
+
+    class Confirm(OneShotBehaviour):
+        def __init__(self, offer_id, confirmation, identity=None):
+            super().__init__()
+            self.offer_id = offer_id
+            self.confirmation = confirmation
+            self.identity = identity
+
+        async def run(self):
+            await self.send(
+                gateway.with_identity(
+                    codec.message(
+                        self.agent.shards.hub_for_offer(self.offer_id),
+                        "confirmation-response",
+                        {"offer_id": self.offer_id, "confirmed": self.confirmation},
+                    ),
+                    self.identity,
+                )
+            )
+
+    class AuctionLost(MessageHandler):
+        async def handle(self, msg):
+            print("AuctionLost got msg")
+
+            await self.agent.event_queue.put({"type": "auction-lost", "agent": self.agent.agent_jid(self.agent.identity_of(msg))})
+
+        metadata = {
+            "conversation-id": "auction-lost",
+            **DEFAULT_METADATA,
+        }
+
+    class RequestExpired(MessageHandler):
+        async def handle(self, msg):
+            print("RequestExpired got msg")
+
+            await self.agent.event_queue.put({"type": "request-expired", "agent": self.agent.agent_jid(self.agent.identity_of(msg))})
+
+        metadata = {
+            "conversation-id": "request-expired",
+            **DEFAULT_METADATA,
+        }
+
+    async def setup(self):
+        use_loopback(self)
+        add_message_handlers(self, self.use_dispatcher)
+        # Broadcasts of large auctions come from their pubsub node
+        self.client.summon(aioxmpp.PubSubClient).on_item_published.connect(
+            self.on_auction_event
+        )
+
+    def raise_standing_bid(self, identity, offer_id, amount):
+        key = identity, offer_id
+        self.standing_bids[key] = max(self.standing_bids.get(key, amount), amount)
+
+    def on_auction_event(self, jid, node, item, *, message=None):
+        event = item.registered_payload
+        if not isinstance(event, AuctionEvent):
+            return
+        msg = event_message(self.jid, event, sender=jid)
+        if event.conversation_id == "outbid-notification" and not self.is_outbid(msg):
+            return
+        self.dispatch(msg)
+
+    def is_outbid(self, msg) -> bool:
+        """Whether a published outbid notification is news to this tenant.
+
+        It goes to every bidder of the auction, including the one leading.
+        Gateway identities are never subscribed, the hub messages them.
+        """
+        try:
+            data = codec.decode_message(msg)
+        except MessageError:
+            return True  # the handler drops it
+        return self.standing_bids.get((None, data.offer_id), 0) < data.current_highest_bid
+
+    def add_register_rental(self, tenant_offer_details: TenantOfferDetails, identity=None):
+        if identity is not None:
+            self.identities.add(identity)
+        behavior = self.RegisterRental(tenant_offer_details, identity)
+        self.add_behaviour(behavior)
+
+    def add_confirm(self, offer_id, confirmation, identity=None):
+        behavior = self.Confirm(offer_id, confirmation, identity)
+        self.add_behaviour(behavior)
+
+    def add_bid(self, offer_id, amount, identity=None):
+        behavior = self.Bid(offer_id, amount, identity)
+        self.add_behaviour(behavior)
+
+    def add_proxy_bid(self, offer_id, max_amount, increment=1, identity=None):
+        behavior = self.ProxyBid(offer_id, max_amount, increment, identity)
+        self.add_behaviour(behavior)
+
+
+class FutureTenantInterface:
+    def __init__(self, event_queue, runtime: AgentRuntime = None, shards: ShardMap = None, gateway_jid: Optional[str] = None):
+        self.event_queue = event_queue
+        self.runtime = runtime or AgentRuntime()
+        self.shards = shards or default_shards()
+        self.agents = []
+        # With a gateway every tenant shares its single XMPP connection
+        self.gateway_jid = gateway_jid or os.environ.get("TENANT_GATEWAY")
+        self.gateway = None
+        # Tenants connected ahead of time, claimed by the next listings
+        self.pool = None
+        if not self.gateway_jid:
+            self.pool = pool_from_env("TENANT", self.new_agent, self.runtime, prefix="tenant")
+
+    def new_agent(self, jid) -> FutureTenantAgent:
+        return FutureTenantAgent(jid, "some_password", self.event_queue, shards=self.shards)
+
+    def gateway_agent(self) -> FutureTenantAgent:
+        if self.gateway is None:
+            self.gateway = self.new_agent(self.gateway_jid)
+            self.runtime.start(self.gateway)
+        return self.gateway
+
+    def register_tenant(self, agent_id, tenant_offer_details: TenantOfferDetails) -> str:
+        """Registers the rental request and returns the id of the tenant agent making it.
+
+        That is ``agent_id`` unless an agent was claimed from the pool.
+        """
+        pooled = self.pool.claim() if self.pool else None
+        if pooled is not None:
+            agent_id = pooled.jid.localpart
+        new_jid = f"{agent_id}@localhost"
+        identity = None
+        if self.gateway_jid:
+            new_agent, identity = self.gateway_agent(), agent_id
+        elif pooled is not None:
+            new_agent = pooled
+        else:
+            new_agent = self.new_agent(new_jid)
+            self.runtime.start(new_agent)
+
+        self.runtime.call(new_agent, lambda: new_agent.add_register_rental(tenant_offer_details, identity))
+
+        self.agents.append({
+            "agent": new_agent,
+            "jid": new_jid,
+            "identity": identity,
+        })
+        return agent_id
+
+    def add_bid_bhv(self, agent_id, offer_id, amount):
+        agent_entry = next(
+            (agent for agent in self.agents if agent["jid"] == f"{agent_id}@localhost"), None
+        )
+        if not agent_entry:
+            print("run bid: Agent not found")
+            return
+
+        agent, identity = agent_entry["agent"], agent_entry["identity"]
+        self.runtime.call(agent, lambda: agent.add_bid(offer_id, amount, identity))
+
+    def add_proxy_bid_bhv(self, agent_id, offer_id, max_amount, increment=1):
+        agent_entry = next(
+            (agent for agent in self.agents if agent["jid"] == f"{agent_id}@localhost"), None
+        )
+        if not agent_entry:
+            print("run proxy bid: Agent not found")
+            return
+
+        agent, identity = agent_entry["agent"], agent_entry["identity"]
+        self.runtime.call(agent, lambda: agent.add_proxy_bid(offer_id, max_amount, increment, identity))
+
+    def add_confirm_bhv(self, agent_id, offer_id, confirmation):
+        agent_entry = next(
+            (agent for agent in self.agents if agent["jid"] == f"{agent_id}@localhost"), None
+        )
+        if not agent_entry:
+            print("run confirm: Agent not found")
+            return
+
+        agent, identity = agent_entry["agent"], agent_entry["identity"]
+        self.runtime.call(agent, lambda: agent.add_confirm(offer_id, confirmation, identity))
+
+    def stop_all_agents(self):
+        # The gateway is listed once per tenant it acts for
+        for agent in {id(entry["agent"]): entry["agent"] for entry in self.agents}.values():
+            self.runtime.stop(agent)
+        self.agents = []
+        self.gateway = None
+        if self.pool:
+            self.pool.close()
+
+async def main():
+    future_tenant = FutureTenantAgent(
+        "future_tenant@localhost", "future_tenant_password"
+    )
+    await future_tenant.start(auto_register=True)
+
+    await spade.wait_until_finished(future_tenant)
+    print("Agents finished")
+
+
+if __name__ == "__main__":
+    spade.run(main())
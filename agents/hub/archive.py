@@ -0,0 +1,53 @@
+import json
+from datetime import datetime
+
+
+class AuctionArchive:
+    """Append-only JSON lines file of finished auctions.
+
+    Lines are buffered and reach the disk on ``flush``. A journal replay may
+    archive an auction again, so readers keep the last line per ``offer_id``.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "a", encoding="utf-8")
+
+    def append(self, offer_id: str, auction, winner, now: datetime):
+        self.file.write(
+            json.dumps(
+                {
+                    "offer_id": offer_id,
+                    "landlord_jid": auction.offer.agent_jid,
+                    "starting_price": auction.offer.starting_price,
+                    "location": auction.offer.location,
+                    "winner_jid": winner.bidder_jid if winner else None,
+                    "final_price": winner.amount if winner else None,
+                    "bids": [
+                        {
+                            "bidder_jid": bid.bidder_jid,
+                            "amount": bid.amount,
+                            "timestamp": bid.timestamp.isoformat(),
+                        }
+                        for bid in auction.bids
+                    ],
+                    "completed_at": now.isoformat(),
+                }
+            )
+            + "\n"
+        )
+
+    def read(self):
+        self.flush()
+        auctions = {}
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                auction = json.loads(line)
+                auctions[auction["offer_id"]] = auction
+        return list(auctions.values())
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,63 @@
+import bisect
+from typing import Dict, Iterator, List
+
+
+def _rank_key(bid):
+    return -bid.amount, bid.timestamp, bid.bidder_jid
+
+
+class BidBook:
+    """Bids of an auction, one per bidder, ranked by amount then by time.
+
+    Rank 0 is the highest bid; equal amounts rank the earlier bid first.
+    """
+
+    def __init__(self, bids=()):
+        self.ranking: List[tuple] = []
+        self.by_bidder: Dict[str, object] = {}
+        for bid in bids:
+            self.place(bid)
+
+    def __len__(self):
+        return len(self.ranking)
+
+    def __iter__(self) -> Iterator:
+        return (self.by_bidder[key[2]] for key in self.ranking)
+
+    def __contains__(self, bidder_jid):
+        return bidder_jid in self.by_bidder
+
+    def __getitem__(self, rank):
+        if isinstance(rank, slice):
+            return [self.by_bidder[key[2]] for key in self.ranking[rank]]
+        return self.by_bidder[self.ranking[rank][2]]
+
+    def place(self, bid):
+        """Adds a bid, replacing the bidder's previous one."""
+        previous = self.by_bidder.get(bid.bidder_jid)
+        if previous is not None:
+            del self.ranking[self.rank_of(bid.bidder_jid)]
+        self.by_bidder[bid.bidder_jid] = bid
+        bisect.insort(self.ranking, _rank_key(bid))
+
+    def remove(self, bidder_jid: str):
+        if bidder_jid in self.by_bidder:
+            del self.ranking[self.rank_of(bidder_jid)]
+            del self.by_bidder[bidder_jid]
+
+    def get(self, bidder_jid: str):
+        return self.by_bidder.get(bidder_jid)
+
+    def highest(self):
+        return self[0] if self.ranking else None
+
+    def rank_of(self, bidder_jid: str) -> int:
+        bid = self.by_bidder.get(bidder_jid)
+        if bid is None:
+            return -1
+        return bisect.bisect_left(self.ranking, _rank_key(bid))
+
+    def below(self, amount) -> List:
+        """Bids lower than the given amount, highest first."""
+        start = bisect.bisect_right(self.ranking, -amount, key=lambda key: key[0])
+        return self[start:]
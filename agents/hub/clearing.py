@@ -0,0 +1,94 @@
+from typing import Dict, Optional
+
+import numpy as np
+
+from agents.hub.model import ClearingProblem
+
+
+def _first_per_group(groups: np.ndarray) -> np.ndarray:
+    """Positions where a run of equal values starts in a sorted array."""
+    return np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]][: len(groups)])
+
+
+def auction_assignment(
+    bidder_index,
+    offer_index,
+    values,
+    bidders: int,
+    offers: int,
+    epsilon: Optional[float] = None,
+) -> np.ndarray:
+    """Offer assigned to each bidder, or -1, maximizing the total value.
+
+    A sparse forward auction: every unassigned bidder bids at once for the
+    offer with the best value net of its price, raising the price by how
+    much better it is than the second best (or than staying unassigned)
+    plus ``epsilon``. Each offer goes to its highest bidder, outbidding the
+    previous one. Bidders leave once no offer is worth its price. The total
+    value is within ``bidders * epsilon`` of the optimum.
+    """
+    bidder_index = np.asarray(bidder_index, dtype=np.int64)
+    offer_index = np.asarray(offer_index, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if epsilon is None:
+        epsilon = max(float(values.max(initial=0.0)) * 1e-3, 1e-9)
+
+    prices = np.zeros(offers)
+    owner = np.full(offers, -1, dtype=np.int64)
+    assigned = np.full(bidders, -1, dtype=np.int64)
+    active = np.zeros(bidders, dtype=bool)
+    active[bidder_index] = True
+
+    while True:
+        edges = np.flatnonzero(active[bidder_index])
+        if not len(edges):
+            return assigned
+        bidder, offer = bidder_index[edges], offer_index[edges]
+        net = values[edges] - prices[offer]
+
+        # Best and second best offer of every active bidder
+        order = np.lexsort((offer, -net, bidder))
+        bidder, offer, net = bidder[order], offer[order], net[order]
+        best = _first_per_group(bidder)
+        after = np.minimum(best + 1, len(bidder) - 1)
+        second = np.where(
+            (best + 1 < len(bidder)) & (bidder[after] == bidder[best]), net[after], 0.0
+        )
+        second = np.maximum(second, 0.0)
+
+        gives_up = net[best] <= 0
+        active[bidder[best[gives_up]]] = False
+        best, second = best[~gives_up], second[~gives_up]
+        bidder, offer = bidder[best], offer[best]
+        amount = prices[offer] + net[best] - second + epsilon
+
+        # Highest bid for each offer, ties to the lower bidder index
+        order = np.lexsort((bidder, -amount, offer))
+        bidder, offer, amount = bidder[order], offer[order], amount[order]
+        winners = _first_per_group(offer)
+        bidder, offer, amount = bidder[winners], offer[winners], amount[winners]
+
+        outbid = owner[offer]
+        outbid = outbid[outbid >= 0]
+        assigned[outbid] = -1
+        active[outbid] = True
+        owner[offer] = bidder
+        assigned[bidder] = offer
+        prices[offer] = amount
+        active[bidder] = False
+
+
+def solve(problem: ClearingProblem) -> Dict[str, str]:
+    """Offer id -> tenant JID for the auctions of ``problem``."""
+    assigned = auction_assignment(
+        problem.bidder_index,
+        problem.offer_index,
+        problem.values,
+        len(problem.bidders),
+        len(problem.offer_ids),
+    )
+    return {
+        problem.offer_ids[offer]: problem.bidders[bidder]
+        for bidder, offer in enumerate(assigned.tolist())
+        if offer >= 0
+    }
@@ -0,0 +1,389 @@
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from agents.hub.archive import AuctionArchive
+from agents.hub.matching import (
+    VECTOR_MIN_SIZE,
+    close_rows,
+    column,
+    covering_mask,
+    covering_rows,
+)
+from agents.hub.model import RentalOffer, RentalRequest
+from agents.hub.spatial_index import CLOSE_DISTANCE, SpatialIndex
+from agents.hub.store import BaseStore
+
+
+NO_CODE = -1
+
+
+class JidTable:
+    """Interns JIDs and other repeated strings as small integer codes."""
+
+    def __init__(self):
+        self.strings: List[str] = []
+        self.codes: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def code(self, string: Optional[str]) -> int:
+        if string is None:
+            return NO_CODE
+        code = self.codes.get(string)
+        if code is None:
+            code = self.codes[string] = len(self.strings)
+            self.strings.append(sys.intern(string))
+        return code
+
+    def string(self, code: int) -> Optional[str]:
+        return None if code == NO_CODE else self.strings[code]
+
+
+class Columns:
+    """Rows of one grid cell stored as one typed array per field.
+
+    Rows are kept dense and ordered by the ``order_by`` price column, so a
+    price condition narrows a block to a run of rows by bisection before
+    any location is compared.
+    """
+
+    __slots__ = ("cell", "ids")
+    fields: Tuple[Tuple[str, str], ...] = ()
+    order_by = ""
+
+    def __init__(self, cell: Tuple[int, int]):
+        self.cell = cell
+        self.ids = array("q")
+        for name, typecode in self.fields:
+            setattr(self, name, array(typecode))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def columns(self):
+        return [self.ids] + [getattr(self, name) for name, _ in self.fields]
+
+    def append(self, key: int, values: tuple):
+        """Inserts a row after the rows with the same or a lower price."""
+        names = [name for name, _ in self.fields]
+        row = bisect_right(getattr(self, self.order_by), values[names.index(self.order_by)])
+        self.ids.insert(row, key)
+        for (name, _), value in zip(self.fields, values):
+            getattr(self, name).insert(row, value)
+
+    def remove(self, key: int):
+        row = self.ids.index(key)
+        for column in self.columns():
+            del column[row]
+
+    def sort(self):
+        """Puts the rows in price order, for blocks pickled before they were kept in it."""
+        prices = getattr(self, self.order_by)
+        order = sorted(range(len(prices)), key=prices.__getitem__)
+        if order != list(range(len(order))):
+            for column in self.columns():
+                column[:] = array(column.typecode, [column[row] for row in order])
+
+    def row_of(self, key: int) -> int:
+        return self.ids.index(key)
+
+
+class OfferColumns(Columns):
+    __slots__ = ("lat", "lon", "starting_price", "agent")
+    fields = (("lat", "d"), ("lon", "d"), ("starting_price", "q"), ("agent", "q"))
+    order_by = "starting_price"
+
+    @staticmethod
+    def values(offer: RentalOffer, jids: JidTable) -> tuple:
+        lat, lon = offer.location
+        return lat, lon, offer.starting_price, jids.code(offer.agent_jid)
+
+    def build(self, row: int, jids: JidTable) -> RentalOffer:
+        return RentalOffer(
+            agent_jid=jids.string(self.agent[row]),
+            starting_price=self.starting_price[row],
+            location=(self.lat[row], self.lon[row]),
+        )
+
+    def in_price_range(self, location, low, high) -> List[int]:
+        start = bisect_left(self.starting_price, low)
+        stop = bisect_right(self.starting_price, high, start)
+        if stop - start >= VECTOR_MIN_SIZE:
+            return close_rows(self, location, start, stop)
+        lat, lon = location
+        return [
+            row
+            for row in range(start, stop)
+            if abs(self.lat[row] - lat) < CLOSE_DISTANCE
+            and abs(self.lon[row] - lon) < CLOSE_DISTANCE
+        ]
+
+
+class RequestColumns(Columns):
+    __slots__ = ("lat", "lon", "min_price", "max_price", "agent", "service_type", "widest")
+    fields = (
+        ("lat", "d"),
+        ("lon", "d"),
+        ("min_price", "q"),
+        ("max_price", "q"),
+        ("agent", "q"),
+        ("service_type", "q"),
+    )
+    order_by = "min_price"
+
+    def __init__(self, cell: Tuple[int, int]):
+        super().__init__(cell)
+        # Widest price range ever stored here, so rows covering a price
+        # start at most this far below it
+        self.widest = 0
+
+    def append(self, key: int, values: tuple):
+        super().append(key, values)
+        _, _, min_price, max_price, *_ = values
+        self.widest = max(self.widest, max_price - min_price)
+
+    def sort(self):
+        super().sort()
+        self.widest = max(
+            (high - low for low, high in zip(self.min_price, self.max_price)), default=0
+        )
+
+    @staticmethod
+    def values(request: RentalRequest, jids: JidTable) -> tuple:
+        lat, lon = request.location
+        return (
+            lat,
+            lon,
+            request.min_price,
+            request.max_price,
+            jids.code(request.agent_jid),
+            jids.code(request.service_type),
+        )
+
+    def build(self, row: int, jids: JidTable) -> RentalRequest:
+        return RentalRequest(
+            min_price=self.min_price[row],
+            max_price=self.max_price[row],
+            location=(self.lat[row], self.lon[row]),
+            agent_jid=jids.string(self.agent[row]),
+            service_type=jids.string(self.service_type[row]),
+        )
+
+    def candidates(self, low, high) -> Tuple[int, int]:
+        """Run of rows that can cover a price between ``low`` and ``high``."""
+        start = bisect_left(self.min_price, low - self.widest)
+        return start, bisect_right(self.min_price, high, start)
+
+    def covering(self, location, price) -> List[int]:
+        start, stop = self.candidates(price, price)
+        if stop - start >= VECTOR_MIN_SIZE:
+            return covering_rows(self, location, price, start, stop)
+        lat, lon = location
+        return [
+            row
+            for row in range(start, stop)
+            if price <= self.max_price[row]
+            and abs(self.lat[row] - lat) < CLOSE_DISTANCE
+            and abs(self.lon[row] - lon) < CLOSE_DISTANCE
+        ]
+
+
+class ColumnTable(Mapping):
+    """Read-only mapping view that builds objects from their columns on access."""
+
+    def __init__(self, rows: dict, jids: JidTable):
+        self.rows = rows  # key -> Columns holding its row
+        self.jids = jids
+
+    def __getitem__(self, key):
+        block = self.rows[key]
+        return block.build(block.row_of(int(key)), self.jids)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class ColumnStore(BaseStore):
+    """Offers and requests kept column-wise, one block of arrays per grid cell.
+
+    Locations are float64 arrays, prices int64 arrays and JIDs integer codes
+    into a shared ``JidTable``, so a standing request takes about a third of
+    the memory of a dataclass with its location tuple. Matching looks at
+    the blocks of the nine cells around a location, bisects each to the
+    rows whose price can match (offers are ordered by starting price,
+    requests by minimum price, within the block's widest range below the
+    price) and only builds objects for the rows that match.
+    """
+
+    def __init__(self, archive: Optional[AuctionArchive] = None, cell_size=CLOSE_DISTANCE):
+        super().__init__(archive)
+        self.grid = SpatialIndex(cell_size)
+        self.jids = JidTable()
+        self.offer_rows: Dict[str, OfferColumns] = {}
+        self.request_rows: Dict[int, RequestColumns] = {}
+        self.offer_blocks: Dict[Tuple[int, int], OfferColumns] = {}
+        self.request_blocks: Dict[Tuple[int, int], RequestColumns] = {}
+        self._views()
+
+    def _views(self):
+        self.offers = ColumnTable(self.offer_rows, self.jids)
+        self.requests = ColumnTable(self.request_rows, self.jids)
+
+    def _add(self, rows, blocks, new_block, key, item, row_id):
+        self._remove(rows, blocks, key, row_id)
+        cell = self.grid.cell(item.location)
+        block = blocks.get(cell)
+        if block is None:
+            block = blocks[cell] = new_block(cell)
+        rows[key] = block
+        block.append(row_id, block.values(item, self.jids))
+
+    def _remove(self, rows, blocks, key, row_id):
+        block = rows.pop(key, None)
+        if block is None:
+            return
+        block.remove(row_id)
+        if not block:
+            del blocks[block.cell]
+
+    def add_offer(self, offer_id: str, offer, expires_at: Optional[datetime] = None):
+        self._add(
+            self.offer_rows, self.offer_blocks, OfferColumns, offer_id, offer, int(offer_id)
+        )
+        self._expire_at(("offer", offer_id), expires_at)
+
+    def remove_offer(self, offer_id: str):
+        self._remove(self.offer_rows, self.offer_blocks, offer_id, int(offer_id))
+        self.expiry.cancel(("offer", offer_id))
+
+    def add_request(self, request_id: int, request, expires_at: Optional[datetime] = None):
+        self._add(
+            self.request_rows,
+            self.request_blocks,
+            RequestColumns,
+            request_id,
+            request,
+            request_id,
+        )
+        self._expire_at(("request", request_id), expires_at)
+
+    def remove_request(self, request_id: int):
+        self._remove(self.request_rows, self.request_blocks, request_id, request_id)
+        self.expiry.cancel(("request", request_id))
+
+    def requests_by_id(self, request_ids) -> Dict[int, RentalRequest]:
+        """The requests among ``request_ids`` that still stand.
+
+        Rows move whenever a block takes or loses a row, so ids are found by
+        scanning each block they are in once, rather than one scan per id.
+        """
+        wanted: Dict[RequestColumns, set] = {}
+        for request_id in request_ids:
+            block = self.request_rows.get(request_id)
+            if block is not None:
+                wanted.setdefault(block, set()).add(request_id)
+        found = {}
+        for block, ids in wanted.items():
+            if len(block) < VECTOR_MIN_SIZE:
+                rows = [row for row, request_id in enumerate(block.ids) if request_id in ids]
+            else:
+                rows = np.flatnonzero(np.isin(column(block.ids), list(ids))).tolist()
+            for row in rows:
+                found[block.ids[row]] = block.build(row, self.jids)
+        return found
+
+    def neighbour_blocks(self, blocks, location):
+        for cell in self.grid.neighbour_cells(location):
+            block = blocks.get(cell)
+            if block:
+                yield block
+
+    def offers_in_price_range(self, location, low, high) -> Iterator[Tuple[str, RentalOffer]]:
+        for block in self.neighbour_blocks(self.offer_blocks, location):
+            for row in block.in_price_range(location, low, high):
+                yield str(block.ids[row]), block.build(row, self.jids)
+
+    def requests_covering_price(self, location, price) -> Iterator[Tuple[int, RentalRequest]]:
+        for block in self.neighbour_blocks(self.request_blocks, location):
+            for row in block.covering(location, price):
+                yield block.ids[row], block.build(row, self.jids)
+
+    def requests_covering_prices(self, offers) -> List[List[Tuple[int, RentalRequest]]]:
+        """Requests matching each of ``offers``.
+
+        Offers are grouped by grid cell and each group is compared against
+        every neighbouring block in a single ``(offers, rows)`` mask. A request
+        matching several offers is built once and shared between them.
+        """
+        matches = [[] for _ in offers]
+        built: Dict[int, RentalRequest] = {}
+
+        def match(i, block, row):
+            request_id = block.ids[row]
+            request = built.get(request_id)
+            if request is None:
+                request = built[request_id] = block.build(row, self.jids)
+            matches[i].append((request_id, request))
+
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        for i, offer in enumerate(offers):
+            groups.setdefault(self.grid.cell(offer.location), []).append(i)
+
+        for group in groups.values():
+            location = offers[group[0]].location
+            lats = [offers[i].location[0] for i in group]
+            lons = [offers[i].location[1] for i in group]
+            prices = [offers[i].starting_price for i in group]
+            for block in self.neighbour_blocks(self.request_blocks, location):
+                start, stop = block.candidates(min(prices), max(prices))
+                if len(group) * (stop - start) < VECTOR_MIN_SIZE:
+                    for i in group:
+                        for row in block.covering(offers[i].location, offers[i].starting_price):
+                            match(i, block, row)
+                    continue
+                offer_indexes, rows = np.nonzero(
+                    covering_mask(block, lats, lons, prices, start, stop)
+                )
+                for offer_index, row in zip(offer_indexes.tolist(), rows.tolist()):
+                    match(group[offer_index], block, start + row)
+        return matches
+
+    def snapshot(self, tag=None) -> dict:
+        return {
+            **super().snapshot(tag),
+            "jids": self.jids,
+            "offer_blocks": self.offer_blocks,
+            "request_blocks": self.request_blocks,
+        }
+
+    def restore(self, state: dict):
+        self.jids = state["jids"]
+        self.offer_blocks = state["offer_blocks"]
+        self.request_blocks = state["request_blocks"]
+        for block in (*self.offer_blocks.values(), *self.request_blocks.values()):
+            block.sort()
+        self.offer_rows = {
+            str(offer_id): block
+            for block in self.offer_blocks.values()
+            for offer_id in block.ids
+        }
+        self.request_rows = {
+            request_id: block
+            for block in self.request_blocks.values()
+            for request_id in block.ids
+        }
+        self._views()
+        super().restore(state)
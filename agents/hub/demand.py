@@ -0,0 +1,45 @@
+from array import array
+from typing import Dict, Optional, Tuple
+
+from database.system_data import SERVICE_OPTIONS
+
+from agents.hub.spatial_index import CLOSE_DISTANCE, SpatialIndex
+
+
+class DemandGrid:
+    """Citizen votes per spatial cell and service type.
+
+    Each cell holds an array with one counter per ``SERVICE_OPTIONS`` entry
+    plus a trailing total. A vote is added to its cell and to the eight
+    neighbouring cells, so the counters of a cell already hold every vote
+    close to it and a lookup is a single array read.
+    """
+
+    def __init__(self, service_options=SERVICE_OPTIONS, cell_size=CLOSE_DISTANCE):
+        self.service_options = list(service_options)
+        self.service_index = {name: i for i, name in enumerate(self.service_options)}
+        self.other = self.service_index.get("Other", len(self.service_options) - 1)
+        self.total = len(self.service_options)
+        self.grid = SpatialIndex(cell_size)
+        self.cells: Dict[Tuple[int, int], array] = {}
+
+    def _slot(self, service_type: Optional[str]) -> int:
+        if service_type is None:
+            return self.total
+        return self.service_index.get(service_type, self.other)
+
+    def add_vote(self, service_type: str, location, weight: int = 1):
+        slot = self._slot(service_type)
+        for cell in self.grid.neighbour_cells(location):
+            counters = self.cells.get(cell)
+            if counters is None:
+                counters = self.cells[cell] = array("q", bytes(8 * (self.total + 1)))
+            counters[slot] += weight
+            counters[self.total] += weight
+
+    def votes(self, location, service_type: Optional[str] = None) -> int:
+        """Votes near a location for a service type, or for all of them."""
+        counters = self.cells.get(self.grid.cell(location))
+        if counters is None:
+            return 0
+        return counters[self._slot(service_type)]
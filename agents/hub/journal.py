@@ -0,0 +1,157 @@
+import json
+import os
+import pickle
+import time
+from datetime import datetime
+
+
+class Journal:
+    """Write-ahead log of market inputs with periodic snapshots.
+
+    ``directory`` holds ``snapshot.pickle``, the market state up to some
+    sequence number, and ``events.log``, one JSON line per input appended
+    after it. Appends are flushed right away but fsynced in batches of
+    ``sync_every`` inputs or every ``sync_interval`` seconds. Every
+    ``snapshot_every`` inputs the market is snapshotted, its store flushed
+    and the log truncated. The snapshot before is kept as
+    ``snapshot.previous.pickle`` until then, for a store that was not
+    flushed yet.
+    """
+
+    def __init__(
+        self, directory, sync_every=256, sync_interval=1.0, snapshot_every=10_000
+    ):
+        self.directory = directory
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.snapshot_every = snapshot_every
+        self.snapshot_path = os.path.join(directory, "snapshot.pickle")
+        self.previous_snapshot_path = os.path.join(directory, "snapshot.previous.pickle")
+        self.log_path = os.path.join(directory, "events.log")
+        self.seq = 0
+        self.unsynced = 0
+        self.since_snapshot = 0
+        self.last_sync = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        self.log = open(self.log_path, "a", encoding="utf-8")
+
+    def recover(self, market) -> int:
+        """Loads the latest snapshot into ``market`` and replays the log tail.
+
+        The previous snapshot is loaded instead when the store refuses the
+        latest one. A torn last line is cut off, so later inputs do not
+        append onto it, and an input the market fails to apply is logged and
+        skipped. Without a snapshot the market is snapshotted before any
+        input is logged, so a persistent store has a state to roll back to
+        before replaying.
+        """
+        snapshot_paths = [
+            path
+            for path in (self.snapshot_path, self.previous_snapshot_path)
+            if os.path.exists(path)
+        ]
+        has_snapshot = bool(snapshot_paths)
+        for path in snapshot_paths:
+            with open(path, "rb") as f:
+                snapshot = pickle.load(f)
+            try:
+                market.restore(snapshot["market"])
+            except ValueError:
+                # The store was not flushed at this snapshot, try the one before
+                if path == snapshot_paths[-1]:
+                    raise
+                continue
+            self.seq = snapshot["seq"]
+            break
+        if not has_snapshot and os.path.getsize(self.log_path) and (
+            market.rental_offers or market.rental_requests
+        ):
+            raise RuntimeError(
+                f"{self.log_path} has no snapshot to replay onto a non-empty market"
+            )
+
+        replayed = 0
+        # End of the last complete line, new inputs are appended from there
+        good_end = 0
+        with open(self.log_path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("unterminated line")
+                    event = json.loads(line)
+                except ValueError:
+                    # Torn write at the end of the log
+                    break
+                good_end += len(line)
+                if event["seq"] <= self.seq:
+                    continue
+                self.seq = event["seq"]
+                try:
+                    market.apply(
+                        event["kind"], event["data"], datetime.fromisoformat(event["at"])
+                    )
+                except Exception as error:
+                    # Skipped rather than failing every restart on the same input
+                    print(f"Skipped journaled {event['kind']} #{event['seq']}: {error!r}")
+                    continue
+                replayed += 1
+        self.log.truncate(good_end)
+        self.since_snapshot = replayed
+        if not has_snapshot:
+            self.snapshot(market)
+        return replayed
+
+    def append(self, kind: str, data: dict, now: datetime):
+        self.seq += 1
+        self.log.write(
+            json.dumps(
+                {"seq": self.seq, "at": now.isoformat(), "kind": kind, "data": data},
+                default=dict,  # typed message bodies
+            )
+            + "\n"
+        )
+        self.log.flush()
+        self.unsynced += 1
+        self.since_snapshot += 1
+        if (
+            self.unsynced >= self.sync_every
+            or time.monotonic() - self.last_sync >= self.sync_interval
+        ):
+            self.sync()
+
+    def sync(self):
+        if self.unsynced:
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def maybe_snapshot(self, market):
+        if self.since_snapshot >= self.snapshot_every:
+            self.snapshot(market)
+
+    def snapshot(self, market):
+        self.sync()
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                {"seq": self.seq, "market": market.snapshot(self.seq)},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(self.snapshot_path):
+            os.replace(self.snapshot_path, self.previous_snapshot_path)
+        os.replace(tmp_path, self.snapshot_path)
+        # A persistent store commits the state of the snapshot only now
+        market.store.flush()
+
+        # Every logged input is covered by the snapshot now
+        self.log.close()
+        self.log = open(self.log_path, "w", encoding="utf-8")
+        self.since_snapshot = 0
+
+    def close(self):
+        self.sync()
+        self.log.close()
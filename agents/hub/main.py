@@ -1,526 +1,313 @@
-import spade
-from spade.agent import Agent
-from spade.behaviour import CyclicBehaviour
-from spade.template import Template
-import json
-import inspect
-from dataclasses import dataclass
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-import asyncio
-import uuid
-import sys
-import os
-
-
-sys.path.append(
-    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "database"))
-)
-from system_data import DEFAULT_METADATA
-
-@dataclass
-class RentalOffer:
-    agent_jid: str
-    starting_price: int
-    location: tuple[float, float]
-
-
-@dataclass
-class RentalRequest:
-    min_price: int
-    max_price: int
-    location: tuple[float, float]
-    votes: int
-    agent_jid: str
-
-
-def is_close(location1, location2):
-    return (
-        abs(location1[0] - location2[0]) < 0.01
-        and abs(location1[1] - location2[1]) < 0.01
-    )
-
-
-def sigmoid(x):
-    return 1 / (1 + math.exp(-x))
-
-
-@dataclass
-class Bid:
-    request: RentalRequest
-    bidder_jid: str
-    amount: int
-    timestamp: datetime
-
-
-@dataclass
-class Auction:
-    offer: RentalOffer
-    bids: List[Bid]
-    end_time: datetime
-    status: str  # 'bidding', 'confirming', 'completed'
-    current_confirming_bidder: Optional[str] = None
-    confirmation_deadline: Optional[datetime] = None
-
-    def extend_duration(self, duration: timedelta):
-        new_end_time = datetime.now() + duration
-        if new_end_time > self.end_time:
-            self.end_time = new_end_time
-
-    def get_outbid_agents(self, amount: int) -> List[str]:
-        return [bid.bidder_jid for bid in self.bids if bid.amount < amount]
-
-    def get_winning_bids(self) -> List[Bid]:
-        return sorted(self.bids, key=lambda x: (-x.amount, x.timestamp))
-
-
-class HubAgent(Agent):
-    def __init__(
-        self,
-        jid,
-        password,
-        auction_time=timedelta(seconds=20),
-        extend_duration=timedelta(seconds=5),
-    ):
-        super().__init__(jid, password)
-        self.rental_offers = []
-        self.rental_requests = []
-        self.active_auctions: Dict[str, Auction] = {}  # offer_id -> Auction
-        self.auction_time = auction_time
-        self.extend_duration = extend_duration
-
-    class RegisterRentalRequestRecvBhv(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=20)
-            if not msg:
-                return
-
-            data = json.loads(msg.body)
-            request = RentalRequest(
-                min_price=data["min_price"],
-                max_price=data["max_price"],
-                location=tuple(data["location"]),
-                agent_jid=str(msg.sender),
-            )
-
-            # Store the request
-            self.agent.rental_requests.append(request)
-
-            # Check for matching offers that already have active auctions
-            for offer_id, auction in self.agent.active_auctions.items():
-                if (
-                    is_close(auction.offer.location, request.location)
-                    and request.min_price
-                    <= auction.offer.starting_price
-                    <= request.max_price
-                ):
-                    auction.bids.append(
-                        Bid(
-                            request=request,
-                            bidder_jid=request.agent_jid,
-                            amount=auction.offer.starting_price,
-                            timestamp=datetime.now(),
-                        )
-                    )
-                    # Notify the requester about the existing auction
-                    msg = spade.message.Message(
-                        to=request.agent_jid,
-                        metadata={"conversation-id": "auction-start"},
-                        body=json.dumps(
-                            {
-                                "offer_id": offer_id,
-                                "starting_price": auction.offer.starting_price,
-                                "location": auction.offer.location,
-                                "current_highest_bid": max(
-                                    (bid.amount for bid in auction.bids),
-                                    default=auction.offer.starting_price,
-                                ),
-                                "end_time": auction.end_time.isoformat(),
-                            }
-                        ),
-                    )
-                    await self.send(msg)
-
-            # Check for matching offers that don't have auctions yet
-            matching_offers = [
-                (offer_id, offer)
-                for offer_id, offer in enumerate(self.agent.rental_offers)
-                if (
-                    is_close(offer.location, request.location)
-                    and request.min_price <= offer.starting_price <= request.max_price
-                    and str(offer_id) not in self.agent.active_auctions
-                )
-            ]
-
-            # Start new auctions if there are multiple requests for the same offer
-            for offer_id, offer in matching_offers:
-                matching_requests = [
-                    req
-                    for req in self.agent.rental_requests
-                    if (
-                        is_close(offer.location, req.location)
-                        and req.min_price <= offer.starting_price <= req.max_price
-                    )
-                ]
-
-                if (
-                    len(matching_requests) >= 1
-                    and str(offer_id) not in self.agent.active_auctions
-                ):
-                    # Create new auction
-                    auction = Auction(
-                        offer=offer,
-                        bids=[],
-                        end_time=datetime.now() + self.agent.auction_time,
-                        status="bidding",
-                    )
-                    self.agent.active_auctions[str(offer_id)] = auction
-
-                    # Notify all matching requesters about the new auction
-                    for req in matching_requests:
-                        auction.bids.append(
-                            Bid(
-                                request=req,
-                                bidder_jid=req.agent_jid,
-                                amount=offer.starting_price,
-                                timestamp=datetime.now(),
-                            )
-                        )
-                        msg = spade.message.Message(
-                            to=req.agent_jid,
-                            metadata={"conversation-id": "auction-start"},
-                            body=json.dumps(
-                                {
-                                    "offer_id": str(offer_id),
-                                    "starting_price": offer.starting_price,
-                                    "location": offer.location,
-                                    "end_time": auction.end_time.isoformat(),
-                                }
-                            ),
-                        )
-                        await self.send(msg)
-                    print("New auction started")
-
-        metadata = {
-            "performative": "inform",
-            "conversation-id": "register-rental",
-            **DEFAULT_METADATA,
-        }
-
-    class RegisterRentalOfferRecvBhv(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=20)
-            if not msg:
-                return
-            print("RegisterRentalOfferRecvBhv got msg")
-
-            data = json.loads(msg.body)
-            offer = RentalOffer(**data, agent_jid=str(msg.sender), votes=0)
-            offer_id = str(uuid.uuid4())
-
-            matching_requests = [
-                request
-                for request in self.agent.rental_requests
-                if is_close(offer.location, request.location)
-                and request.min_price <= offer.starting_price <= request.max_price
-            ]
-
-            if len(matching_requests) >= 1:
-                auction = Auction(
-                    offer=offer,
-                    bids=[],
-                    end_time=datetime.now() + self.agent.auction_time,
-                    status="bidding",
-                )
-                self.agent.active_auctions[offer_id] = auction
-
-                # Notify all matching requesters about the auction
-                for request in matching_requests:
-                    auction.bids.append(
-                        Bid(
-                            request=request,
-                            bidder_jid=request.agent_jid,
-                            amount=offer.starting_price,
-                            timestamp=datetime.now(),
-                        )
-                    )
-                    msg = spade.message.Message(
-                        to=request.agent_jid,
-                        metadata={
-                            "conversation-id": "auction-start",
-                            **DEFAULT_METADATA,
-                        },
-                        body=json.dumps(
-                            {
-                                "offer_id": offer_id,
-                                "starting_price": offer.starting_price,
-                                "location": offer.location,
-                                "end_time": auction.end_time.isoformat(),
-                            }
-                        ),
-                    )
-                    await self.send(msg)
-
-            self.agent.rental_offers.append(offer)
-
-        metadata = {
-            "performative": "inform",
-            "conversation-id": "rental-offer",
-        }
-
-    class HandleBidBehaviour(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=20)
-            if not msg:
-                return
-
-            data = json.loads(msg.body)
-            offer_id = data["offer_id"]
-            bid_amount = data["amount"]
-            bidder_jid = str(msg.sender)
-
-            auction = self.agent.active_auctions.get(offer_id)
-            if not auction or auction.status != "bidding":
-                return
-
-            # Record the bid
-            current_bid = next(
-                (
-                    i
-                    for i, bid in enumerate(auction.bids)
-                    if bid.bidder_jid == bidder_jid
-                ),
-            )
-            new_bid = Bid(
-                request=current_bid.request,
-                bidder_jid=bidder_jid,
-                amount=bid_amount,
-                timestamp=datetime.now(),
-            )
-            if new_bid.amount <= auction.bids[current_bid].amount:
-                return
-
-            auction.bids[current_bid] = new_bid
-            auction.extend_duration(self.agent.extend_duration)
-
-            # Notify outbid agents
-            outbid_agents = auction.get_outbid_agents(bid_amount)
-            for agent_jid in outbid_agents:
-                msg = spade.message.Message(
-                    to=agent_jid,
-                    metadata={"conversation-id": "outbid-notification"},
-                    body=json.dumps(
-                        {"offer_id": offer_id, "current_highest_bid": bid_amount}
-                    ),
-                )
-                await self.send(msg)
-
-        metadata = {
-            "performative": "inform",
-            "conversation-id": "bid",
-        }
-
-    class AuctionManagerBehaviour(CyclicBehaviour):
-        async def run(self):
-            await asyncio.sleep(1)  # Check every second
-            now = datetime.now()
-
-            for offer_id, auction in list(self.agent.active_auctions.items()):
-                if auction.status == "bidding" and now >= auction.end_time:
-                    # Transition to confirmation phase
-                    auction.status = "confirming"
-
-                    # Notify all bidders
-                    for bid in auction.bids:
-                        msg = spade.message.Message(
-                            to=bid.bidder_jid,
-                            metadata={
-                                "conversation-id": "auction-stop",
-                                **DEFAULT_METADATA,
-                            },
-                            body=json.dumps(
-                                {
-                                    "offer_id": offer_id,
-                                }
-                            ),
-                        )
-                        await self.send(msg)
-
-                    winning_bids = auction.get_winning_bids()
-                    if winning_bids:
-                        auction.current_confirming_bidder = winning_bids[0].bidder_jid
-                        auction.confirmation_deadline = now + timedelta(seconds=20)
-
-                        # Ask for confirmation
-                        msg = spade.message.Message(
-                            to=auction.current_confirming_bidder,
-                            metadata={
-                                "conversation-id": "confirmation-request",
-                                **DEFAULT_METADATA,
-                            },
-                            body=json.dumps(
-                                {
-                                    "offer_id": offer_id,
-                                    "bid_amount": winning_bids[0].amount
-                                    * sigmoid(winning_bids[0].request.votes),
-                                }
-                            ),
-                        )
-                        await self.send(msg)
-
-                elif (
-                    auction.status == "confirming"
-                    and now >= auction.confirmation_deadline
-                ):
-                    # Move to next bidder or close auction
-                    winning_bids = auction.get_winning_bids()
-                    current_index = next(
-                        (
-                            i
-                            for i, bid in enumerate(winning_bids)
-                            if bid.bidder_jid == auction.current_confirming_bidder
-                        ),
-                        -1,
-                    )
-
-                    if current_index + 1 < len(winning_bids):
-                        # Try next bidder
-                        auction.current_confirming_bidder = winning_bids[
-                            current_index + 1
-                        ].bidder_jid
-                        auction.confirmation_deadline = now + timedelta(seconds=20)
-
-                        msg = spade.message.Message(
-                            to=auction.current_confirming_bidder,
-                            metadata={
-                                "conversation-id": "confirmation-request",
-                                **DEFAULT_METADATA,
-                            },
-                            body=json.dumps(
-                                {
-                                    "offer_id": offer_id,
-                                    "bid_amount": winning_bids[
-                                        current_index + 1
-                                    ].amount,
-                                }
-                            ),
-                        )
-                        await self.send(msg)
-                    else:
-                        # No more bidders, close auction
-                        auction.status = "completed"
-                        del self.agent.active_auctions[offer_id]
-
-    class HandleConfirmationBehaviour(CyclicBehaviour):
-        async def run(self):
-            msg = await self.receive(timeout=20)
-            if not msg:
-                return
-
-            data = json.loads(msg.body)
-            offer_id = data["offer_id"]
-            confirmed = data["confirmed"]
-            bidder_jid = str(msg.sender)
-
-            auction = self.agent.active_auctions.get(offer_id)
-            if not auction or auction.status != "confirming":
-                return
-
-            if confirmed and bidder_jid == auction.current_confirming_bidder:
-                winner_bid = next(
-                    bid for bid in auction.bids if bid.bidder_jid == bidder_jid
-                )
-
-                winning_bids = auction.get_winning_bids()
-                current_index = next(
-                    (
-                        i
-                        for i, bid in enumerate(winning_bids)
-                        if bid.bidder_jid == auction.current_confirming_bidder
-                    ),
-                    -1,
-                )
-
-                if current_index + 1 < len(winning_bids):
-                    for losing_bid in winning_bids[current_index + 1 :]:
-                        msg = spade.message.Message(
-                            to=losing_bid.bidder_jid,
-                            metadata={
-                                "conversation-id": "auction-lost",
-                                **DEFAULT_METADATA,
-                            },
-                            body=json.dumps({"offer_id": offer_id}),
-                        )
-                        await self.send(msg)
-
-                # Notify seller
-                msg = spade.message.Message(
-                    to=auction.offer.agent_jid,
-                    metadata={
-                        "conversation-id": "auction-completed",
-                        **DEFAULT_METADATA,
-                    },
-                    body=json.dumps(
-                        {"offer_id": offer_id, "final_price": winner_bid.amount}
-                    ),
-                )
-                await self.send(msg)
-
-                auction.status = "completed"
-                del self.agent.active_auctions[offer_id]
-
-        metadata = {
-            "performative": "inform",
-            "conversation-id": "confirmation-response",
-            **DEFAULT_METADATA,
-        }
-
-    class ServiceDemandRequestRecvBehaviour(CyclicBehaviour):
-        async def run(self):
-            print("ServiceDemandRequestRecvBehaviour running")
-            msg = await self.receive(timeout=20)
-            print("ServiceDemandRequest handled")
-            if not msg:
-                return
-
-            data = json.loads(msg.body)
-
-            for request in self.agent.rental_requests:
-                if request.service_type == data["service_type"] and is_close(
-                    request.location, data["localization"]
-                ):
-                    request.votes += 1
-        metadata = {
-            "performative": "inform",
-            "conversation-id": "ServiceDemandRequest",
-            **DEFAULT_METADATA,
-        }
-
-    async def setup(self):
-        print("HubAgent started")
-
-        self.add_behaviour(self.AuctionManagerBehaviour())
-
-        for d in [
-            d
-            for d in dir(self)
-            if inspect.isclass(getattr(self, d)) and d != "__class__"
-        ]:
-            attr = getattr(self, d)
-            if issubclass(attr, CyclicBehaviour) and hasattr(attr, "metadata"):
-                template = Template(metadata=attr.metadata)
-                self.add_behaviour(attr(), template)
-
-
-async def main():
-    hub_agent = HubAgent("hub_agent@localhost", "hub_agent_password")
-    await hub_agent.start(auto_register=True)
-    hub_agent.web.start(hostname="127.0.0.1", port=10001)
-    print("hub_agent started")
-
-    await spade.wait_until_finished(hub_agent)
-    print("Agents finished")
-
-
-if __name__ == "__main__":
-    spade.run(main())
+import asyncio
+import spade
+from spade.agent import Agent
+from spade.behaviour import CyclicBehaviour, PeriodicBehaviour
+from datetime import datetime, timedelta
+from typing import List
+import sys
+import os
+import traceback
+
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "database"))
+)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from system_data import DEFAULT_METADATA
+from agents.common import codec, gateway
+from agents.common.dispatch import MessageHandler, add_message_handlers
+from agents.common.loopback import use_loopback
+from agents.common.shards import default_shards
+from agents.hub.archive import AuctionArchive
+from agents.hub.clearing import solve
+from agents.hub.columns import ColumnStore
+from agents.hub.journal import Journal
+from agents.hub.market import (
+    Auction,
+    Bid,
+    Market,
+    Notification,
+    PrecomputedMatches,
+    RentalOffer,
+    RentalRequest,
+    whole,
+)
+from agents.hub.outbox import Outbox, PubSubOutbox
+from agents.hub.workers import MatchingPool, worker_executor
+from database.store import SqliteStore
+
+
+class HubMessageHandler(MessageHandler):
+    """Applies the message to the hub's market and sends the resulting notifications."""
+
+    async def handle(self, msg):
+        await self.apply(self.parse(msg))
+
+    def parse(self, msg):
+        """Typed body of ``msg``; raises ``MessageError`` if it is malformed."""
+        data = codec.decode_message(msg)
+        data.sender, is_identity = gateway.sender_of(msg)
+        if is_identity:
+            self.agent.identities.add(data.sender)
+        # Notifications go back in the language the agent writes in
+        language = codec.language_of(msg)
+        if language != codec.JSON:
+            self.agent.languages[data.sender] = language
+        else:
+            self.agent.languages.pop(data.sender, None)
+        return data
+
+    async def apply(self, data: dict, matches=None):
+        notifications = self.agent.apply(
+            self.metadata["conversation-id"], data, matches=matches
+        )
+        await self.agent.outbox.deliver(self, notifications)
+
+
+class HubAgent(Agent):
+    def __init__(
+        self,
+        jid,
+        password,
+        auction_time=timedelta(seconds=20),
+        extend_duration=timedelta(seconds=5),
+        use_dispatcher=False,
+        state_dir=None,
+        store=None,
+        confirmation_time=timedelta(seconds=20),
+        confirmation_fanout=1,
+        shard_index=0,
+        shard_count=1,
+        matching_workers=0,
+        clearing_interval=None,
+        pubsub_service=None,
+        offer_ttl=timedelta(days=1),
+        request_ttl=timedelta(days=1),
+    ):
+        super().__init__(jid, password)
+        self.use_dispatcher = use_dispatcher
+        if store is None and state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+            store = ColumnStore(AuctionArchive(os.path.join(state_dir, "auctions.jsonl")))
+        self.market = Market(
+            auction_time,
+            extend_duration,
+            confirmation_time,
+            store=store,
+            offer_ttl=offer_ttl,
+            request_ttl=request_ttl,
+            confirmation_fanout=confirmation_fanout,
+            offer_id_start=shard_index,
+            offer_id_step=shard_count,
+            clearing=clearing_interval is not None,
+        )
+        self.languages = {}  # JID -> message language, for agents not writing JSON
+        self.identities = set()  # JIDs of gateway identities, see agents.common.gateway
+        outbox = {"languages": self.languages, "identities": self.identities}
+        if pubsub_service:
+            self.outbox = PubSubOutbox(pubsub_service, **outbox)
+        else:
+            self.outbox = Outbox(**outbox)
+        self.matching = MatchingPool(matching_workers) if matching_workers else None
+        self.clearing_interval = clearing_interval
+        self.solver = None
+        if clearing_interval is not None:
+            self.solver = self.matching.executor if self.matching else worker_executor(1)
+        self.imports = set()  # bulk imports waiting for the matching workers
+        self.journal = None
+        if state_dir:
+            self.journal = Journal(state_dir)
+            replayed = self.journal.recover(self.market)
+            print(f"Hub state recovered, replayed {replayed} events")
+
+    @property
+    def rental_offers(self):
+        return self.market.rental_offers
+
+    @property
+    def rental_requests(self):
+        return self.market.rental_requests
+
+    @property
+    def active_auctions(self):
+        return self.market.active_auctions
+
+    def apply(self, kind: str, data: dict, now=None, matches=None) -> List[Notification]:
+        now = now or datetime.now()
+        notifications = self.market.apply(kind, data, now, matches)
+        if self.journal:
+            # Logged once applied, so an input the market rejects cannot fail
+            # every replay. Nothing is sent before it is logged. Precomputed
+            # matches are not journaled, a replay matches from scratch.
+            self.journal.append(kind, data, now)
+            self.journal.maybe_snapshot(self.market)
+        return notifications
+
+    class RegisterRentalRequestRecvBhv(HubMessageHandler):
+        metadata = {
+            "performative": "inform",
+            "conversation-id": "register-rental",
+            **DEFAULT_METADATA,
+        }
+
+    class RegisterRentalOfferRecvBhv(HubMessageHandler):
+        metadata = {
+            "performative": "inform",
+            "conversation-id": "rental-offer",
+        }
+
+    class RegisterRentalOffersRecvBhv(HubMessageHandler):
+        metadata = {
+            "performative": "inform",
+            "conversation-id": "rental-offers",
+        }
+
+        async def handle(self, msg):
+            data = self.parse(msg)
+            pool = self.agent.matching
+            if pool is None or len(data["offers"]) < pool.min_batch:
+                await self.apply(data)
+                return
+            # Large imports are matched by the workers while bids keep coming in
+            task = asyncio.create_task(self.apply_matched(pool, data))
+            self.agent.imports.add(task)
+            task.add_done_callback(self.agent.imports.discard)
+
+        async def apply_matched(self, pool, data: dict):
+            try:
+                offers = data["offers"]
+                matches = await pool.match_offers(
+                    self.agent.market,
+                    [(*offer["location"], whole(offer["starting_price"])) for offer in offers],
+                )
+                # Applied a chunk at a time so no single input holds up the bids
+                for i in range(0, len(offers), pool.chunk_size):
+                    chunk = slice(i, i + pool.chunk_size)
+                    await self.apply(
+                        {**data, "offers": offers[chunk]},
+                        PrecomputedMatches(
+                            matches.candidates[chunk], matches.next_request_id
+                        ),
+                    )
+            except Exception:
+                print("Bulk offer import failed")
+                traceback.print_exc()
+
+    class HandleBidBehaviour(HubMessageHandler):
+        metadata = {
+            "performative": "inform",
+            "conversation-id": "bid",
+        }
+
+    class HandleProxyBidBehaviour(HubMessageHandler):
+        metadata = {
+            "performative": "inform",
+            "conversation-id": "proxy-bid",
+        }
+
+    class AuctionManagerBehaviour(CyclicBehaviour):
+        async def run(self):
+            await self.agent.market.deadlines.wait()
+            now = datetime.now()
+            if self.agent.market.has_due(now):
+                notifications = self.agent.apply("advance", {}, now)
+                await self.agent.outbox.deliver(self, notifications)
+
+    class HandleConfirmationBehaviour(HubMessageHandler):
+        metadata = {
+            "performative": "inform",
+            "conversation-id": "confirmation-response",
+            **DEFAULT_METADATA,
+        }
+
+    class ServiceDemandRequestRecvBehaviour(HubMessageHandler):
+        metadata = {
+            "performative": "inform",
+            "conversation-id": "ServiceDemandRequest",
+            **DEFAULT_METADATA,
+        }
+
+    class ClearingBehaviour(PeriodicBehaviour):
+        """Assigns the tenants of all auctions that ended since the last run at once."""
+
+        async def run(self):
+            problem = self.agent.market.clearing_problem()
+            if problem is None:
+                return
+            loop = asyncio.get_running_loop()
+            try:
+                assignment = await loop.run_in_executor(self.agent.solver, solve, problem)
+            except Exception:
+                # The auctions still get confirmed by rank
+                print("Batch clearing failed")
+                traceback.print_exc()
+                assignment = {}
+            notifications = self.agent.apply(
+                "clear-auctions", {"offer_ids": problem.offer_ids, "assignment": assignment}
+            )
+            await self.agent.outbox.deliver(self, notifications)
+
+    class SyncBehaviour(PeriodicBehaviour):
+        async def run(self):
+            if self.agent.journal:
+                # The store is flushed at the journal's snapshots
+                self.agent.journal.sync()
+            else:
+                self.agent.market.store.flush()
+
+    async def setup(self):
+        print("HubAgent started")
+        use_loopback(self)
+        if isinstance(self.outbox, PubSubOutbox):
+            self.outbox.attach(self.client)
+
+        self.add_behaviour(self.AuctionManagerBehaviour())
+        self.add_behaviour(self.SyncBehaviour(1.0))
+        if self.clearing_interval is not None:
+            self.add_behaviour(
+                self.ClearingBehaviour(self.clearing_interval.total_seconds())
+            )
+        add_message_handlers(self, self.use_dispatcher)
+
+    async def stop(self):
+        if self.matching:
+            self.matching.close()
+        elif self.solver:
+            self.solver.shutdown(cancel_futures=True)
+        await super().stop()
+
+
+async def main():
+    database_path = os.environ.get("HUB_DATABASE")
+    # In a sharded deployment every hub process runs with its own HUB_SHARD_INDEX
+    shards = default_shards()
+    shard_index = int(os.environ.get("HUB_SHARD_INDEX", "0"))
+    hub_agent = HubAgent(
+        shards.hubs[shard_index],
+        "hub_agent_password",
+        state_dir=os.environ.get("HUB_STATE_DIR"),
+        store=SqliteStore(database_path) if database_path else None,
+        confirmation_fanout=int(os.environ.get("HUB_CONFIRMATION_FANOUT", "1")),
+        shard_index=shard_index,
+        shard_count=len(shards),
+        matching_workers=int(os.environ.get("HUB_MATCHING_WORKERS", "0")),
+        clearing_interval=(
+            timedelta(seconds=float(os.environ["HUB_CLEARING_INTERVAL"]))
+            if os.environ.get("HUB_CLEARING_INTERVAL")
+            else None
+        ),
+        pubsub_service=os.environ.get("HUB_PUBSUB_SERVICE"),
+        # Seconds a listing stands unmatched, 0 keeps listings until they are let
+        offer_ttl=timedelta(seconds=float(os.environ.get("HUB_OFFER_TTL", "86400"))),
+        request_ttl=timedelta(seconds=float(os.environ.get("HUB_REQUEST_TTL", "86400"))),
+    )
+    await hub_agent.start(auto_register=True)
+    hub_agent.web.start(hostname="127.0.0.1", port=10001 + shard_index)
+    print("hub_agent started")
+
+    await spade.wait_until_finished(hub_agent)
+    print("Agents finished")
+
+
+if __name__ == "__main__":
+    spade.run(main())
@@ -0,0 +1,696 @@
+import math
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from agents.hub.columns import ColumnStore
+from agents.hub.demand import DemandGrid
+from agents.hub.model import (
+    Auction,
+    Bid,
+    ClearingProblem,
+    Notification,
+    PrecomputedMatches,
+    ProxyBid,
+    RentalOffer,
+    RentalRequest,
+)
+from agents.hub.scheduler import DeadlineScheduler
+
+
+def sigmoid(x):
+    return 1 / (1 + math.exp(-x))
+
+
+EXPIRY_SWEEP = ("expiry",)  # deadline key of the next TTL sweep
+
+
+# Prices and bids are stored in int64 columns
+MAX_AMOUNT = 2**63 - 1
+
+
+def whole(amount) -> int:
+    """Prices and bids are whole currency units, stored as integers."""
+    amount = round(amount)
+    if not -MAX_AMOUNT <= amount <= MAX_AMOUNT:
+        raise ValueError(f"Amount out of range: {amount}")
+    return amount
+
+
+class Market:
+    """Hub state and auction rules, independent of how messages travel.
+
+    Every input is applied through ``apply`` with the time it happened at and
+    returns the notifications the hub has to send, so the same sequence of
+    inputs always rebuilds the same state. Offers and requests live in
+    ``store``, a ``ColumnStore`` unless another store is given. They leave it
+    when their auction completes or when their TTL runs out, which their owner
+    is told of; the store keeps their expiry times ordered and the market
+    sweeps them at the earliest one.
+
+    With ``clearing`` on, auctions that end wait for a batch clearing that
+    assigns each tenant at most one of them (``clear_auctions``), and only
+    fall back to asking by rank if none comes within ``confirmation_time``.
+    """
+
+    def __init__(
+        self,
+        auction_time=timedelta(seconds=20),
+        extend_duration=timedelta(seconds=5),
+        confirmation_time=timedelta(seconds=20),
+        store=None,
+        offer_ttl: Optional[timedelta] = timedelta(days=1),
+        request_ttl: Optional[timedelta] = timedelta(days=1),
+        confirmation_fanout: int = 1,
+        offer_id_start: int = 0,
+        offer_id_step: int = 1,
+        clearing: bool = False,
+    ):
+        self.auction_time = auction_time
+        self.extend_duration = extend_duration
+        self.confirmation_time = confirmation_time
+        self.confirmation_fanout = max(confirmation_fanout, 1)
+        self.clearing = clearing
+        self.offer_ttl = offer_ttl
+        self.request_ttl = request_ttl
+        self.store = store or ColumnStore()
+        self.active_auctions: Dict[str, Auction] = {}  # offer_id -> Auction
+        self.demand = DemandGrid()
+        self.deadlines = DeadlineScheduler()  # offer_id -> next auction deadline
+        # Sharded hubs issue interleaved offer ids: start, start + step, ...
+        self.offer_id_step = offer_id_step
+        next_offer_id, self.next_request_id = self.store.next_ids()
+        self.next_offer_id = next_offer_id + (offer_id_start - next_offer_id) % offer_id_step
+        self._schedule_expiry(self.store.next_expiry())
+
+    @property
+    def rental_offers(self):
+        return self.store.offers
+
+    @property
+    def rental_requests(self):
+        return self.store.requests
+
+    def apply(
+        self,
+        kind: str,
+        data: dict,
+        now: datetime,
+        matches: Optional[PrecomputedMatches] = None,
+    ) -> List[Notification]:
+        match kind:
+            case "register-rental":
+                return self.register_request(
+                    RentalRequest(
+                        min_price=whole(data["min_price"]),
+                        max_price=whole(data["max_price"]),
+                        location=tuple(data["location"]),
+                        agent_jid=data["sender"],
+                        service_type=data.get("service_type"),
+                    ),
+                    now,
+                )
+            case "rental-offer":
+                return self.register_offer(
+                    RentalOffer(
+                        starting_price=whole(data["starting_price"]),
+                        location=tuple(data["location"]),
+                        agent_jid=data["sender"],
+                    ),
+                    now,
+                )
+            case "rental-offers":
+                return self.register_offers(
+                    [
+                        RentalOffer(
+                            starting_price=whole(offer["starting_price"]),
+                            location=tuple(offer["location"]),
+                            agent_jid=data["sender"],
+                        )
+                        for offer in data["offers"]
+                    ],
+                    now,
+                    matches,
+                )
+            case "bid":
+                return self.place_bid(
+                    data["offer_id"], data["sender"], whole(data["amount"]), now
+                )
+            case "proxy-bid":
+                return self.register_proxy(
+                    data["offer_id"],
+                    data["sender"],
+                    whole(data["max_amount"]),
+                    whole(data.get("increment", 1)),
+                    now,
+                )
+            case "confirmation-response":
+                return self.confirm(
+                    data["offer_id"], data["sender"], data["confirmed"], now
+                )
+            case "ServiceDemandRequest":
+                self.demand.add_vote(data["service_type"], data["localization"])
+                return []
+            case "clear-auctions":
+                return self.clear_auctions(data["offer_ids"], data["assignment"], now)
+            case "advance":
+                return self.advance(now)
+        raise ValueError(f"Unknown market input: {kind}")
+
+    def _schedule_expiry(self, expires_at: Optional[datetime]):
+        if expires_at is not None:
+            self.deadlines.schedule(EXPIRY_SWEEP, expires_at)
+
+    def add_offer(self, offer: RentalOffer, now: datetime) -> str:
+        offer_id = str(self.next_offer_id)
+        self.next_offer_id += self.offer_id_step
+        expires_at = now + self.offer_ttl if self.offer_ttl else None
+        self.store.add_offer(offer_id, offer, expires_at)
+        self._schedule_expiry(expires_at)
+        return offer_id
+
+    def remove_offer(self, offer_id: str):
+        self.store.remove_offer(offer_id)
+
+    def add_request(self, request: RentalRequest, now: datetime) -> int:
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        expires_at = now + self.request_ttl if self.request_ttl else None
+        self.store.add_request(request_id, request, expires_at)
+        self._schedule_expiry(expires_at)
+        return request_id
+
+    def remove_request(self, request_id: int):
+        self.store.remove_request(request_id)
+
+    def matching_offers(self, request: RentalRequest):
+        return list(
+            self.store.offers_in_price_range(
+                request.location, request.min_price, request.max_price
+            )
+        )
+
+    def matching_requests(self, offer: RentalOffer):
+        return list(
+            self.store.requests_covering_price(offer.location, offer.starting_price)
+        )
+
+    def expire(self, now: datetime) -> List[Notification]:
+        """Removes the listings whose TTL ran out and tells their owners."""
+        # Offers in a running auction leave the store too; the auction keeps
+        # its own reference to the offer and finishes normally.
+        notifications = []
+        for kind, key in self.store.pop_expired(now):
+            if kind == "offer":
+                offer = self.store.offers.get(key)
+                self.remove_offer(key)
+                if offer is not None:
+                    notifications.append(
+                        Notification(
+                            [offer.agent_jid],
+                            "offer-expired",
+                            {
+                                "offer_id": key,
+                                "starting_price": offer.starting_price,
+                                "location": offer.location,
+                            },
+                        )
+                    )
+            else:
+                request = self.store.requests.get(key)
+                self.remove_request(key)
+                if request is not None:
+                    notifications.append(
+                        Notification(
+                            [request.agent_jid],
+                            "request-expired",
+                            {
+                                "min_price": request.min_price,
+                                "max_price": request.max_price,
+                                "location": request.location,
+                            },
+                        )
+                    )
+        self._schedule_expiry(self.store.next_expiry())
+        return notifications
+
+    def start_auction(self, offer_id: str, offer: RentalOffer, now: datetime) -> Auction:
+        auction = Auction(
+            offer=offer,
+            end_time=now + self.auction_time,
+            status="bidding",
+        )
+        self.active_auctions[offer_id] = auction
+        self.deadlines.schedule(offer_id, auction.end_time)
+        return auction
+
+    def close_auction(self, offer_id: str, now: datetime, winner: Optional[Bid] = None):
+        auction = self.active_auctions.pop(offer_id, None)
+        if auction is not None:
+            auction.status = "completed"
+            self.store.archive_auction(offer_id, auction, winner, now)
+        self.deadlines.cancel(offer_id)
+
+    def _open_auction(
+        self, offer_id: str, offer: RentalOffer, requests, now
+    ) -> Notification:
+        auction = self.start_auction(offer_id, offer, now)
+        # Bids are placed in request order, whichever way the requests were found
+        requests = sorted(requests, key=lambda pair: pair[0])
+        for request_id, request in requests:
+            auction.bids.place(
+                Bid(
+                    request=request,
+                    bidder_jid=request.agent_jid,
+                    amount=offer.starting_price,
+                    timestamp=now,
+                    request_id=request_id,
+                )
+            )
+        return Notification(
+            [request.agent_jid for _, request in requests],
+            "auction-start",
+            {
+                "offer_id": offer_id,
+                "starting_price": offer.starting_price,
+                "location": offer.location,
+                "end_time": auction.end_time.isoformat(),
+            },
+        )
+
+    def register_request(self, request: RentalRequest, now: datetime) -> List[Notification]:
+        notifications = []
+        request_id = self.add_request(request, now)
+
+        for offer_id, offer in self.matching_offers(request):
+            auction = self.active_auctions.get(offer_id)
+            if auction is None:
+                # Start a new auction for an offer that doesn't have one yet
+                notifications.append(
+                    self._open_auction(
+                        offer_id, offer, self.matching_requests(offer), now
+                    )
+                )
+                continue
+
+            # Join the offer's active auction
+            auction.bids.place(
+                Bid(
+                    request=request,
+                    bidder_jid=request.agent_jid,
+                    amount=offer.starting_price,
+                    timestamp=now,
+                    request_id=request_id,
+                )
+            )
+            notifications.append(
+                Notification(
+                    [request.agent_jid],
+                    "auction-start",
+                    {
+                        "offer_id": offer_id,
+                        "starting_price": offer.starting_price,
+                        "location": offer.location,
+                        "current_highest_bid": auction.bids.highest().amount,
+                        "end_time": auction.end_time.isoformat(),
+                    },
+                )
+            )
+        return notifications
+
+    def register_offer(self, offer: RentalOffer, now: datetime) -> List[Notification]:
+        return self.register_offers([offer], now)
+
+    def register_offers(
+        self,
+        offers: List[RentalOffer],
+        now: datetime,
+        matches: Optional[PrecomputedMatches] = None,
+    ) -> List[Notification]:
+        """Adds offers in bulk, matching all of them against the requests at once.
+
+        ``matches`` found by the hub's matching workers replace the matching
+        done here; they give the same auctions as matching from scratch.
+        """
+        if matches is None:
+            found = self.store.requests_covering_prices(offers)
+        else:
+            found = self._reconcile(offers, matches)
+        offer_ids = [self.add_offer(offer, now) for offer in offers]
+        return [
+            self._open_auction(offer_id, offer, matching_requests, now)
+            for offer_id, offer, matching_requests in zip(offer_ids, offers, found)
+            if matching_requests
+        ]
+
+    def _reconcile(
+        self, offers: List[RentalOffer], matches: PrecomputedMatches
+    ) -> List[List[tuple]]:
+        # A request's location and prices never change, so a candidate still
+        # matches as long as it stands; only the requests registered since
+        # the candidates were found need matching here.
+        recent = ColumnStore()
+        registered = range(matches.next_request_id, self.next_request_id)
+        for request_id, request in self.store.requests_by_id(registered).items():
+            recent.add_request(request_id, request)
+        found = recent.requests_covering_prices(offers)
+        # Looked up in one pass, the candidates of a chunk share most requests
+        standing = self.store.requests_by_id(
+            {request_id for candidates in matches.candidates for request_id in candidates}
+        )
+        for offer_matches, candidates in zip(found, matches.candidates):
+            offer_matches.extend(
+                (request_id, standing[request_id])
+                for request_id in candidates
+                if request_id in standing
+            )
+        return found
+
+    def place_bid(
+        self, offer_id: str, bidder_jid: str, amount, now: datetime
+    ) -> List[Notification]:
+        auction = self.active_auctions.get(offer_id)
+        if not auction or auction.status != "bidding":
+            return []
+
+        current_bid = auction.bids.get(bidder_jid)
+        if not current_bid or amount <= current_bid.amount:
+            return []
+
+        highest_before = auction.bids.highest().amount
+        auction.bids.place(
+            Bid(
+                request=current_bid.request,
+                bidder_jid=bidder_jid,
+                amount=amount,
+                timestamp=now,
+                request_id=current_bid.request_id,
+            )
+        )
+        if auction.proxies:
+            return self._resolve_proxies(offer_id, auction, highest_before, now)
+        auction.extend_duration(self.extend_duration, now)
+
+        return [
+            Notification(
+                auction.get_outbid_agents(amount),
+                "outbid-notification",
+                {"offer_id": offer_id, "current_highest_bid": amount},
+            )
+        ]
+
+    def register_proxy(
+        self, offer_id: str, bidder_jid: str, max_amount, increment, now: datetime
+    ) -> List[Notification]:
+        """Lets the hub bid for ``bidder_jid`` up to ``max_amount`` in steps of ``increment``."""
+        auction = self.active_auctions.get(offer_id)
+        if not auction or auction.status != "bidding" or bidder_jid not in auction.bids:
+            return []
+
+        highest = auction.bids.highest().amount
+        auction.proxies[bidder_jid] = ProxyBid(max_amount, max(increment, 1), now)
+        return self._resolve_proxies(offer_id, auction, highest, now)
+
+    def _resolve_proxies(
+        self, offer_id: str, auction: Auction, highest_before, now: datetime
+    ) -> List[Notification]:
+        """Settles the proxy bidding war at once instead of bid by bid.
+
+        Every bidder's ceiling is their proxy maximum, or their bid without a
+        proxy. Losing proxies bid their whole maximum and the leading proxy
+        bids one increment above the runner-up, capped at its own maximum.
+        Equal ceilings go to whoever committed to them first.
+        """
+
+        def ceiling(bid):
+            proxy = auction.proxies.get(bid.bidder_jid)
+            if proxy is None or proxy.max_amount < bid.amount:
+                return bid.amount, bid.timestamp
+            return proxy.max_amount, proxy.registered_at
+
+        standings = sorted(auction.bids, key=lambda bid: (-ceiling(bid)[0], ceiling(bid)[1]))
+        leader, runners_up = standings[0], standings[1:]
+
+        targets = {}
+        for bid in runners_up:
+            if bid.bidder_jid in auction.proxies:
+                targets[bid.bidder_jid] = ceiling(bid)
+        leader_proxy = auction.proxies.get(leader.bidder_jid)
+        if leader_proxy is not None and runners_up:
+            leader_ceiling, committed_at = ceiling(leader)
+            runner_up = ceiling(runners_up[0])[0]
+            targets[leader.bidder_jid] = (
+                min(leader_ceiling, runner_up + leader_proxy.increment),
+                committed_at,
+            )
+
+        for bidder_jid, (amount, committed_at) in targets.items():
+            bid = auction.bids.get(bidder_jid)
+            if amount > bid.amount or (amount == bid.amount and committed_at < bid.timestamp):
+                auction.bids.place(
+                    Bid(
+                        request=bid.request,
+                        bidder_jid=bidder_jid,
+                        amount=amount,
+                        timestamp=committed_at,
+                        request_id=bid.request_id,
+                    )
+                )
+
+        highest = auction.bids.highest().amount
+        if highest == highest_before:
+            return []
+        auction.extend_duration(self.extend_duration, now)
+        return [
+            Notification(
+                auction.get_outbid_agents(highest),
+                "outbid-notification",
+                {"offer_id": offer_id, "current_highest_bid": highest},
+            )
+        ]
+
+    def _request_confirmations(
+        self, offer_id: str, auction: Auction, now
+    ) -> List[Notification]:
+        """Asks the next ``confirmation_fanout`` ranked bidders to confirm at once."""
+        ranked = self._confirmation_ranking(auction)[
+            auction.next_rank : auction.next_rank + self.confirmation_fanout
+        ]
+        if not ranked:
+            # No more bidders, close auction
+            self.close_auction(offer_id, now)
+            return []
+
+        notifications = []
+        auction.confirming = {}
+        for bid in ranked:
+            amount = bid.amount
+            if auction.next_rank == 0 and not notifications:
+                # The top bid is adjusted by the local demand for its service
+                amount = self._demand_adjusted(bid)
+            auction.confirming[bid.bidder_jid] = None
+            notifications.append(
+                Notification(
+                    [bid.bidder_jid],
+                    "confirmation-request",
+                    {"offer_id": offer_id, "bid_amount": amount},
+                )
+            )
+        auction.next_rank += len(ranked)
+        auction.confirmation_deadline = now + self.confirmation_time
+        self.deadlines.schedule(offer_id, auction.confirmation_deadline)
+        return notifications
+
+    def _demand_adjusted(self, bid: Bid) -> float:
+        return bid.amount * sigmoid(
+            self.demand.votes(bid.request.location, bid.request.service_type)
+        )
+
+    @staticmethod
+    def _confirmation_ranking(auction: Auction) -> List[Bid]:
+        if auction.confirmation_order is None:
+            return auction.get_winning_bids()
+        return [auction.bids.get(bidder_jid) for bidder_jid in auction.confirmation_order]
+
+    def _settle_confirmations(
+        self, offer_id: str, auction: Auction, now
+    ) -> List[Notification]:
+        """Completes the auction with the highest-ranked acceptance once it is certain.
+
+        A positive answer wins only when every bidder ranked above it in the
+        round has declined or timed out. If the whole round declines, the
+        next bidders are asked.
+        """
+        for bidder_jid, answer in auction.confirming.items():
+            if answer is None:
+                return []
+            if answer:
+                return self._complete(offer_id, auction, auction.bids.get(bidder_jid), now)
+        return self._request_confirmations(offer_id, auction, now)
+
+    def has_due(self, now: datetime) -> bool:
+        deadline = self.deadlines.next_deadline()
+        return deadline is not None and deadline <= now
+
+    def advance(self, now: datetime) -> List[Notification]:
+        notifications = []
+        for offer_id in self.deadlines.pop_due(now):
+            if offer_id == EXPIRY_SWEEP:
+                notifications.extend(self.expire(now))
+                continue
+
+            auction = self.active_auctions.get(offer_id)
+            if not auction:
+                continue
+
+            deadline = auction.deadline()
+            if deadline and deadline > now:
+                # Auction was extended after its deadline was scheduled
+                self.deadlines.schedule(offer_id, deadline)
+                continue
+
+            if auction.status == "bidding":
+                notifications.append(
+                    Notification(
+                        [bid.bidder_jid for bid in auction.bids],
+                        "auction-stop",
+                        {"offer_id": offer_id},
+                    )
+                )
+                if self.clearing:
+                    auction.status = "clearing"
+                    auction.confirmation_deadline = now + self.confirmation_time
+                    self.deadlines.schedule(offer_id, auction.confirmation_deadline)
+                    continue
+
+                # Transition to confirmation phase
+                auction.status = "confirming"
+                notifications.extend(self._request_confirmations(offer_id, auction, now))
+
+            elif auction.status == "clearing":
+                # No batch clearing came in time
+                auction.status = "confirming"
+                notifications.extend(self._request_confirmations(offer_id, auction, now))
+
+            elif auction.status == "confirming":
+                # Bidders who haven't answered in time count as declined
+                for bidder_jid, answer in auction.confirming.items():
+                    if answer is None:
+                        auction.confirming[bidder_jid] = False
+                notifications.extend(self._settle_confirmations(offer_id, auction, now))
+        return notifications
+
+    def clearing_problem(self) -> Optional[ClearingProblem]:
+        """Bids of the auctions waiting for the batch clearing, if there are any.
+
+        A bid is worth its demand-adjusted amount, the price its tenant is
+        asked to confirm when ranked first.
+        """
+        problem = ClearingProblem()
+        bidders: Dict[str, int] = {}
+        for offer_id, auction in self.active_auctions.items():
+            if auction.status != "clearing":
+                continue
+            for bid in auction.bids:
+                problem.bidder_index.append(bidders.setdefault(bid.bidder_jid, len(bidders)))
+                problem.offer_index.append(len(problem.offer_ids))
+                problem.values.append(self._demand_adjusted(bid))
+            problem.offer_ids.append(offer_id)
+        problem.bidders = list(bidders)
+        return problem if problem.offer_ids else None
+
+    def clear_auctions(
+        self, offer_ids: List[str], assignment: Dict[str, str], now: datetime
+    ) -> List[Notification]:
+        """Starts the confirmations of the cleared auctions.
+
+        ``assignment`` maps offer ids to the tenant each one should go to.
+        That tenant is asked first; tenants assigned to another offer are
+        only asked once every other bidder has declined.
+        """
+        assigned = set(assignment.values())
+        notifications = []
+        for offer_id in offer_ids:
+            auction = self.active_auctions.get(offer_id)
+            if not auction or auction.status != "clearing":
+                # Confirmed by rank in the meantime
+                continue
+            tenant = assignment.get(offer_id)
+            ranking = [bid.bidder_jid for bid in auction.get_winning_bids()]
+            auction.confirmation_order = (
+                [bidder_jid for bidder_jid in ranking if bidder_jid == tenant]
+                + [bidder_jid for bidder_jid in ranking if bidder_jid not in assigned]
+                + [
+                    bidder_jid
+                    for bidder_jid in ranking
+                    if bidder_jid in assigned and bidder_jid != tenant
+                ]
+            )
+            auction.status = "confirming"
+            notifications.extend(self._request_confirmations(offer_id, auction, now))
+        return notifications
+
+    def confirm(
+        self, offer_id: str, bidder_jid: str, confirmed: bool, now: datetime
+    ) -> List[Notification]:
+        auction = self.active_auctions.get(offer_id)
+        if not auction or auction.status != "confirming":
+            return []
+        if auction.confirming.get(bidder_jid, False) is not None:
+            # Not asked in this round, or already answered
+            return []
+
+        auction.confirming[bidder_jid] = bool(confirmed)
+        return self._settle_confirmations(offer_id, auction, now)
+
+    def _complete(
+        self, offer_id: str, auction: Auction, winner_bid: Bid, now
+    ) -> List[Notification]:
+        notifications = []
+        bidder_jid = winner_bid.bidder_jid
+        winning_bids = self._confirmation_ranking(auction)
+        current_index = [bid.bidder_jid for bid in winning_bids].index(bidder_jid)
+
+        if current_index + 1 < len(winning_bids):
+            notifications.append(
+                Notification(
+                    [bid.bidder_jid for bid in winning_bids[current_index + 1 :]],
+                    "auction-lost",
+                    {"offer_id": offer_id},
+                )
+            )
+
+        # Notify seller
+        notifications.append(
+            Notification(
+                [auction.offer.agent_jid],
+                "auction-completed",
+                {"offer_id": offer_id, "final_price": winner_bid.amount},
+            )
+        )
+
+        # The offer is let and the winning request is satisfied
+        self.close_auction(offer_id, now, winner_bid)
+        self.remove_offer(offer_id)
+        if winner_bid.request_id is not None:
+            self.remove_request(winner_bid.request_id)
+        return notifications
+
+    def snapshot(self, tag=None) -> dict:
+        return {
+            "next_offer_id": self.next_offer_id,
+            "next_request_id": self.next_request_id,
+            "store": self.store.snapshot(tag),
+            "active_auctions": self.active_auctions,
+            "demand": self.demand.cells,
+        }
+
+    def restore(self, state: dict):
+        # First, so a store refusing the snapshot leaves the market untouched
+        self.store.restore(state["store"])
+        self.next_offer_id = state["next_offer_id"]
+        self.next_request_id = state["next_request_id"]
+        for offer_id, auction in state["active_auctions"].items():
+            self.active_auctions[offer_id] = auction
+            self.deadlines.schedule(offer_id, auction.deadline())
+        self._schedule_expiry(self.store.next_expiry())
+        self.demand.cells = state["demand"]
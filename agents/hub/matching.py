@@ -0,0 +1,47 @@
+import numpy as np
+
+from agents.hub.spatial_index import CLOSE_DISTANCE
+
+
+# Below this many comparisons a plain Python loop is faster than building
+# array views, so column blocks only go through NumPy above it.
+VECTOR_MIN_SIZE = 32
+
+
+def column(values) -> np.ndarray:
+    """Zero-copy NumPy view of an ``array.array`` column.
+
+    The view locks the array against resizing, so it must not outlive the
+    function that creates it.
+    """
+    return np.frombuffer(values, dtype=np.float64 if values.typecode == "d" else np.int64)
+
+
+def close_mask(block, lats, lons, rows=slice(None)) -> np.ndarray:
+    return (np.abs(column(block.lat)[rows] - lats) < CLOSE_DISTANCE) & (
+        np.abs(column(block.lon)[rows] - lons) < CLOSE_DISTANCE
+    )
+
+
+def covering_mask(block, lats, lons, prices, start=0, stop=None) -> np.ndarray:
+    """``(offers, rows)`` mask of the block's requests ``start`` to ``stop`` that match each offer."""
+    rows = slice(start, stop)
+    lats = np.asarray(lats, dtype=np.float64)[:, None]
+    lons = np.asarray(lons, dtype=np.float64)[:, None]
+    prices = np.asarray(prices, dtype=np.int64)[:, None]
+    return (
+        close_mask(block, lats, lons, rows)
+        & (column(block.min_price)[rows] <= prices)
+        & (column(block.max_price)[rows] >= prices)
+    )
+
+
+def covering_rows(block, location, price, start=0, stop=None) -> list:
+    mask = covering_mask(block, [location[0]], [location[1]], [price], start, stop)[0]
+    return (np.flatnonzero(mask) + start).tolist()
+
+
+def close_rows(block, location, start, stop) -> list:
+    """Rows ``start`` to ``stop`` of the block that are close to ``location``."""
+    mask = close_mask(block, location[0], location[1], slice(start, stop))
+    return (np.flatnonzero(mask) + start).tolist()
@@ -0,0 +1,105 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from agents.hub.bid_book import BidBook
+
+
+@dataclass(slots=True)
+class RentalOffer:
+    agent_jid: str
+    starting_price: int
+    location: tuple[float, float]
+
+
+@dataclass(slots=True)
+class RentalRequest:
+    min_price: int
+    max_price: int
+    location: tuple[float, float]
+    agent_jid: str
+    service_type: Optional[str] = None
+
+
+@dataclass(slots=True)
+class Bid:
+    request: RentalRequest
+    bidder_jid: str
+    amount: int
+    timestamp: datetime
+    request_id: Optional[int] = None
+
+
+@dataclass(slots=True)
+class ProxyBid:
+    max_amount: int
+    increment: int
+    registered_at: datetime
+
+
+@dataclass(slots=True)
+class Auction:
+    offer: RentalOffer
+    end_time: datetime
+    status: str  # 'bidding', 'clearing', 'confirming', 'completed'
+    bids: BidBook = field(default_factory=BidBook)
+    # Bidders asked to confirm in the current round, in rank order, with
+    # their answer or None while it is pending
+    confirming: Dict[str, Optional[bool]] = field(default_factory=dict)
+    next_rank: int = 0  # rank of the first bidder not asked yet
+    confirmation_deadline: Optional[datetime] = None
+    proxies: Dict[str, ProxyBid] = field(default_factory=dict)  # bidder_jid -> ProxyBid
+    # Order the batch clearing asks the bidders in, instead of their ranking
+    confirmation_order: Optional[List[str]] = None
+
+    def deadline(self) -> Optional[datetime]:
+        if self.status == "bidding":
+            return self.end_time
+        if self.status in ("clearing", "confirming"):
+            return self.confirmation_deadline
+        return None
+
+    def extend_duration(self, duration: timedelta, now: Optional[datetime] = None):
+        new_end_time = (now or datetime.now()) + duration
+        if new_end_time > self.end_time:
+            self.end_time = new_end_time
+
+    def get_outbid_agents(self, amount: int) -> List[str]:
+        return [bid.bidder_jid for bid in self.bids.below(amount)]
+
+    def get_winning_bids(self) -> BidBook:
+        return self.bids
+
+
+@dataclass(slots=True)
+class Notification:
+    recipients: List[str]
+    conversation_id: str
+    payload: dict
+
+
+@dataclass(slots=True)
+class PrecomputedMatches:
+    """Request ids matching each offer of a batch, found outside the market.
+
+    ``candidates`` were matched against the requests registered before
+    ``next_request_id``; some of them may have been removed since.
+    """
+
+    candidates: List[List[int]]
+    next_request_id: int
+
+
+@dataclass(slots=True)
+class ClearingProblem:
+    """Bids of the auctions waiting for the batch clearing, as a sparse matrix.
+
+    Edge ``i`` is a bid of ``bidders[bidder_index[i]]`` for
+    ``offer_ids[offer_index[i]]`` worth ``values[i]`` to the landlord.
+    """
+
+    offer_ids: List[str] = field(default_factory=list)
+    bidders: List[str] = field(default_factory=list)
+    bidder_index: List[int] = field(default_factory=list)
+    offer_index: List[int] = field(default_factory=list)
+    values: List[float] = field(default_factory=list)
@@ -0,0 +1,240 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, replace
+from typing import Dict, Iterable, List, Optional, Set
+
+import aioxmpp
+from spade.message import Message
+
+from agents.common import codec, gateway, pubsub
+from database.system_data import DEFAULT_METADATA
+
+
+@dataclass
+class BatchReport:
+    conversation_id: str
+    recipients: int
+    failed: int
+    latency: float  # seconds
+
+
+class Outbox:
+    """Sends one payload to many recipients concurrently.
+
+    The body is serialized once per batch and language, recipients getting
+    it in the language they last wrote in (``languages``, JSON otherwise).
+    Recipients in ``identities`` are a gateway's identities and are sent to
+    through their gateway. The number of sends in flight across all batches
+    is bounded by ``max_concurrency``.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 64,
+        history: int = 1000,
+        languages: Optional[Dict[str, str]] = None,
+        identities: Optional[Set[str]] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.reports = deque(maxlen=history)
+        self.languages = languages if languages is not None else {}
+        self.identities = identities if identities is not None else set()
+
+    async def _send(self, behaviour, to: str, metadata: dict, body: str):
+        metadata = dict(metadata)
+        if to in self.identities:
+            to, metadata[gateway.IDENTITY] = gateway.route(to)
+        async with self.semaphore:
+            await behaviour.send(Message(to=to, metadata=metadata, body=body))
+
+    async def broadcast(
+        self, behaviour, recipients: Iterable[str], conversation_id: str, payload
+    ) -> BatchReport:
+        recipients = list(recipients)
+        by_language: Dict[str, List[str]] = {}
+        for to in recipients:
+            by_language.setdefault(self.languages.get(to, codec.JSON), []).append(to)
+
+        sends = []
+        for language, group in by_language.items():
+            metadata = {"conversation-id": conversation_id, **DEFAULT_METADATA, "language": language}
+            body = codec.encode(conversation_id, payload, language)
+            sends.extend(self._send(behaviour, to, metadata, body) for to in group)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        report = BatchReport(
+            conversation_id=conversation_id,
+            recipients=len(recipients),
+            failed=sum(isinstance(result, Exception) for result in results),
+            latency=time.perf_counter() - started,
+        )
+        self.reports.append(report)
+        print(
+            f"Sent {conversation_id} to {report.recipients - report.failed}"
+            f"/{report.recipients} recipients in {report.latency * 1000:.1f} ms"
+        )
+        return report
+
+    async def send(self, behaviour, to: str, conversation_id: str, payload):
+        return await self.broadcast(behaviour, [to], conversation_id, payload)
+
+    async def notify(self, behaviour, notification) -> BatchReport:
+        return await self.broadcast(
+            behaviour,
+            notification.recipients,
+            notification.conversation_id,
+            notification.payload,
+        )
+
+    async def deliver(self, behaviour, notifications) -> List[BatchReport]:
+        """Sends notifications in order, each one as a concurrent batch."""
+        return [
+            await self.notify(behaviour, notification)
+            for notification in notifications
+            if notification.recipients
+        ]
+
+
+def node_config() -> aioxmpp.forms.Data:
+    """Auction nodes: only the subscribed bidders read them, nothing is kept."""
+    form = aioxmpp.forms.Data(aioxmpp.forms.DataType.SUBMIT)
+    form.fields.append(
+        aioxmpp.forms.Field(
+            type_=aioxmpp.forms.FieldType.HIDDEN,
+            var="FORM_TYPE",
+            values=["http://jabber.org/protocol/pubsub#node_config"],
+        )
+    )
+    for var, value in (
+        ("pubsub#access_model", "whitelist"),
+        ("pubsub#publish_model", "publishers"),
+        ("pubsub#deliver_payloads", "1"),
+        ("pubsub#persist_items", "0"),
+        ("pubsub#send_last_published_item", "never"),
+        ("pubsub#presence_based_delivery", "0"),
+    ):
+        form.fields.append(aioxmpp.forms.Field(var=var, values=[value]))
+    return form
+
+
+class PubSubOutbox(Outbox):
+    """Publishes the broadcasts of large auctions to a pubsub node per auction.
+
+    An auction opening with at least ``min_subscribers`` bidders gets a node
+    on ``service`` that its bidders are subscribed to, and its auction-start,
+    outbid notifications and auction-stop are published there once instead
+    of sent to every bidder; the server fans them out. Tenants joining later
+    are subscribed and get their own auction-start directly. Every bidder
+    receives the outbid notifications and tells from ``current_highest_bid``
+    whether it was outbid. The node is deleted after the auction stops.
+    Smaller auctions, any whose node could not be set up and gateway
+    identities, which have no session to subscribe, get direct messages.
+    ``attach`` must be called once the hub is connected.
+    """
+
+    TOPICS = ("auction-start", "outbid-notification", "auction-stop")
+
+    def __init__(self, service: str = pubsub.SERVICE, min_subscribers: int = 8, **kwargs):
+        super().__init__(**kwargs)
+        self.service = aioxmpp.JID.fromstr(service)
+        self.min_subscribers = min_subscribers
+        self.client = None  # aioxmpp PubSubClient
+        self.nodes: Dict[str, asyncio.Task] = {}  # offer_id -> node set-up, True once ready
+
+    def attach(self, client: aioxmpp.Client):
+        self.client = client.summon(aioxmpp.PubSubClient)
+
+    async def notify(self, behaviour, notification) -> BatchReport:
+        if self.client is None or notification.conversation_id not in self.TOPICS:
+            return await super().notify(behaviour, notification)
+        direct = [jid for jid in notification.recipients if jid in self.identities]
+        if direct:
+            report = await super().notify(behaviour, replace(notification, recipients=direct))
+            notification = replace(
+                notification,
+                recipients=[jid for jid in notification.recipients if jid not in self.identities],
+            )
+            if not notification.recipients:
+                return report
+        report = await self.publish(notification)
+        if report is None:
+            report = await super().notify(behaviour, notification)
+        return report
+
+    async def publish(self, notification) -> Optional[BatchReport]:
+        """Publishes ``notification`` to its auction's node, or None to send it directly."""
+        offer_id = notification.payload["offer_id"]
+        conversation_id = notification.conversation_id
+        if conversation_id == "auction-start" and "current_highest_bid" not in notification.payload:
+            if len(notification.recipients) < self.min_subscribers:
+                return None
+            self.nodes[offer_id] = asyncio.ensure_future(
+                self._open(offer_id, notification.recipients)
+            )
+        elif conversation_id == "auction-start":
+            # A tenant joining the auction
+            node = self.nodes.get(offer_id)
+            if node is not None and await node:
+                await self._try(self._subscribe(offer_id, notification.recipients))
+            return None
+
+        if conversation_id == "auction-stop":
+            node = self.nodes.pop(offer_id, None)
+        else:
+            node = self.nodes.get(offer_id)
+        if node is None or not await node:
+            return None
+        started = time.perf_counter()
+        event = pubsub.AuctionEvent(
+            conversation_id, codec.encode(conversation_id, notification.payload)
+        )
+        if not await self._try(
+            self.client.publish(self.service, pubsub.auction_node(offer_id), event)
+        ):
+            return None
+        report = BatchReport(
+            conversation_id=conversation_id,
+            recipients=len(notification.recipients),
+            failed=0,
+            latency=time.perf_counter() - started,
+        )
+        self.reports.append(report)
+        print(
+            f"Published {conversation_id} for {report.recipients} recipients "
+            f"in {report.latency * 1000:.1f} ms"
+        )
+        if conversation_id == "auction-stop":
+            await self._try(self.client.delete(self.service, pubsub.auction_node(offer_id)))
+        return report
+
+    async def _open(self, offer_id: str, recipients: List[str]) -> bool:
+        node = pubsub.auction_node(offer_id)
+
+        async def set_up():
+            await self.client.create(self.service, node)
+            await self.client.set_node_config(self.service, node_config(), node)
+            await self._subscribe(offer_id, recipients)
+
+        return await self._try(set_up())
+
+    async def _subscribe(self, offer_id: str, recipients: List[str]):
+        node = pubsub.auction_node(offer_id)
+        jids = [aioxmpp.JID.fromstr(jid) for jid in recipients]
+        await self.client.change_node_affiliations(
+            self.service, node, [(jid, "member") for jid in jids]
+        )
+        await self.client.change_node_subscriptions(
+            self.service, node, [(jid, "subscribed") for jid in jids]
+        )
+
+    @staticmethod
+    async def _try(request) -> bool:
+        try:
+            await request
+        except Exception as error:
+            print(f"PubSub request failed: {error!r}")
+            return False
+        return True
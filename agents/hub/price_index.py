@@ -0,0 +1,169 @@
+import bisect
+import random
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+
+class SortedPriceIndex:
+    """Items kept sorted by a single price for range lookups."""
+
+    def __init__(self, price_of: Callable[[Any], float]):
+        self.price_of = price_of
+        self.entries: List[Tuple[float, Hashable]] = []
+        self.by_key: Dict[Hashable, Any] = {}
+
+    def __len__(self):
+        return len(self.by_key)
+
+    def __contains__(self, key):
+        return key in self.by_key
+
+    def items(self):
+        return self.by_key.items()
+
+    def add(self, key: Hashable, item):
+        if key in self.by_key:
+            self.discard(key)
+        self.by_key[key] = item
+        bisect.insort(self.entries, (self.price_of(item), key))
+
+    def discard(self, key: Hashable):
+        item = self.by_key.pop(key, None)
+        if item is None:
+            return
+        entry = (self.price_of(item), key)
+        i = bisect.bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            del self.entries[i]
+
+    def between(self, low, high) -> Iterator[Tuple[Hashable, Any]]:
+        entries = self.entries
+        for i in range(bisect.bisect_left(entries, (low,)), len(entries)):
+            price, key = entries[i]
+            if price > high:
+                break
+            yield key, self.by_key[key]
+
+
+class _Node:
+    __slots__ = ("low", "high", "key", "priority", "max_high", "left", "right")
+
+    def __init__(self, low, high, key):
+        self.low = low
+        self.high = high
+        self.key = key
+        self.priority = random.random()
+        self.max_high = high
+        self.left: Optional[_Node] = None
+        self.right: Optional[_Node] = None
+
+    def order(self):
+        return self.low, self.key
+
+    def update(self):
+        self.max_high = self.high
+        if self.left is not None and self.left.max_high > self.max_high:
+            self.max_high = self.left.max_high
+        if self.right is not None and self.right.max_high > self.max_high:
+            self.max_high = self.right.max_high
+
+
+def _rotate_right(node: _Node) -> _Node:
+    pivot = node.left
+    node.left = pivot.right
+    pivot.right = node
+    node.update()
+    pivot.update()
+    return pivot
+
+
+def _rotate_left(node: _Node) -> _Node:
+    pivot = node.right
+    node.right = pivot.left
+    pivot.left = node
+    node.update()
+    pivot.update()
+    return pivot
+
+
+def _insert(node: Optional[_Node], new: _Node) -> _Node:
+    if node is None:
+        return new
+    if new.order() < node.order():
+        node.left = _insert(node.left, new)
+        if node.left.priority > node.priority:
+            node = _rotate_right(node)
+    else:
+        node.right = _insert(node.right, new)
+        if node.right.priority > node.priority:
+            node = _rotate_left(node)
+    node.update()
+    return node
+
+
+def _delete(node: Optional[_Node], order) -> Optional[_Node]:
+    if node is None:
+        return None
+    if order < node.order():
+        node.left = _delete(node.left, order)
+    elif order > node.order():
+        node.right = _delete(node.right, order)
+    elif node.left is None:
+        return node.right
+    elif node.right is None:
+        return node.left
+    elif node.left.priority > node.right.priority:
+        node = _rotate_right(node)
+        node.right = _delete(node.right, order)
+    else:
+        node = _rotate_left(node)
+        node.left = _delete(node.left, order)
+    node.update()
+    return node
+
+
+class IntervalTree:
+    """Items keyed by a price range, answering which ranges cover a price.
+
+    A treap ordered by the range's low end and augmented with the highest
+    high end of each subtree, so stabbing queries skip whole subtrees.
+    """
+
+    def __init__(self, interval_of: Callable[[Any], Tuple[float, float]]):
+        self.interval_of = interval_of
+        self.root: Optional[_Node] = None
+        self.by_key: Dict[Hashable, Any] = {}
+
+    def __len__(self):
+        return len(self.by_key)
+
+    def __contains__(self, key):
+        return key in self.by_key
+
+    def items(self):
+        return self.by_key.items()
+
+    def add(self, key: Hashable, item):
+        if key in self.by_key:
+            self.discard(key)
+        low, high = self.interval_of(item)
+        self.by_key[key] = item
+        self.root = _insert(self.root, _Node(low, high, key))
+
+    def discard(self, key: Hashable):
+        item = self.by_key.pop(key, None)
+        if item is None:
+            return
+        low, _ = self.interval_of(item)
+        self.root = _delete(self.root, (low, key))
+
+    def covering(self, point) -> Iterator[Tuple[Hashable, Any]]:
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None or node.max_high < point:
+                continue
+            if node.low <= point:
+                if point <= node.high:
+                    yield node.key, self.by_key[node.key]
+                stack.append(node.right)
+            stack.append(node.left)
@@ -0,0 +1,76 @@
+import asyncio
+import heapq
+import itertools
+from datetime import datetime
+from typing import Dict, Hashable, List, Optional, Tuple
+
+
+class DeadlineScheduler:
+    """Min-heap of deadlines with at most one live deadline per key.
+
+    Moving a deadline later is free: the earlier entry stays in the heap and
+    the owner re-schedules the key when it pops and turns out not to be due
+    yet. This is how auction extensions are handled without touching the heap
+    on every bid. Moving a deadline earlier pushes a new entry and wakes up
+    whoever is waiting in ``wait``.
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[datetime, int, Hashable]] = []
+        self.deadlines: Dict[Hashable, datetime] = {}
+        self.wakeup = asyncio.Event()
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key: Hashable, deadline: datetime):
+        current = self.deadlines.get(key)
+        if current is not None and current <= deadline:
+            return
+        next_deadline = self.next_deadline()
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, next(self._seq), key))
+        if next_deadline is None or deadline < next_deadline:
+            self.wakeup.set()
+
+    def cancel(self, key: Hashable):
+        if self.deadlines.pop(key, None) is None:
+            return
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            # Drop cancelled entries so they don't pile up until their deadline
+            self.heap = [entry for entry in self.heap if self._is_live(entry)]
+            heapq.heapify(self.heap)
+
+    def _is_live(self, entry) -> bool:
+        deadline, _, key = entry
+        return self.deadlines.get(key) == deadline
+
+    def next_deadline(self) -> Optional[datetime]:
+        while self.heap and not self._is_live(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: datetime) -> List[Hashable]:
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if self._is_live(entry):
+                del self.deadlines[entry[2]]
+                due.append(entry[2])
+        return due
+
+    async def wait(self):
+        """Sleeps until the earliest deadline or until an earlier one is scheduled."""
+        self.wakeup.clear()
+        deadline = self.next_deadline()
+        timeout = None
+        if deadline is not None:
+            timeout = max((deadline - datetime.now()).total_seconds(), 0)
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
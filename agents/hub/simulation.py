@@ -0,0 +1,339 @@
+import argparse
+import heapq
+import itertools
+import random
+import time
+from array import array
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from database.system_data import SERVICE_OPTIONS
+
+from agents.hub.clearing import solve
+from agents.hub.columns import ColumnStore
+from agents.hub.market import Market, Notification
+from agents.hub.store import MemoryStore
+
+
+@dataclass
+class Population:
+    """Synthetic tenants, landlords and citizens, and how they behave."""
+
+    tenants: int = 10_000
+    offers: int = 2_000
+    votes: int = 0
+    duration: timedelta = timedelta(hours=1)  # arrivals are spread over it
+    origin: tuple = (52.1, 20.85)
+    extent: float = 0.4  # side of the square the locations fall in, in degrees
+    bid_probability: float = 0.3  # of bidding above the starting price
+    raise_probability: float = 0.1  # of raising when outbid
+    raise_step: int = 10
+    confirm_probability: float = 0.8
+    reaction_time: timedelta = timedelta(seconds=2)  # mean delay of an agent's answer
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+@dataclass
+class InputStats:
+    count: int = 0
+    latencies: array = field(default_factory=lambda: array("d"))  # wall-clock seconds
+
+
+@dataclass
+class SimulationReport:
+    virtual_time: timedelta
+    wall_time: float
+    inputs: Dict[str, InputStats]
+    messages: int = 0  # notification recipients, one XMPP message each
+    auctions_started: int = 0
+    auctions_let: int = 0
+    confirmation_requests: int = 0
+    time_to_let: array = field(default_factory=lambda: array("d"))  # virtual seconds
+
+    @property
+    def applied(self) -> int:
+        return sum(stats.count for stats in self.inputs.values())
+
+    def format(self) -> str:
+        lines = [
+            f"Simulated {self.virtual_time} in {self.wall_time:.1f} s: "
+            f"{self.applied} inputs ({self.applied / max(self.wall_time, 1e-9):,.0f}/s), "
+            f"{self.messages} messages",
+            f"{'input':<24}{'count':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+        ]
+        for kind, stats in sorted(self.inputs.items()):
+            lines.append(
+                f"{kind:<24}{stats.count:>10}"
+                + "".join(
+                    f"{percentile(stats.latencies, fraction) * 1000:>10.3f}"
+                    for fraction in (0.5, 0.95, 0.99, 1.0)
+                )
+            )
+        let = self.auctions_let
+        lines.append(
+            f"Auctions: {self.auctions_started} started, {let} let, "
+            f"{self.confirmation_requests / max(let, 1):.2f} confirmation requests per let offer"
+        )
+        lines.append(
+            f"Time to let: p50 {percentile(self.time_to_let, 0.5):.1f} s, "
+            f"p95 {percentile(self.time_to_let, 0.95):.1f} s"
+        )
+        return "\n".join(lines)
+
+
+class Simulation:
+    """Drives a ``Market`` on a virtual clock with synthetic agents.
+
+    Tenants, offers and demand votes arrive as Poisson processes over the
+    population's ``duration``. Agents answer the notifications they get
+    after ``reaction_time`` on average: tenants bid on auctions they were
+    matched to, raise when outbid and confirm or decline; a tenant who
+    accepts an offer stops bidding. The market's own deadlines are applied
+    as ``advance`` inputs the moment they fall due, like the hub's
+    ``AuctionManagerBehaviour`` does, and with ``clearing_interval`` the
+    batch clearing runs in line. The run ends once no agent has anything
+    left to do and no auction is open.
+    """
+
+    def __init__(
+        self,
+        market: Market,
+        population: Population,
+        seed: int = 0,
+        start: datetime = datetime(2024, 1, 1),
+        clearing_interval: Optional[timedelta] = None,
+        journal=None,
+    ):
+        self.market = market
+        self.population = population
+        self.rng = random.Random(seed)
+        self.start = self.now = start
+        self.clearing_interval = clearing_interval
+        self.journal = journal
+        self.events = []  # (time, sequence, kind, data)
+        self.sequence = itertools.count()
+        self.max_price = array("q", bytes(8 * population.tenants))
+        self.housed = bytearray(population.tenants)
+        self.pending_bids = set()  # (tenant, offer_id) with a bid on its way
+        self.started_at: Dict[str, datetime] = {}  # offer_id -> auction start
+        self.report = SimulationReport(timedelta(0), 0.0, {})
+
+    def schedule(self, at: datetime, kind: str, data: dict):
+        heapq.heappush(self.events, (at, next(self.sequence), kind, data))
+
+    def later(self, mean: timedelta) -> datetime:
+        return self.now + timedelta(seconds=self.rng.expovariate(1 / mean.total_seconds()))
+
+    def location(self) -> List[float]:
+        lat, lon = self.population.origin
+        extent = self.population.extent
+        return [lat + self.rng.random() * extent, lon + self.rng.random() * extent]
+
+    @staticmethod
+    def tenant_index(jid: str) -> int:
+        return int(jid[1 : jid.index("@")])
+
+    def apply(self, kind: str, data: dict):
+        started = time.perf_counter()
+        if self.journal:
+            self.journal.append(kind, data, self.now)
+        notifications = self.market.apply(kind, data, self.now)
+        elapsed = time.perf_counter() - started
+
+        stats = self.report.inputs.get(kind)
+        if stats is None:
+            stats = self.report.inputs[kind] = InputStats()
+        stats.count += 1
+        stats.latencies.append(elapsed)
+        for notification in notifications:
+            self.deliver(notification)
+
+    def arrive(self, kind: str, index: int):
+        population = self.population
+        count = {"tenant": population.tenants, "offer": population.offers, "vote": population.votes}[kind]
+        if index + 1 < count:
+            self.schedule(self.later(population.duration / count), kind, {"index": index + 1})
+
+        if kind == "tenant":
+            min_price = self.rng.randint(50, 150)
+            self.max_price[index] = min_price + self.rng.randint(20, 150)
+            self.apply(
+                "register-rental",
+                {
+                    "min_price": min_price,
+                    "max_price": self.max_price[index],
+                    "location": self.location(),
+                    "sender": f"t{index}@simulation",
+                },
+            )
+        elif kind == "offer":
+            self.apply(
+                "rental-offer",
+                {
+                    "starting_price": self.rng.randint(80, 250),
+                    "location": self.location(),
+                    "sender": f"l{index}@simulation",
+                },
+            )
+        else:
+            self.apply(
+                "ServiceDemandRequest",
+                {"service_type": self.rng.choice(SERVICE_OPTIONS), "localization": self.location()},
+            )
+
+    def bid(self, jid: str, offer_id: str, amount: int):
+        tenant = self.tenant_index(jid)
+        if self.housed[tenant] or amount > self.max_price[tenant]:
+            return
+        # A tenant never has more than one bid on its way per auction
+        if (tenant, offer_id) not in self.pending_bids:
+            self.pending_bids.add((tenant, offer_id))
+            self.schedule(
+                self.later(self.population.reaction_time),
+                "bid",
+                {"offer_id": offer_id, "amount": amount, "sender": jid},
+            )
+
+    def responders(self, recipients: List[str], probability: float) -> List[str]:
+        """About ``probability`` of the recipients, without a draw per recipient."""
+        count = int(len(recipients) * probability + self.rng.random())
+        return self.rng.sample(recipients, min(count, len(recipients)))
+
+    def deliver(self, notification: Notification):
+        self.report.messages += len(notification.recipients)
+        payload = notification.payload
+        population = self.population
+        match notification.conversation_id:
+            case "auction-start":
+                self.report.auctions_started += 1
+                self.started_at[payload["offer_id"]] = self.now
+                for jid in self.responders(notification.recipients, population.bid_probability):
+                    raises = self.rng.randint(1, 5)
+                    self.bid(
+                        jid,
+                        payload["offer_id"],
+                        payload["starting_price"] + raises * population.raise_step,
+                    )
+            case "outbid-notification":
+                for jid in self.responders(notification.recipients, population.raise_probability):
+                    self.bid(
+                        jid,
+                        payload["offer_id"],
+                        payload["current_highest_bid"] + population.raise_step,
+                    )
+            case "confirmation-request":
+                self.report.confirmation_requests += 1
+                for jid in notification.recipients:
+                    self.schedule(
+                        self.later(population.reaction_time),
+                        "confirm",
+                        {"offer_id": payload["offer_id"], "sender": jid},
+                    )
+            case "auction-completed":
+                self.report.auctions_let += 1
+                started = self.started_at.pop(payload["offer_id"], None)
+                if started is not None:
+                    self.report.time_to_let.append((self.now - started).total_seconds())
+
+    def confirm(self, data: dict):
+        tenant = self.tenant_index(data["sender"])
+        confirmed = (
+            not self.housed[tenant] and self.rng.random() < self.population.confirm_probability
+        )
+        if confirmed:
+            self.housed[tenant] = 1
+        self.apply("confirmation-response", {**data, "confirmed": confirmed})
+
+    def clear(self):
+        problem = self.market.clearing_problem()
+        if problem is not None:
+            started = time.perf_counter()
+            assignment = solve(problem)
+            stats = self.report.inputs.setdefault("clearing-solve", InputStats())
+            stats.count += 1
+            stats.latencies.append(time.perf_counter() - started)
+            self.apply("clear-auctions", {"offer_ids": problem.offer_ids, "assignment": assignment})
+        if self.events or self.market.active_auctions:
+            self.schedule(self.now + self.clearing_interval, "clear", {})
+
+    def run(self) -> SimulationReport:
+        population = self.population
+        for kind in ("tenant", "offer", "vote"):
+            if getattr(population, kind + "s"):
+                self.schedule(self.start, kind, {"index": 0})
+        if self.clearing_interval:
+            self.schedule(self.start + self.clearing_interval, "clear", {})
+
+        started = time.perf_counter()
+        while True:
+            deadline = self.market.deadlines.next_deadline()
+            if self.events and (deadline is None or self.events[0][0] <= deadline):
+                self.now, _, kind, data = heapq.heappop(self.events)
+                match kind:
+                    case "tenant" | "offer" | "vote":
+                        self.arrive(kind, data["index"])
+                    case "bid":
+                        self.pending_bids.discard(
+                            (self.tenant_index(data["sender"]), data["offer_id"])
+                        )
+                        self.apply("bid", data)
+                    case "confirm":
+                        self.confirm(data)
+                    case "clear":
+                        self.clear()
+            elif deadline is not None and (self.events or self.market.active_auctions):
+                self.now = max(self.now, deadline)
+                self.apply("advance", {})
+            else:
+                break
+        self.report.wall_time = time.perf_counter() - started
+        self.report.virtual_time = self.now - self.start
+        return self.report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the hub's market on a virtual clock.")
+    parser.add_argument("--tenants", type=int, default=Population.tenants)
+    parser.add_argument("--offers", type=int, default=Population.offers)
+    parser.add_argument("--votes", type=int, default=Population.votes)
+    parser.add_argument("--hours", type=float, default=1.0, help="arrival window")
+    parser.add_argument(
+        "--extent", type=float, default=Population.extent, help="side of the area, in degrees"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--store", choices=("columns", "memory"), default="columns")
+    parser.add_argument("--confirmation-fanout", type=int, default=1)
+    parser.add_argument("--clearing-interval", type=float, help="seconds between batch clearings")
+    args = parser.parse_args(argv)
+
+    market = Market(
+        store=ColumnStore() if args.store == "columns" else MemoryStore(),
+        confirmation_fanout=args.confirmation_fanout,
+        clearing=args.clearing_interval is not None,
+    )
+    simulation = Simulation(
+        market,
+        Population(
+            tenants=args.tenants,
+            offers=args.offers,
+            votes=args.votes,
+            duration=timedelta(hours=args.hours),
+            extent=args.extent,
+        ),
+        seed=args.seed,
+        clearing_interval=(
+            timedelta(seconds=args.clearing_interval) if args.clearing_interval else None
+        ),
+    )
+    print(simulation.run().format())
+
+
+if __name__ == "__main__":
+    main()
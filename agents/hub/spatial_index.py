@@ -0,0 +1,110 @@
+import math
+from typing import Any, Hashable, Iterator, Tuple
+
+from agents.hub.price_index import IntervalTree, SortedPriceIndex
+
+
+CLOSE_DISTANCE = 0.01
+
+
+def is_close(location1, location2):
+    return (
+        abs(location1[0] - location2[0]) < CLOSE_DISTANCE
+        and abs(location1[1] - location2[1]) < CLOSE_DISTANCE
+    )
+
+
+class Bucket(dict):
+    def add(self, key: Hashable, item):
+        self[key] = item
+
+    def discard(self, key: Hashable):
+        self.pop(key, None)
+
+
+class SpatialIndex:
+    """Fixed-degree grid of located items.
+
+    Cells are as wide as the ``is_close`` tolerance, so every item close to a
+    location lies in that location's cell or in one of its eight neighbours.
+    """
+
+    def __init__(self, cell_size: float = CLOSE_DISTANCE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def new_bucket(self):
+        return Bucket()
+
+    def cell(self, location) -> Tuple[int, int]:
+        return (
+            math.floor(location[0] / self.cell_size),
+            math.floor(location[1] / self.cell_size),
+        )
+
+    def neighbour_cells(self, location) -> Iterator[Tuple[int, int]]:
+        row, col = self.cell(location)
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                yield row + d_row, col + d_col
+
+    def neighbour_buckets(self, location):
+        for cell in self.neighbour_cells(location):
+            bucket = self.cells.get(cell)
+            if bucket:
+                yield bucket
+
+    def insert(self, key: Hashable, item):
+        cell = self.cell(item.location)
+        bucket = self.cells.get(cell)
+        if bucket is None:
+            bucket = self.cells[cell] = self.new_bucket()
+        if key not in bucket:
+            self.size += 1
+        bucket.add(key, item)
+
+    def remove(self, key: Hashable, item):
+        cell = self.cell(item.location)
+        bucket = self.cells.get(cell)
+        if bucket is None or key not in bucket:
+            return
+        bucket.discard(key)
+        self.size -= 1
+        if not bucket:
+            del self.cells[cell]
+
+    def nearby(self, location) -> Iterator[Tuple[Hashable, Any]]:
+        for bucket in self.neighbour_buckets(location):
+            for key, item in bucket.items():
+                if is_close(item.location, location):
+                    yield key, item
+
+
+class OfferIndex(SpatialIndex):
+    """Offers bucketed by location and sorted by starting price per cell."""
+
+    def new_bucket(self):
+        return SortedPriceIndex(lambda offer: offer.starting_price)
+
+    def in_price_range(self, location, min_price, max_price):
+        for bucket in self.neighbour_buckets(location):
+            for key, offer in bucket.between(min_price, max_price):
+                if is_close(offer.location, location):
+                    yield key, offer
+
+
+class RequestIndex(SpatialIndex):
+    """Requests bucketed by location with an interval tree of price ranges per cell."""
+
+    def new_bucket(self):
+        return IntervalTree(lambda request: (request.min_price, request.max_price))
+
+    def covering_price(self, location, price):
+        for bucket in self.neighbour_buckets(location):
+            for key, request in bucket.covering(price):
+                if is_close(request.location, location):
+                    yield key, request
@@ -0,0 +1,122 @@
+from datetime import datetime
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple
+
+from agents.hub.archive import AuctionArchive
+from agents.hub.scheduler import DeadlineScheduler
+from agents.hub.spatial_index import OfferIndex, RequestIndex
+
+
+class BaseStore:
+    """Expiry and archival shared by the in-memory stores.
+
+    Expiry times are kept in a deadline heap keyed by ``("offer", offer_id)``
+    and ``("request", request_id)``. Finished auctions go to ``archive`` if
+    one is given.
+    """
+
+    def __init__(self, archive: Optional[AuctionArchive] = None):
+        self.expiry = DeadlineScheduler()
+        self.archive = archive
+
+    def next_ids(self) -> Tuple[int, int]:
+        return 0, 0
+
+    def _expire_at(self, key: Tuple[str, Hashable], expires_at: Optional[datetime]):
+        if expires_at is not None:
+            self.expiry.schedule(key, expires_at)
+
+    def next_expiry(self) -> Optional[datetime]:
+        return self.expiry.next_deadline()
+
+    def pop_expired(self, now: datetime) -> List[Tuple[str, Hashable]]:
+        """Expired ``("offer", offer_id)`` and ``("request", request_id)`` keys."""
+        return self.expiry.pop_due(now)
+
+    def requests_covering_prices(self, offers) -> List[List[Tuple[int, object]]]:
+        """Requests matching each of ``offers``."""
+        return [
+            list(self.requests_covering_price(offer.location, offer.starting_price))
+            for offer in offers
+        ]
+
+    def requests_by_id(self, request_ids) -> Dict[int, object]:
+        """The requests among ``request_ids`` that still stand."""
+        found = {}
+        for request_id in request_ids:
+            request = self.requests.get(request_id)
+            if request is not None:
+                found[request_id] = request
+        return found
+
+    def archive_auction(self, offer_id: str, auction, winner, now: datetime):
+        # Finished auctions are never kept in memory
+        if self.archive:
+            self.archive.append(offer_id, auction, winner, now)
+
+    def flush(self):
+        if self.archive:
+            self.archive.flush()
+
+    def snapshot(self, tag=None) -> dict:
+        return {"expiry": self.expiry.deadlines}
+
+    def restore(self, state: dict):
+        for key, expires_at in state["expiry"].items():
+            self.expiry.schedule(key, expires_at)
+
+
+class MemoryStore(BaseStore):
+    """Offers and requests kept as objects in dicts with spatial indexes.
+
+    ``agents.hub.columns.ColumnStore`` and ``database.store.SqliteStore``
+    implement the same methods on columnar arrays and on top of SQLite.
+    """
+
+    def __init__(self, archive: Optional[AuctionArchive] = None):
+        super().__init__(archive)
+        self.offers: Dict[str, object] = {}  # offer_id -> RentalOffer
+        self.requests: Dict[int, object] = {}  # request_id -> RentalRequest
+        self.offer_index = OfferIndex()
+        self.request_index = RequestIndex()
+
+    def add_offer(self, offer_id: str, offer, expires_at: Optional[datetime] = None):
+        self.offers[offer_id] = offer
+        self.offer_index.insert(offer_id, offer)
+        self._expire_at(("offer", offer_id), expires_at)
+
+    def remove_offer(self, offer_id: str):
+        offer = self.offers.pop(offer_id, None)
+        if offer is not None:
+            self.offer_index.remove(offer_id, offer)
+        self.expiry.cancel(("offer", offer_id))
+
+    def add_request(self, request_id: int, request, expires_at: Optional[datetime] = None):
+        self.requests[request_id] = request
+        self.request_index.insert(request_id, request)
+        self._expire_at(("request", request_id), expires_at)
+
+    def remove_request(self, request_id: int):
+        request = self.requests.pop(request_id, None)
+        if request is not None:
+            self.request_index.remove(request_id, request)
+        self.expiry.cancel(("request", request_id))
+
+    def offers_in_price_range(self, location, low, high) -> Iterator[Tuple[str, object]]:
+        return self.offer_index.in_price_range(location, low, high)
+
+    def requests_covering_price(self, location, price) -> Iterator[Tuple[int, object]]:
+        return self.request_index.covering_price(location, price)
+
+    def snapshot(self, tag=None) -> dict:
+        return {
+            **super().snapshot(tag),
+            "offers": self.offers,
+            "requests": self.requests,
+        }
+
+    def restore(self, state: dict):
+        for offer_id, offer in state["offers"].items():
+            self.add_offer(offer_id, offer)
+        for request_id, request in state["requests"].items():
+            self.add_request(request_id, request)
+        super().restore(state)
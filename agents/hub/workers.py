@@ -0,0 +1,234 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from agents.hub.matching import column
+from agents.hub.model import PrecomputedMatches
+from agents.hub.spatial_index import CLOSE_DISTANCE
+
+
+# Every column of the shared index is 8 bytes wide:
+# cell key, request id, min price, max price (int64), lat, lon (float64)
+COLUMNS = 6
+
+
+@dataclass(frozen=True)
+class IndexHandle:
+    """Name and shape of a published request index, sent along with each task."""
+
+    name: str
+    rows: int
+    cell_size: float
+    next_request_id: int
+
+
+def cell_keys(xs, ys) -> np.ndarray:
+    """Grid cells as int64 keys ordered like ``(x, y)`` tuples."""
+    return np.asarray(xs, dtype=np.int64) * (1 << 32) + np.asarray(ys, dtype=np.int64)
+
+
+def index_columns(buffer, rows: int):
+    ints = np.ndarray((4, rows), dtype=np.int64, buffer=buffer)
+    floats = np.ndarray((2, rows), dtype=np.float64, buffer=buffer, offset=ints.nbytes)
+    return (*ints, *floats)
+
+
+def request_columns(store) -> Tuple[np.ndarray, ...]:
+    """Standing requests as columns sorted by cell key.
+
+    A ``ColumnStore`` already keeps its requests grouped by cell, so its
+    blocks are concatenated in cell order; any other store is read row by row
+    and sorted.
+    """
+    blocks = getattr(store, "request_blocks", None)
+    if blocks is not None:
+        ordered = [blocks[cell] for cell in sorted(blocks)]
+
+        def concatenated(name, dtype):
+            if not ordered:
+                return np.empty(0, dtype=dtype)
+            return np.concatenate([column(getattr(block, name)) for block in ordered])
+
+        keys = np.repeat(
+            cell_keys([block.cell[0] for block in ordered], [block.cell[1] for block in ordered]),
+            [len(block) for block in ordered],
+        )
+        return (
+            keys,
+            concatenated("ids", np.int64),
+            concatenated("min_price", np.int64),
+            concatenated("max_price", np.int64),
+            concatenated("lat", np.float64),
+            concatenated("lon", np.float64),
+        )
+
+    requests = list(store.requests.items())
+    ids = np.array([request_id for request_id, _ in requests], dtype=np.int64)
+    min_price = np.array([request.min_price for _, request in requests], dtype=np.int64)
+    max_price = np.array([request.max_price for _, request in requests], dtype=np.int64)
+    lat = np.array([request.location[0] for _, request in requests], dtype=np.float64)
+    lon = np.array([request.location[1] for _, request in requests], dtype=np.float64)
+    keys = cell_keys(
+        np.floor(lat / CLOSE_DISTANCE), np.floor(lon / CLOSE_DISTANCE)
+    )
+    order = np.argsort(keys, kind="stable")
+    return tuple(values[order] for values in (keys, ids, min_price, max_price, lat, lon))
+
+
+def cell_size_of(store) -> float:
+    grid = getattr(store, "grid", None)
+    return grid.cell_size if grid is not None else CLOSE_DISTANCE
+
+
+# Worker side: the index attached most recently, kept until a newer one is published
+_attached: Optional[Tuple[shared_memory.SharedMemory, tuple]] = None
+
+
+def _attach(handle: IndexHandle) -> tuple:
+    global _attached
+    if _attached is None or _attached[0].name != handle.name:
+        if _attached is not None:
+            segment = _attached[0]
+            _attached = None
+            segment.close()
+        segment = shared_memory.SharedMemory(name=handle.name)
+        _attached = segment, index_columns(segment.buf, handle.rows)
+    return _attached[1]
+
+
+def match_offers(handle: IndexHandle, offers: Sequence[Tuple[float, float, int]]) -> List[List[int]]:
+    """Ids of the indexed requests matching each ``(lat, lon, price)`` offer.
+
+    Rows are sorted by cell key, so the three cells of a neighbourhood row
+    are one contiguous slice found by binary search.
+    """
+    keys, ids, min_price, max_price, lat, lon = _attach(handle)
+    if not offers:
+        return []
+    offer_lats, offer_lons, prices = (np.array(values) for values in zip(*offers))
+    xs = np.floor(offer_lats / handle.cell_size).astype(np.int64)[:, None] + (-1, 0, 1)
+    ys = np.floor(offer_lons / handle.cell_size).astype(np.int64)[:, None]
+    lows = np.searchsorted(keys, cell_keys(xs, ys - 1), "left").tolist()
+    highs = np.searchsorted(keys, cell_keys(xs, ys + 1), "right").tolist()
+
+    matches = []
+    for i, (offer_lat, offer_lon, price) in enumerate(offers):
+        found = []
+        for low, high in zip(lows[i], highs[i]):
+            if low == high:
+                continue
+            rows = slice(low, high)
+            mask = (
+                (np.abs(lat[rows] - offer_lat) < CLOSE_DISTANCE)
+                & (np.abs(lon[rows] - offer_lon) < CLOSE_DISTANCE)
+                & (min_price[rows] <= price)
+                & (max_price[rows] >= price)
+            )
+            found.extend(ids[rows][mask].tolist())
+        matches.append(found)
+    return matches
+
+
+def worker_executor(workers: int) -> ProcessPoolExecutor:
+    """Process pool for the hub's offloaded work.
+
+    Workers are spawned rather than forked, so they never inherit the
+    agent's event loop or XMPP connection.
+    """
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+class MatchingPool:
+    """Matches bulk offer imports in worker processes.
+
+    The hub publishes its standing requests into a shared memory segment
+    that every worker maps read-only, so a task only carries the offers.
+    The segment is republished once ``republish_after`` requests have been
+    registered since, or after ``republish_interval`` seconds. Results are
+    ``PrecomputedMatches`` that the market brings up to date with the requests
+    registered or removed while the workers ran.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        chunk_size: int = 256,
+        min_batch: int = 256,
+        republish_after: int = 1024,
+        republish_interval: float = 5.0,
+    ):
+        self.executor = worker_executor(workers)
+        self.chunk_size = chunk_size
+        self.min_batch = min_batch
+        self.republish_after = republish_after
+        self.republish_interval = republish_interval
+        self.index: Optional[IndexHandle] = None
+        self.published_at = 0.0
+        self.segments: Dict[str, shared_memory.SharedMemory] = {}
+        self.in_flight: Dict[str, int] = {}  # segment name -> tasks using it
+
+    def publish(self, market) -> IndexHandle:
+        columns = request_columns(market.store)
+        rows = len(columns[0])
+        segment = shared_memory.SharedMemory(create=True, size=max(COLUMNS * 8 * rows, 1))
+        for target, values in zip(index_columns(segment.buf, rows), columns):
+            target[:] = values
+        self.segments[segment.name] = segment
+        previous, self.index = self.index, IndexHandle(
+            segment.name, rows, cell_size_of(market.store), market.next_request_id
+        )
+        self.published_at = time.monotonic()
+        if previous is not None:
+            self._release(previous.name)
+        return self.index
+
+    def _stale(self, market) -> bool:
+        return (
+            self.index is None
+            or market.next_request_id - self.index.next_request_id >= self.republish_after
+            or time.monotonic() - self.published_at >= self.republish_interval
+        )
+
+    def _release(self, name: str):
+        if self.in_flight.get(name) or (self.index and self.index.name == name):
+            return
+        self.in_flight.pop(name, None)
+        segment = self.segments.pop(name)
+        segment.close()
+        segment.unlink()
+
+    async def match_offers(
+        self, market, offers: Sequence[Tuple[float, float, int]]
+    ) -> PrecomputedMatches:
+        """Matches ``(lat, lon, price)`` offers, one chunk per worker task."""
+        index = self.publish(market) if self._stale(market) else self.index
+        self.in_flight[index.name] = self.in_flight.get(index.name, 0) + 1
+        loop = asyncio.get_running_loop()
+        try:
+            chunks = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        self.executor, match_offers, index, offers[i : i + self.chunk_size]
+                    )
+                    for i in range(0, len(offers), self.chunk_size)
+                )
+            )
+        finally:
+            self.in_flight[index.name] -= 1
+            self._release(index.name)
+        return PrecomputedMatches(
+            [matches for chunk in chunks for matches in chunk], index.next_request_id
+        )
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.index = None
+        for name in list(self.segments):
+            self.in_flight.pop(name, None)
+            self._release(name)
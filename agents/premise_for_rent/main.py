@@ -1,142 +1,242 @@
-from dataclasses import dataclass
-import inspect
-import spade
-from spade.agent import Agent
-from spade.behaviour import OneShotBehaviour, CyclicBehaviour
-from spade.message import Message
-from spade.template import Template
-import json
-import sys
-import threading
-import asyncio
-import uuid
-import os
-
-
-sys.path.append(
-    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "database"))
-)
-from system_data import DEFAULT_METADATA
-
-
-@dataclass
-class RentalOfferDetails:
-    starting_price: float
-    location: list[float]
-
-
-class PremiseForRentAgent(Agent):
-    def __init__(self, jid, password, event_queue, *args, **kwargs):
-        super().__init__(jid, password, *args, **kwargs)
-        self.event_queue = event_queue
-
-    class RentalOffer(OneShotBehaviour):
-        def __init__(self, rental_offer_details: RentalOfferDetails):
-            super().__init__()
-            self.rental_offer_details = rental_offer_details
-
-        async def run(self):
-            print("RentalOffer running")
-            msg = Message(
-                to="hub_agent@localhost",
-                metadata={
-                    "performative": "inform",
-                    "conversation-id": "rental-offer",
-                    **DEFAULT_METADATA,
-                },
-                body=json.dumps(
-                    {
-                        "starting_price": self.rental_offer_details.starting_price,
-                        "location": self.rental_offer_details.location,
-                    }
-                ),
-            )
-            await self.send(msg)
-
-    class AuctionCompleted(CyclicBehaviour):
-        async def run(self):
-            print("AuctionCompleted running")
-            msg = await self.receive(timeout=20)
-            if not msg:
-                return
-            data = json.loads(msg.body)
-            final_price = data["final_price"]
-
-            print("AuctionCompleted got msg")
-            await self.agent.event_queue.put(
-                {
-                    "type": "auction-completed",
-                    "data": {"final_price": final_price},
-                    "agent": self.agent.jid,
-                }
-            )
-
-        metadata = {
-            "conversation-id": "auction-completed",
-            **DEFAULT_METADATA,
-        }
-
-    async def setup(self):
-        print("PremiseForRentAgent started")
-
-        for d in [
-            d
-            for d in dir(self)
-            if inspect.isclass(getattr(self, d)) and d != "__class__"
-        ]:
-            attr = getattr(self, d)
-            if issubclass(attr, CyclicBehaviour) and hasattr(attr, "metadata"):
-                template = Template(metadata=attr.metadata)
-                self.add_behaviour(attr(), template)
-
-    def add_service_demand_request(self, rental_offer_details: RentalOfferDetails):
-        behavior = self.RentalOffer(rental_offer_details)
-        self.add_behaviour(behavior)
-
-
-class PremiseForRentInterface:
-
-    def __init__(self, event_queue):
-        self.event_queue = event_queue
-        self.agents = []
-
-    def add_rental_offer(self, agent_id, rental_offer_details: RentalOfferDetails):
-        unique_jid_localpart = agent_id
-        new_jid = f"{unique_jid_localpart}@localhost"
-        new_password = "some_password"
-        new_agent = PremiseForRentAgent(new_jid, new_password, self.event_queue)
-        new_loop = asyncio.new_event_loop()
-
-        def agent_thread_main():
-            asyncio.set_event_loop(new_loop)
-            new_loop.run_until_complete(new_agent.start(auto_register=True))
-            new_loop.run_until_complete(spade.wait_until_finished(new_agent))
-
-        t = threading.Thread(target=agent_thread_main, daemon=True)
-        t.start()
-
-        self.agents.append(
-            {
-                "agent": new_agent,
-                "loop": new_loop,
-                "thread": t,
-                "jid": new_jid,
-            }
-        )
-
-        new_loop.call_soon_threadsafe(
-            lambda: new_agent.add_service_demand_request(rental_offer_details)
-        )
-
-
-async def main():
-    premise_for_rent_agent = PremiseForRentAgent(
-        "premise_for_rent_agent@localhost", "premise_for_rent_agent_password"
-    )
-    await premise_for_rent_agent.start(auto_register=True)
-    await spade.wait_until_finished(premise_for_rent_agent)
-    print("Agents finished")
-
-
-if __name__ == "__main__":
-    spade.run(main())
+from dataclasses import dataclass
+from typing import Optional
+import aioxmpp
+import spade
+from spade.agent import Agent
+from spade.behaviour import OneShotBehaviour
+import sys
+import uuid
+import os
+
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "database"))
+)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from system_data import DEFAULT_METADATA
+from agents.common import codec, gateway
+from agents.common.dispatch import MessageHandler, add_message_handlers
+from agents.common.loopback import use_loopback
+from agents.common.pool import pool_from_env
+from agents.common.runtime import AgentRuntime
+from agents.common.shards import ShardMap, default_shards
+
+
+@dataclass
+class RentalOfferDetails:
+    starting_price: int
+    location: list[float]
+
+
+class PremiseForRentAgent(Agent):
+    """A landlord, or a gateway acting for many landlords over one connection.
+
+    As a gateway, behaviours take the ``identity`` of the landlord they act
+    for and events carry that landlord's JID, see ``agents.common.gateway``.
+    """
+
+    def __init__(
+        self,
+        jid,
+        password,
+        event_queue,
+        *args,
+        use_dispatcher=False,
+        shards: ShardMap = None,
+        **kwargs,
+    ):
+        super().__init__(jid, password, *args, **kwargs)
+        self.event_queue = event_queue
+        self.use_dispatcher = use_dispatcher
+        self.shards = shards or default_shards()
+        self.identities = set()  # landlords this agent is a gateway for
+
+    def agent_jid(self, identity=None) -> aioxmpp.JID:
+        """JID the events of ``identity`` are reported under."""
+        return self.jid if identity is None else self.jid.replace(localpart=identity)
+
+    class RentalOffer(OneShotBehaviour):
+        def __init__(self, rental_offer_details: RentalOfferDetails, identity=None):
+            super().__init__()
+            self.rental_offer_details = rental_offer_details
+            self.identity = identity
+
+        async def run(self):
+            print("RentalOffer running")
+            msg = codec.message(
+                self.agent.shards.hub_for(self.rental_offer_details.location),
+                "rental-offer",
+                {
+                    "starting_price": self.rental_offer_details.starting_price,
+                    "location": self.rental_offer_details.location,
+                },
+            )
+            await self.send(gateway.with_identity(msg, self.identity))
+
+    class RentalOffers(OneShotBehaviour):
+        def __init__(self, rental_offers_details: list[RentalOfferDetails], identity=None):
+            super().__init__()
+            self.rental_offers_details = rental_offers_details
+            self.identity = identity
+
+        async def run(self):
+            by_hub = self.agent.shards.group_by_hub(
+                self.rental_offers_details, lambda details: details.location
+            )
+            for hub, rental_offers_details in by_hub.items():
+                msg = codec.message(
+                    hub,
+                    "rental-offers",
+                    {
+                        "offers": [
+                            {
+                                "starting_price": details.starting_price,
+                                "location": details.location,
+                            }
+                            for details in rental_offers_details
+                        ]
+                    },
+                )
+                await self.send(gateway.with_identity(msg, self.identity))
+
+    class AuctionCompleted(MessageHandler):
+        async def handle(self, msg):
+            data = codec.decode_message(msg)
+            final_price = data.final_price
+
+            print("AuctionCompleted got msg")
+            await self.agent.event_queue.put(
+                {
+                    "type": "auction-completed",
+                    "data": {"final_price": final_price},
+                    "agent": self.agent.agent_jid(
+                        gateway.identity_of(msg, self.agent.identities)
+                    ),
+                }
+            )
+
+        metadata = {
+            "conversation-id": "auction-completed",
+            **DEFAULT_METADATA,
+        }
+
+    class OfferExpired(MessageHandler):
+        async def handle(self, msg):
+            data = codec.decode_message(msg)
+
+            print("OfferExpired got msg")
+            await self.agent.event_queue.put(
+                {
+                    "type": "offer-expired",
+                    "data": {"offer_id": data.offer_id},
+                    "agent": self.agent.agent_jid(
+                        gateway.identity_of(msg, self.agent.identities)
+                    ),
+                }
+            )
+
+        metadata = {
+            "conversation-id": "offer-expired",
+            **DEFAULT_METADATA,
+        }
+
+    async def setup(self):
+        print("PremiseForRentAgent started")
+        use_loopback(self)
+        add_message_handlers(self, self.use_dispatcher)
+
+    def add_service_demand_request(
+        self, rental_offer_details: RentalOfferDetails, identity=None
+    ):
+        if identity is not None:
+            self.identities.add(identity)
+        behavior = self.RentalOffer(rental_offer_details, identity)
+        self.add_behaviour(behavior)
+
+    def add_rental_offers(
+        self, rental_offers_details: list[RentalOfferDetails], identity=None
+    ):
+        if identity is not None:
+            self.identities.add(identity)
+        self.add_behaviour(self.RentalOffers(rental_offers_details, identity))
+
+
+class PremiseForRentInterface:
+
+    def __init__(
+        self,
+        event_queue,
+        runtime: AgentRuntime = None,
+        shards: ShardMap = None,
+        gateway_jid: Optional[str] = None,
+    ):
+        self.event_queue = event_queue
+        self.runtime = runtime or AgentRuntime()
+        self.shards = shards or default_shards()
+        self.agents = []
+        # With a gateway every landlord shares its single XMPP connection
+        self.gateway_jid = gateway_jid or os.environ.get("LANDLORD_GATEWAY")
+        self.gateway = None
+        # Landlords connected ahead of time, claimed by the next listings
+        self.pool = None
+        if not self.gateway_jid:
+            self.pool = pool_from_env(
+                "LANDLORD", self.new_agent, self.runtime, prefix="rentaloffer"
+            )
+
+    def new_agent(self, jid) -> PremiseForRentAgent:
+        return PremiseForRentAgent(
+            jid, "some_password", self.event_queue, shards=self.shards
+        )
+
+    def gateway_agent(self) -> PremiseForRentAgent:
+        if self.gateway is None:
+            self.gateway = self.new_agent(self.gateway_jid)
+            self.runtime.start(self.gateway)
+        return self.gateway
+
+    def add_rental_offer(self, agent_id, rental_offer_details: RentalOfferDetails) -> str:
+        """Registers the rental offer and returns the id of the landlord agent making it.
+
+        That is ``agent_id`` unless an agent was claimed from the pool.
+        """
+        pooled = self.pool.claim() if self.pool else None
+        if pooled is not None:
+            agent_id = pooled.jid.localpart
+        unique_jid_localpart = agent_id
+        new_jid = f"{unique_jid_localpart}@localhost"
+        identity = None
+        if self.gateway_jid:
+            new_agent, identity = self.gateway_agent(), agent_id
+        elif pooled is not None:
+            new_agent = pooled
+        else:
+            new_agent = self.new_agent(new_jid)
+            self.runtime.start(new_agent)
+
+        self.agents.append(
+            {
+                "agent": new_agent,
+                "jid": new_jid,
+                "identity": identity,
+            }
+        )
+
+        self.runtime.call(
+            new_agent,
+            lambda: new_agent.add_service_demand_request(rental_offer_details, identity),
+        )
+        return agent_id
+
+
+async def main():
+    premise_for_rent_agent = PremiseForRentAgent(
+        "premise_for_rent_agent@localhost", "premise_for_rent_agent_password"
+    )
+    await premise_for_rent_agent.start(auto_register=True)
+    await spade.wait_until_finished(premise_for_rent_agent)
+    print("Agents finished")
+
+
+if __name__ == "__main__":
+    spade.run(main())
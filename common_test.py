@@ -0,0 +1,495 @@
+import asyncio
+import base64
+import json
+import threading
+import time
+
+import aioxmpp
+import pytest
+from spade.message import Message
+
+from agents.common import codec
+from agents.common.codec import MessageError
+from agents.common.dispatch import Dispatcher, MessageHandler
+from agents.common.loopback import Loopback
+from agents.common.messages import Bid, RentalOffers
+from agents.common.pool import AgentPool
+from agents.common.runtime import AgentRuntime
+from agents.common.shards import ShardMap, default_shards
+
+
+class RecordingHandler(MessageHandler):
+    def __init__(self, conversation_id):
+        super().__init__()
+        self.metadata = {"conversation-id": conversation_id}
+        self.handled = []
+
+    async def handle(self, msg):
+        self.handled.append(msg)
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_drains_mailbox_by_conversation_id():
+    # given
+    bid = RecordingHandler("bid")
+    confirmation = RecordingHandler("confirmation-response")
+    dispatcher = Dispatcher({"bid": bid, "confirmation-response": confirmation})
+    dispatcher.queue = asyncio.Queue()
+    for conversation_id in ["bid", "confirmation-response", "bid", "unknown"]:
+        dispatcher.queue.put_nowait(
+            Message(to="hub_agent@localhost", metadata={"conversation-id": conversation_id})
+        )
+
+    # when
+    await dispatcher.run()
+
+    # then
+    assert len(bid.handled) == 2, "Both bids should be handled in one wake-up"
+    assert len(confirmation.handled) == 1
+    assert dispatcher.mailbox_size() == 0, "Mailbox should be drained"
+
+
+class LoopRecordingAgent:
+    def __init__(self, jid):
+        self.jid = jid
+        self.loop = None
+        self.started_on = None
+
+    def set_loop(self, loop):
+        self.loop = loop
+
+    async def start(self, auto_register=True):
+        self.started_on = asyncio.get_running_loop()
+
+    async def stop(self):
+        pass
+
+
+def test_agent_runtime_spreads_agents_over_fixed_loops():
+    # given
+    runtime = AgentRuntime(loops=2)
+    agents = [LoopRecordingAgent(f"future_tenant{i}@localhost") for i in range(6)]
+
+    # when
+    for agent in agents:
+        runtime.start(agent).result(timeout=5)
+    called = threading.Event()
+    runtime.call(agents[0], called.set)
+
+    # then
+    assert all(agent.started_on is agent.loop for agent in agents)
+    assert sorted(runtime.load.values()) == [3, 3], "Agents should be balanced"
+    assert called.wait(timeout=5), "Callback should run on the agent's loop"
+
+    for agent in agents:
+        runtime.stop(agent).result(timeout=5)
+    runtime.shutdown()
+
+
+class LoopbackAgent(LoopRecordingAgent):
+    def __init__(self, jid):
+        super().__init__(aioxmpp.JID.fromstr(jid))
+        self.alive = True
+        self.container = None
+        self.received = threading.Event()
+        self.dispatched_on = None
+
+    def is_alive(self):
+        return self.alive
+
+    def set_container(self, container):
+        self.container = container
+
+    def dispatch(self, msg):
+        self.dispatched_on = asyncio.get_running_loop()
+        self.received.set()
+
+
+class XmppRecordingBehaviour:
+    def __init__(self):
+        self.sent = []
+
+    async def _xmpp_send(self, msg):
+        self.sent.append(str(msg.to))
+
+
+def test_loopback_delivers_on_receivers_loop_and_falls_back_to_xmpp():
+    # given
+    runtime = AgentRuntime(loops=2)
+    loopback = Loopback()
+    tenant = LoopbackAgent("future_tenant0@localhost")
+    hub = LoopbackAgent("hub_agent@localhost")
+    for agent in (tenant, hub):
+        runtime.start(agent).result(timeout=5)
+
+        async def register(agent=agent):
+            loopback.register(agent)
+
+        runtime.submit(agent, register()).result(timeout=5)
+    behaviour = XmppRecordingBehaviour()
+
+    async def send(to):
+        await tenant.container.send(Message(to=to), behaviour)
+
+    # when
+    runtime.submit(tenant, send("Hub_Agent@localhost/resource")).result(timeout=5)
+    runtime.submit(tenant, send("other@localhost")).result(timeout=5)
+    hub.alive = False
+    runtime.submit(tenant, send("hub_agent@localhost")).result(timeout=5)
+
+    # then
+    assert hub.received.wait(timeout=5)
+    assert hub.dispatched_on is runtime.loop_of(hub) is not runtime.loop_of(tenant)
+    assert behaviour.sent == ["other@localhost", "hub_agent@localhost"]
+    assert loopback.delivered == 1
+
+    for agent in (tenant, hub):
+        runtime.stop(agent).result(timeout=5)
+    assert loopback.agents == {}, "Stopped agents should leave the loopback"
+    runtime.shutdown()
+
+
+def test_shard_map_routes_by_location_and_offer_id():
+    # given
+    shards = ShardMap(["west@localhost", "centre@localhost", "east@localhost"], [21.0, 21.1])
+
+    # when
+    owners = [shards.hub_for((52.2, lon)) for lon in (20.9, 21.0, 21.05, 21.2)]
+    near = [shards.hubs_near((52.2, lon)) for lon in (20.9, 20.995, 21.05, 21.105)]
+
+    # then
+    assert owners == ["west@localhost", "centre@localhost", "centre@localhost", "east@localhost"]
+    assert near == [
+        ["west@localhost"],
+        ["west@localhost", "centre@localhost"],
+        ["centre@localhost"],
+        ["centre@localhost", "east@localhost"],
+    ]
+    assert [shards.hub_for_offer(offer_id) for offer_id in ("0", "4", "8")] == [
+        "west@localhost",
+        "centre@localhost",
+        "east@localhost",
+    ]
+
+
+def test_default_shards_is_single_hub():
+    # when
+    single = default_shards({})
+    sharded = default_shards(
+        {"HUB_JIDS": "a@localhost, b@localhost", "HUB_SHARD_BOUNDARIES": "21.0"}
+    )
+
+    # then
+    assert single.hubs_near((52.2, 21.0)) == ["hub_agent@localhost"]
+    assert sharded.hub_for((52.2, 21.5)) == "b@localhost"
+    with pytest.raises(ValueError):
+        ShardMap(["a@localhost", "b@localhost"])
+
+
+def test_codec_decodes_typed_bodies():
+    # when
+    bid = codec.decode("bid", '{"offer_id": "3", "amount": 120.0, "extra": 1}')
+    offers = codec.decode(
+        "rental-offers", '{"offers": [{"starting_price": 100, "location": [52.2, 21.0]}]}'
+    )
+
+    # then
+    assert bid == Bid("3", 120), "Integral floats should be read as int"
+    assert bid["amount"] == 120 and dict(bid)["offer_id"] == "3"
+    assert offers.offers[0].location == (52.2, 21.0)
+    assert codec.decode("proxy-bid", '{"offer_id": "3", "max_amount": 200}').increment == 1
+    opened = codec.decode(
+        "auction-start",
+        '{"offer_id": "3", "starting_price": 100, "location": [52.2, 21.0], "end_time": "x"}',
+    )
+    assert opened.current_highest_bid is None
+
+
+@pytest.mark.parametrize(
+    "conversation_id, body",
+    [
+        ("bid", "not json"),
+        ("bid", None),
+        ("bid", "[]"),
+        ("bid", '{"offer_id": "3"}'),
+        ("bid", '{"offer_id": "3", "amount": "120"}'),
+        ("bid", '{"offer_id": "3", "amount": 120.5}'),
+        ("confirmation-response", '{"offer_id": "3", "confirmed": 1}'),
+        ("register-rental", '{"min_price": 1, "max_price": 2, "location": [52.2]}'),
+        (
+            "register-rental",
+            '{"min_price": 1, "max_price": 100000000000000000000, "location": [52.2, 21.0]}',
+        ),
+        ("bid", '{"offer_id": "3", "amount": 1e20}'),
+        ("rental-offers", '{"offers": [{"starting_price": 100}]}'),
+        ("unknown", "{}"),
+    ],
+)
+def test_codec_rejects_malformed_bodies(conversation_id, body):
+    with pytest.raises(MessageError):
+        codec.decode(conversation_id, body)
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_drops_malformed_messages():
+    # given
+    class BidHandler(MessageHandler):
+        metadata = {"conversation-id": "bid"}
+
+        def __init__(self):
+            super().__init__()
+            self.decoded = []
+
+        async def handle(self, msg):
+            self.decoded.append(codec.decode_message(msg))
+
+    handler = BidHandler()
+    dispatcher = Dispatcher({"bid": handler})
+    dispatcher.queue = asyncio.Queue()
+    for body in ['{"offer_id": "1"}', '{"offer_id": "1", "amount": 10}']:
+        dispatcher.queue.put_nowait(
+            Message(to="hub_agent@localhost", metadata={"conversation-id": "bid"}, body=body)
+        )
+
+    # when
+    await dispatcher.run()
+
+    # then
+    assert handler.decoded == [Bid("1", 10)]
+
+
+@pytest.mark.asyncio
+async def test_message_handler_survives_failing_messages():
+    # given
+    class BidHandler(MessageHandler):
+        metadata = {"conversation-id": "bid"}
+
+        def __init__(self):
+            super().__init__()
+            self.handled = []
+
+        async def handle(self, msg):
+            self.handled.append(msg.body)
+            raise OverflowError("amount too large")
+
+    handler = BidHandler()
+    handler.queue = asyncio.Queue()
+    handler.queue.put_nowait(
+        Message(to="hub_agent@localhost", metadata={"conversation-id": "bid"}, body="{}")
+    )
+
+    # when
+    await handler.run()
+
+    # then
+    assert handler.handled == ["{}"], "The failure should be logged, not raised"
+
+
+def test_codec_positional_round_trip():
+    # given
+    schema = codec.SCHEMAS["rental-offers"]
+    payload = {"offers": [{"starting_price": 100, "location": [52.2, 21.0]}]}
+
+    # when
+    packed = schema.to_list(payload)
+    decoded = schema.from_list(packed)
+
+    # then
+    assert packed == [[[100, [52.2, 21.0]]]]
+    assert decoded == codec.decode("rental-offers", codec.encode("rental-offers", payload))
+    assert codec.SCHEMAS["proxy-bid"].from_list(["3", 200]).increment == 1
+
+
+def test_codec_msgpack_is_smaller():
+    pytest.importorskip("msgpack")
+    # given
+    payload = {
+        "offer_id": "3",
+        "starting_price": 100,
+        "location": [52.2, 21.0],
+        "end_time": "2024-01-01T12:00:00",
+        "current_highest_bid": 100,
+    }
+
+    # when
+    body = codec.encode("auction-start", payload, codec.MSGPACK)
+
+    # then
+    assert len(body) < len(codec.encode("auction-start", payload))
+    assert codec.decode("auction-start", body, codec.MSGPACK).location == (52.2, 21.0)
+
+
+def test_codec_compact_encoding_through_stub_packer(monkeypatch):
+    # given
+    class JsonPacker:
+        """Stands in for msgpack, which the test environment may not have."""
+
+        @staticmethod
+        def packb(data):
+            return json.dumps(data).encode()
+
+        @staticmethod
+        def unpackb(packed):
+            return json.loads(packed)
+
+    monkeypatch.setattr(codec, "msgpack", JsonPacker)
+    payload = {
+        "offers": [
+            {"starting_price": 100, "location": [52.2, 21.0]},
+            {"starting_price": 150.0, "location": [52.3, 21.1]},
+        ]
+    }
+
+    # when
+    body = codec.encode("rental-offers", payload, codec.MSGPACK)
+    decoded = codec.decode("rental-offers", body, codec.MSGPACK)
+
+    # then
+    assert json.loads(base64.b64decode(body)) == [[[100, [52.2, 21.0]], [150.0, [52.3, 21.1]]]]
+    assert decoded == codec.decode("rental-offers", codec.encode("rental-offers", payload))
+    assert decoded.offers[1].starting_price == 150
+    with pytest.raises(MessageError):
+        codec.decode("rental-offers", "not base64!", codec.MSGPACK)
+
+
+def test_tenant_dispatches_published_auction_events():
+    # given
+    from agents.common.pubsub import AuctionEvent
+    from agents.future_tenant.main import FutureTenantAgent
+
+    tenant = FutureTenantAgent("future_tenant0@localhost", "password", asyncio.Queue())
+    dispatched = []
+    tenant.dispatch = dispatched.append
+    tenant.standing_bids[None, "0"] = 120
+
+    class Item:
+        def __init__(self, conversation_id, payload):
+            self.registered_payload = AuctionEvent(
+                conversation_id, codec.encode(conversation_id, payload)
+            )
+
+    # when
+    for conversation_id, payload in [
+        ("outbid-notification", {"offer_id": "0", "current_highest_bid": 120}),
+        ("outbid-notification", {"offer_id": "0", "current_highest_bid": 130}),
+        ("auction-stop", {"offer_id": "0"}),
+    ]:
+        tenant.on_auction_event("pubsub.localhost", "auction/0", Item(conversation_id, payload))
+
+    # then
+    assert [msg.get_metadata("conversation-id") for msg in dispatched] == [
+        "outbid-notification",
+        "auction-stop",
+    ], "The tenant leading at 120 should only hear of the higher bid"
+    assert codec.decode_message(dispatched[0]).current_highest_bid == 130
+
+
+@pytest.mark.asyncio
+async def test_tenant_gateway_reports_events_per_identity():
+    # given
+    from agents.common import gateway
+    from agents.future_tenant.main import FutureTenantAgent
+
+    events = asyncio.Queue()
+    tenants = FutureTenantAgent("tenant_gateway@localhost", "password", events)
+    tenants.identities.update({"tenant_1", "tenant_2"})
+    handler = FutureTenantAgent.AuctionStart()
+    handler.set_agent(tenants)
+    payload = {"offer_id": "0", "starting_price": 100, "location": [52.2, 21.0], "end_time": ""}
+
+    # when
+    for to, identity in [
+        ("tenant_gateway@localhost", "tenant_1"),
+        # sent before the hub learned the route
+        ("tenant_gateway@localhost/tenant_2", None),
+    ]:
+        msg = codec.message(to, "auction-start", payload)
+        await handler.handle(gateway.with_identity(msg, identity))
+
+    # then
+    reported = [events.get_nowait()["agent"] for _ in range(2)]
+    assert [jid.localpart for jid in reported] == ["tenant_1", "tenant_2"]
+    assert set(tenants.standing_bids) == {("tenant_1", "0"), ("tenant_2", "0")}
+
+
+def test_citizen_service_reports_delivery(monkeypatch):
+    # given
+    from agents.citizen.main import CitizenAgent, CitizenService, ServiceDemand
+
+    async def connect(agent):
+        pass
+
+    monkeypatch.setattr(CitizenAgent, "_async_register", connect)
+    monkeypatch.setattr(CitizenAgent, "_async_connect", connect)
+    runtime = AgentRuntime(loops=2)
+    loopback = Loopback()
+    hub = LoopbackAgent("hub_agent@localhost")
+    service = CitizenService(runtime)
+    runtime.start(hub).result(timeout=5)
+    service.started.result(timeout=5)
+    for agent in (hub, service.agent):
+
+        async def register(agent=agent):
+            loopback.register(agent)
+
+        runtime.submit(agent, register()).result(timeout=5)
+
+    # when
+    delivery = service.submit(ServiceDemand((52.2, 21.0), "Żabka", "High"))
+
+    # then
+    assert delivery.result(timeout=5) is True
+    assert hub.received.is_set()
+    runtime.shutdown()
+
+
+def test_citizen_service_fails_deliveries_when_agent_cannot_start(monkeypatch):
+    # given
+    from agents.citizen.main import CitizenAgent, CitizenService, ServiceDemand
+
+    async def connect(agent):
+        await asyncio.sleep(0.1)
+        raise ConnectionRefusedError("no XMPP server")
+
+    monkeypatch.setattr(CitizenAgent, "_async_register", connect)
+    runtime = AgentRuntime(loops=1)
+    demand = ServiceDemand((52.2, 21.0), "Żabka", "High")
+
+    # when
+    service = CitizenService(runtime)
+    before_failure = service.submit(demand)
+    with pytest.raises(ConnectionRefusedError):
+        service.started.result(timeout=5)
+    after_failure = service.submit(demand)
+
+    # then
+    for delivery in (before_failure, after_failure):
+        assert isinstance(delivery.exception(timeout=5), ConnectionRefusedError)
+    runtime.shutdown()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Condition not met in time"
+        time.sleep(0.01)
+
+
+def test_agent_pool_hands_out_started_agents_and_refills():
+    # given
+    runtime = AgentRuntime(loops=1)
+    pool = AgentPool(LoopbackAgent, runtime, size=3, refill_at=1, prefix="tenant")
+    wait_until(lambda: len(pool.ready) == 3)
+
+    # when
+    first, second = pool.claim(), pool.claim()
+
+    # then
+    assert first.started_on is not None and second.started_on is not None
+    assert first.jid != second.jid
+    assert first.jid.localpart.startswith("tenant_")
+    wait_until(lambda: len(pool.ready) == 3)
+
+    pool.close()
+    assert pool.claim() is None, "A closed pool should hand out nothing"
+    runtime.shutdown()
@@ -0,0 +1,401 @@
+import math
+import sqlite3
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple
+
+from agents.hub.model import RentalOffer, RentalRequest
+from agents.hub.spatial_index import CLOSE_DISTANCE, is_close
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS offers (
+    id INTEGER PRIMARY KEY,
+    agent_jid TEXT NOT NULL,
+    starting_price INTEGER NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    cell_x INTEGER NOT NULL,
+    cell_y INTEGER NOT NULL,
+    expires_at TEXT
+);
+CREATE INDEX IF NOT EXISTS offers_by_cell_price
+    ON offers (cell_x, cell_y, starting_price);
+CREATE INDEX IF NOT EXISTS offers_by_expiry
+    ON offers (expires_at) WHERE expires_at IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY,
+    agent_jid TEXT NOT NULL,
+    min_price INTEGER NOT NULL,
+    max_price INTEGER NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    cell_x INTEGER NOT NULL,
+    cell_y INTEGER NOT NULL,
+    service_type TEXT,
+    expires_at TEXT
+);
+CREATE INDEX IF NOT EXISTS requests_by_cell_price
+    ON requests (cell_x, cell_y, min_price, max_price);
+CREATE INDEX IF NOT EXISTS requests_by_expiry
+    ON requests (expires_at) WHERE expires_at IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS bids (
+    offer_id INTEGER NOT NULL,
+    bidder_jid TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    placed_at TEXT NOT NULL,
+    PRIMARY KEY (offer_id, bidder_jid)
+);
+CREATE INDEX IF NOT EXISTS bids_by_bidder ON bids (bidder_jid);
+
+CREATE TABLE IF NOT EXISTS completed_auctions (
+    offer_id INTEGER PRIMARY KEY,
+    landlord_jid TEXT NOT NULL,
+    winner_jid TEXT,
+    final_price INTEGER,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    cell_x INTEGER NOT NULL,
+    cell_y INTEGER NOT NULL,
+    completed_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS completed_auctions_by_time
+    ON completed_auctions (completed_at);
+CREATE INDEX IF NOT EXISTS completed_auctions_by_cell
+    ON completed_auctions (cell_x, cell_y);
+
+-- Journal input the committed state is at, see SqliteStore.snapshot
+CREATE TABLE IF NOT EXISTS checkpoint (seq INTEGER);
+INSERT INTO checkpoint SELECT NULL WHERE NOT EXISTS (SELECT 1 FROM checkpoint);
+"""
+
+# Statements are kept as constants so sqlite3's statement cache prepares each
+# of them once per connection.
+INSERT_OFFER = (
+    "INSERT OR REPLACE INTO offers"
+    " (id, agent_jid, starting_price, lat, lon, cell_x, cell_y, expires_at)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+DELETE_OFFER = "DELETE FROM offers WHERE id = ?"
+SELECT_OFFER = "SELECT agent_jid, starting_price, lat, lon FROM offers WHERE id = ?"
+SELECT_OFFERS = "SELECT id, agent_jid, starting_price, lat, lon FROM offers"
+COUNT_OFFERS = "SELECT count(*) FROM offers"
+OFFERS_IN_PRICE_RANGE = (
+    "SELECT id, agent_jid, starting_price, lat, lon FROM offers"
+    " WHERE cell_x IN (?, ?, ?) AND cell_y IN (?, ?, ?)"
+    " AND starting_price BETWEEN ? AND ?"
+    " ORDER BY starting_price"
+)
+
+INSERT_REQUEST = (
+    "INSERT OR REPLACE INTO requests"
+    " (id, agent_jid, min_price, max_price, lat, lon, cell_x, cell_y, service_type,"
+    " expires_at)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+DELETE_REQUEST = "DELETE FROM requests WHERE id = ?"
+SELECT_REQUEST = (
+    "SELECT agent_jid, min_price, max_price, lat, lon, service_type"
+    " FROM requests WHERE id = ?"
+)
+SELECT_REQUESTS = (
+    "SELECT id, agent_jid, min_price, max_price, lat, lon, service_type FROM requests"
+)
+COUNT_REQUESTS = "SELECT count(*) FROM requests"
+REQUESTS_COVERING_PRICE = (
+    "SELECT id, agent_jid, min_price, max_price, lat, lon, service_type FROM requests"
+    " WHERE cell_x IN (?, ?, ?) AND cell_y IN (?, ?, ?)"
+    " AND min_price <= ? AND max_price >= ?"
+)
+
+# Expiry times are stored as fixed-width ISO strings, so they sort by time
+EXPIRED_OFFERS = (
+    "SELECT id FROM offers WHERE expires_at IS NOT NULL AND expires_at <= ?"
+)
+EXPIRED_REQUESTS = (
+    "SELECT id FROM requests WHERE expires_at IS NOT NULL AND expires_at <= ?"
+)
+NEXT_EXPIRY = (
+    "SELECT min("
+    " coalesce((SELECT min(expires_at) FROM offers WHERE expires_at IS NOT NULL), '~'),"
+    " coalesce((SELECT min(expires_at) FROM requests WHERE expires_at IS NOT NULL), '~')"
+    ")"
+)
+
+INSERT_BID = (
+    "INSERT OR REPLACE INTO bids (offer_id, bidder_jid, amount, placed_at)"
+    " VALUES (?, ?, ?, ?)"
+)
+INSERT_COMPLETED_AUCTION = (
+    "INSERT OR REPLACE INTO completed_auctions"
+    " (offer_id, landlord_jid, winner_jid, final_price, lat, lon, cell_x, cell_y, completed_at)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+NEXT_IDS = (
+    "SELECT max("
+    " coalesce((SELECT max(id) FROM offers), -1),"
+    " coalesce((SELECT max(offer_id) FROM completed_auctions), -1)"
+    ") + 1, coalesce((SELECT max(id) FROM requests), -1) + 1"
+)
+
+
+def _timestamp(moment: Optional[datetime]) -> Optional[str]:
+    if moment is None:
+        return None
+    return moment.isoformat(timespec="microseconds")
+
+
+def _offer(agent_jid, starting_price, lat, lon) -> RentalOffer:
+    return RentalOffer(agent_jid=agent_jid, starting_price=starting_price, location=(lat, lon))
+
+
+def _request(agent_jid, min_price, max_price, lat, lon, service_type) -> RentalRequest:
+    return RentalRequest(
+        min_price=min_price,
+        max_price=max_price,
+        location=(lat, lon),
+        agent_jid=agent_jid,
+        service_type=service_type,
+    )
+
+
+class _Table(Mapping):
+    """Read-only mapping view of the offers or requests table."""
+
+    def __init__(self, store, select_one, select_all, count, key, build):
+        self.store = store
+        self.select_one = select_one
+        self.select_all = select_all
+        self.count = count
+        self.key = key
+        self.build = build
+
+    def __getitem__(self, key):
+        try:
+            row_id = int(key)
+        except (TypeError, ValueError):
+            raise KeyError(key)
+        row = self.store.conn.execute(self.select_one, (row_id,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self.build(*row)
+
+    def __iter__(self):
+        for row in self.store.conn.execute(self.select_all):
+            yield self.key(row[0])
+
+    def __len__(self):
+        return self.store.conn.execute(self.count).fetchone()[0]
+
+    def items(self):
+        return [
+            (self.key(row[0]), self.build(*row[1:]))
+            for row in self.store.conn.execute(self.select_all)
+        ]
+
+
+class SqliteStore:
+    """Offers, requests and auction history kept in a SQLite database.
+
+    Implements the same methods as ``agents.hub.store.MemoryStore``. Offers
+    and requests are indexed by grid cell and price, so matching is a range
+    scan over the nine cells around a location. Writes go into an open
+    transaction that is committed every ``batch_size`` writes or on
+    ``flush``; the database runs in WAL mode so readers are not blocked by
+    the writer. Once snapshotted for a journal, writes are only committed at
+    the journal's snapshots, see ``snapshot``.
+    """
+
+    def __init__(self, path: str, batch_size: int = 256, cell_size: float = CLOSE_DISTANCE):
+        self.path = path
+        self.batch_size = batch_size
+        self.cell_size = cell_size
+        self.pending = 0
+        self.checkpointed = False
+        self.conn = sqlite3.connect(path, cached_statements=64)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.offers = _Table(self, SELECT_OFFER, SELECT_OFFERS, COUNT_OFFERS, str, _offer)
+        self.requests = _Table(
+            self, SELECT_REQUEST, SELECT_REQUESTS, COUNT_REQUESTS, int, _request
+        )
+
+    def cell(self, location) -> Tuple[int, int]:
+        return (
+            math.floor(location[0] / self.cell_size),
+            math.floor(location[1] / self.cell_size),
+        )
+
+    def neighbour_cells(self, location) -> Tuple[int, ...]:
+        row, col = self.cell(location)
+        return (row - 1, row, row + 1, col - 1, col, col + 1)
+
+    def next_ids(self) -> Tuple[int, int]:
+        return self.conn.execute(NEXT_IDS).fetchone()
+
+    def _written(self, count=1):
+        self.pending += count
+        if self.pending >= self.batch_size and not self.checkpointed:
+            self.flush()
+
+    def add_offer(
+        self, offer_id: str, offer: RentalOffer, expires_at: Optional[datetime] = None
+    ):
+        lat, lon = offer.location
+        self.conn.execute(
+            INSERT_OFFER,
+            (
+                int(offer_id),
+                offer.agent_jid,
+                offer.starting_price,
+                lat,
+                lon,
+                *self.cell(offer.location),
+                _timestamp(expires_at),
+            ),
+        )
+        self._written()
+
+    def remove_offer(self, offer_id: str):
+        self.conn.execute(DELETE_OFFER, (int(offer_id),))
+        self._written()
+
+    def add_request(
+        self, request_id: int, request: RentalRequest, expires_at: Optional[datetime] = None
+    ):
+        lat, lon = request.location
+        self.conn.execute(
+            INSERT_REQUEST,
+            (
+                request_id,
+                request.agent_jid,
+                request.min_price,
+                request.max_price,
+                lat,
+                lon,
+                *self.cell(request.location),
+                request.service_type,
+                _timestamp(expires_at),
+            ),
+        )
+        self._written()
+
+    def remove_request(self, request_id: int):
+        self.conn.execute(DELETE_REQUEST, (request_id,))
+        self._written()
+
+    def next_expiry(self) -> Optional[datetime]:
+        (expires_at,) = self.conn.execute(NEXT_EXPIRY).fetchone()
+        return None if expires_at == "~" else datetime.fromisoformat(expires_at)
+
+    def pop_expired(self, now: datetime) -> List[Tuple[str, Hashable]]:
+        """Expired ``("offer", offer_id)`` and ``("request", request_id)`` keys."""
+        now = _timestamp(now)
+        expired = [
+            ("offer", str(offer_id))
+            for (offer_id,) in self.conn.execute(EXPIRED_OFFERS, (now,))
+        ]
+        expired += [
+            ("request", request_id)
+            for (request_id,) in self.conn.execute(EXPIRED_REQUESTS, (now,))
+        ]
+        return expired
+
+    def offers_in_price_range(self, location, low, high) -> Iterator[Tuple[str, RentalOffer]]:
+        for offer_id, *row in self.conn.execute(
+            OFFERS_IN_PRICE_RANGE, (*self.neighbour_cells(location), low, high)
+        ):
+            offer = _offer(*row)
+            if is_close(offer.location, location):
+                yield str(offer_id), offer
+
+    def requests_covering_price(self, location, price) -> Iterator[Tuple[int, RentalRequest]]:
+        for request_id, *row in self.conn.execute(
+            REQUESTS_COVERING_PRICE, (*self.neighbour_cells(location), price, price)
+        ):
+            request = _request(*row)
+            if is_close(request.location, location):
+                yield request_id, request
+
+    def requests_covering_prices(self, offers) -> List[List[Tuple[int, RentalRequest]]]:
+        """Requests matching each of ``offers``."""
+        return [
+            list(self.requests_covering_price(offer.location, offer.starting_price))
+            for offer in offers
+        ]
+
+    def requests_by_id(self, request_ids) -> Dict[int, RentalRequest]:
+        """The requests among ``request_ids`` that still stand."""
+        found = {}
+        for request_id in request_ids:
+            request = self.requests.get(request_id)
+            if request is not None:
+                found[request_id] = request
+        return found
+
+    def archive_auction(self, offer_id: str, auction, winner, now: datetime):
+        lat, lon = auction.offer.location
+        self.conn.executemany(
+            INSERT_BID,
+            [
+                (int(offer_id), bid.bidder_jid, bid.amount, _timestamp(bid.timestamp))
+                for bid in auction.bids
+            ],
+        )
+        self.conn.execute(
+            INSERT_COMPLETED_AUCTION,
+            (
+                int(offer_id),
+                auction.offer.agent_jid,
+                winner.bidder_jid if winner else None,
+                winner.amount if winner else None,
+                lat,
+                lon,
+                *self.cell(auction.offer.location),
+                _timestamp(now),
+            ),
+        )
+        self._written(len(auction.bids) + 1)
+
+    def flush(self):
+        if self.pending:
+            self.conn.commit()
+            self.pending = 0
+
+    def snapshot(self, tag=None) -> dict:
+        """Tags the open transaction with the journal input ``tag``.
+
+        The database is its own snapshot: the next ``flush`` commits the
+        writes up to ``tag`` together with ``tag`` itself, and from then on
+        writes are only committed at snapshots, so the committed state is
+        always the one of the last snapshot and the journal replays the rest.
+        """
+        self.checkpointed = True
+        self.conn.execute("UPDATE checkpoint SET seq = ?", (tag,))
+        self.pending += 1
+        return {"seq": tag}
+
+    def restore(self, state: dict):
+        """Drops uncommitted writes, the journal replays them.
+
+        Raises ``ValueError`` when the committed state is not the one of the
+        snapshot ``state`` was taken at.
+        """
+        self.conn.rollback()
+        self.pending = 0
+        (seq,) = self.conn.execute("SELECT seq FROM checkpoint").fetchone()
+        if seq != state["seq"]:
+            raise ValueError(f"{self.path} is at input #{seq}, not #{state['seq']}")
+        self.checkpointed = True
+
+    def close(self):
+        # Past a snapshot the journal holds what was not committed
+        if self.checkpointed:
+            self.conn.rollback()
+        else:
+            self.flush()
+        self.conn.close()
@@ -41,6 +41,10 @@ async def main(page: ft.Page):
                             f"{event['agent'].localpart} completed with final price: {final_price}"
                         )
                     )
+                case "offer-expired":
+                    page.snack_bar = ft.SnackBar(
+                        content=ft.Text(f"{event['agent'].localpart} has expired")
+                    )
 
     asyncio.create_task(poll_events())
 
@@ -478,7 +482,8 @@ async def main(page: ft.Page):
         )
 
         details = RentalOfferDetails(
-            starting_price=float(price_lower.value),
+            # The hub deals in whole currency units
+            starting_price=round(float(price_lower.value)),
             location=[coordinates["lat"], coordinates["lng"]],
         )
 
@@ -57,6 +57,8 @@ async def main(page: ft.Page):
                     open_confirmation_modal(event["agent"].localpart, offer_id, bid_amount)
                 case "auction-lost":
                     page.snack_bar = ft.SnackBar(content=ft.Text("You have lost the auction!"))
+                case "request-expired":
+                    page.snack_bar = ft.SnackBar(content=ft.Text("Your rental request has expired!"))
 
     asyncio.create_task(poll_events())
 
@@ -346,15 +348,16 @@ async def main(page: ft.Page):
         state["current_offer_idx"] += 1
 
         details = TenantOfferDetails(
-            min_price=float(min_price.value),
-            max_price=float(max_price.value),
+            # The hub deals in whole currency units
+            min_price=round(float(min_price.value)),
+            max_price=round(float(max_price.value)),
             location=(coordinates["lat"], coordinates["lng"]),
+            service_type=service or None,
         )
-        agent_id = f"tenant_{uuid.uuid4().hex[:8]}"
+        # A tenant claimed from the pool keeps its own id
+        agent_id = agents.register_tenant(f"tenant_{uuid.uuid4().hex[:8]}", details)
         state["offers"].append({"agent_id": agent_id, "offer_id": None})
 
-        agents.register_tenant(agent_id, details)
-
         # Clear form fields...
         tenant_name.value = ""
         street.value = ""
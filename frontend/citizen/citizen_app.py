@@ -7,9 +7,11 @@ from geopy.geocoders import Nominatim
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'database')))
 
-from agents.citizen.main import run_citizen_agent, ServiceDemand
+from agents.citizen.main import CitizenService, ServiceDemand
 from system_data import SERVICE_OPTIONS, PREMISE_DEMAND_PRIORITY
 
+citizen_service = CitizenService()
+
 def main(page: ft.Page):
     page.title = "Service Request Form"
     page.vertical_alignment = ft.MainAxisAlignment.START
@@ -124,7 +126,14 @@ def main(page: ft.Page):
             priority=priority_input.value
         )
 
-        run_citizen_agent(service_demand)
+        delivery = citizen_service.submit(service_demand)
+
+        def on_delivered(delivery):
+            if delivery.exception():
+                page.overlay.append(ft.SnackBar(content=ft.Text("Could not send your request!"), open=True))
+                page.update()
+
+        delivery.add_done_callback(on_delivered)
 
         # Clear all fields after successful submission
         name_input.value = ""
@@ -0,0 +1,1239 @@
+import asyncio
+import itertools
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from spade.message import Message
+
+from agents.common import gateway
+from agents.common.shards import ShardMap
+from agents.hub.archive import AuctionArchive
+from agents.hub.bid_book import BidBook
+from agents.hub.clearing import auction_assignment, solve
+from agents.hub.columns import ColumnStore
+from agents.hub.demand import DemandGrid
+from agents.hub.journal import Journal
+from agents.hub.main import Bid, HubAgent, RentalOffer, RentalRequest
+from agents.hub.market import Market, Notification
+from agents.hub.outbox import Outbox, PubSubOutbox
+from agents.hub.price_index import IntervalTree
+from agents.hub.scheduler import DeadlineScheduler
+from agents.hub.simulation import Population, Simulation
+from agents.hub.spatial_index import OfferIndex, RequestIndex, SpatialIndex, is_close
+from agents.hub.store import MemoryStore
+from agents.hub.workers import MatchingPool
+from database.store import SqliteStore
+
+
+def get_offer(location, starting_price=100) -> RentalOffer:
+    return RentalOffer(
+        agent_jid="premise_for_rent_agent@localhost",
+        starting_price=starting_price,
+        location=location,
+    )
+
+
+def get_request(location, min_price=50, max_price=200) -> RentalRequest:
+    return RentalRequest(
+        min_price=min_price,
+        max_price=max_price,
+        location=location,
+        agent_jid="future_tenant@localhost",
+    )
+
+
+def test_spatial_index_nearby_matches_is_close():
+    # given
+    index = SpatialIndex()
+    locations = [
+        (52.2297, 21.0117),
+        (52.2391, 21.0117),
+        (52.2399, 21.0199),
+        (52.2197, 21.0017),
+        (52.2497, 21.0117),
+    ]
+    for i, location in enumerate(locations):
+        index.insert(i, get_offer(location))
+
+    # when
+    found = {key for key, _ in index.nearby((52.2300, 21.0120))}
+
+    # then
+    expected = {
+        i for i, location in enumerate(locations) if is_close(location, (52.2300, 21.0120))
+    }
+    assert found == expected, "Index should return exactly the close items"
+
+
+def test_spatial_index_remove():
+    # given
+    index = SpatialIndex()
+    offer = get_offer((52.2297, 21.0117))
+    index.insert("0", offer)
+
+    # when
+    index.remove("0", offer)
+
+    # then
+    assert len(index) == 0, "Removed item should not be counted"
+    assert list(index.nearby(offer.location)) == [], "Removed item should not be found"
+
+
+def test_interval_tree_covering_after_removals():
+    # given
+    rng = random.Random(0)
+    tree = IntervalTree(lambda request: (request.min_price, request.max_price))
+    requests = {}
+    for i in range(500):
+        low = rng.randint(0, 1000)
+        requests[i] = get_request((0.0, 0.0), min_price=low, max_price=low + rng.randint(0, 300))
+        tree.add(i, requests[i])
+    for i in range(0, 500, 3):
+        tree.discard(i)
+        del requests[i]
+
+    # when
+    found = {key for key, _ in tree.covering(600)}
+
+    # then
+    expected = {
+        i for i, request in requests.items() if request.min_price <= 600 <= request.max_price
+    }
+    assert found == expected, "Tree should return exactly the ranges covering the price"
+
+
+def test_offer_index_in_price_range():
+    # given
+    index = OfferIndex()
+    index.insert("0", get_offer((52.2297, 21.0117), starting_price=90))
+    index.insert("1", get_offer((52.2298, 21.0118), starting_price=150))
+    index.insert("2", get_offer((52.2299, 21.0119), starting_price=300))
+    index.insert("3", get_offer((52.3000, 21.0119), starting_price=150))
+
+    # when
+    found = {key for key, _ in index.in_price_range((52.2297, 21.0117), 100, 200)}
+
+    # then
+    assert found == {"1"}, "Only close offers within the price range should match"
+
+
+def test_request_index_covering_price():
+    # given
+    index = RequestIndex()
+    index.insert(0, get_request((52.2297, 21.0117), min_price=50, max_price=200))
+    index.insert(1, get_request((52.2297, 21.0117), min_price=150, max_price=200))
+    index.insert(2, get_request((52.3000, 21.0117), min_price=50, max_price=200))
+
+    # when
+    found = {key for key, _ in index.covering_price((52.2297, 21.0117), 100)}
+
+    # then
+    assert found == {0}, "Only close requests covering the price should match"
+
+
+def test_deadline_scheduler_pops_only_due_keys():
+    # given
+    scheduler = DeadlineScheduler()
+    now = datetime(2024, 1, 1, 12, 0, 0)
+    scheduler.schedule("0", now + timedelta(seconds=5))
+    scheduler.schedule("1", now + timedelta(seconds=1))
+    scheduler.schedule("2", now + timedelta(seconds=10))
+
+    # when
+    due = scheduler.pop_due(now + timedelta(seconds=5))
+
+    # then
+    assert due == ["1", "0"], "Due keys should pop in deadline order"
+    assert scheduler.next_deadline() == now + timedelta(seconds=10)
+
+
+def test_deadline_scheduler_moves_deadline_earlier():
+    # given
+    scheduler = DeadlineScheduler()
+    now = datetime(2024, 1, 1, 12, 0, 0)
+    scheduler.schedule("0", now + timedelta(seconds=10))
+
+    # when
+    scheduler.schedule("0", now + timedelta(seconds=2))
+    scheduler.schedule("0", now + timedelta(seconds=30))
+
+    # then
+    assert scheduler.next_deadline() == now + timedelta(seconds=2)
+    assert scheduler.pop_due(now + timedelta(seconds=60)) == ["0"], "Key should pop once"
+    assert len(scheduler) == 0
+
+
+def get_bid(bidder_jid, amount, timestamp) -> Bid:
+    return Bid(
+        request=get_request((52.2297, 21.0117)),
+        bidder_jid=bidder_jid,
+        amount=amount,
+        timestamp=timestamp,
+    )
+
+
+def test_bid_book_ranks_and_replaces_bids():
+    # given
+    now = datetime(2024, 1, 1, 12, 0, 0)
+    book = BidBook(
+        [
+            get_bid("a@localhost", 100, now),
+            get_bid("b@localhost", 100, now + timedelta(seconds=1)),
+            get_bid("c@localhost", 100, now + timedelta(seconds=2)),
+        ]
+    )
+
+    # when
+    book.place(get_bid("c@localhost", 140, now + timedelta(seconds=3)))
+
+    # then
+    assert len(book) == 3, "Bidder should keep a single bid"
+    assert [bid.bidder_jid for bid in book] == ["c@localhost", "a@localhost", "b@localhost"]
+    assert book.highest().amount == 140
+    assert book.rank_of("b@localhost") == 2
+    assert [bid.bidder_jid for bid in book.below(140)] == ["a@localhost", "b@localhost"]
+
+
+class RecordingBehaviour:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, msg):
+        await asyncio.sleep(0)
+        self.sent.append(msg)
+
+
+@pytest.mark.asyncio
+async def test_outbox_broadcast_serializes_once():
+    # given
+    outbox = Outbox(max_concurrency=2)
+    behaviour = RecordingBehaviour()
+    recipients = [f"future_tenant{i}@localhost" for i in range(5)]
+
+    # when
+    report = await outbox.broadcast(
+        behaviour, recipients, "auction-stop", {"offer_id": "0"}
+    )
+
+    # then
+    assert sorted(str(msg.to) for msg in behaviour.sent) == recipients
+    assert len({id(msg.body) for msg in behaviour.sent}) == 1, "Body should be shared"
+    assert behaviour.sent[0].get_metadata("conversation-id") == "auction-stop"
+    assert report.recipients == 5 and report.failed == 0
+
+
+@pytest.mark.asyncio
+async def test_outbox_routes_gateway_identities_through_their_gateway():
+    # given
+    inbound = Message(
+        to="hub_agent@localhost",
+        sender="tenant_gateway@localhost/session",
+        metadata={"conversation-id": "bid", gateway.IDENTITY: "tenant_1"},
+    )
+    sender, is_identity = gateway.sender_of(inbound)
+    outbox = Outbox(identities={sender})
+    behaviour = RecordingBehaviour()
+
+    # when
+    await outbox.broadcast(
+        behaviour, [sender, "future_tenant0@localhost"], "auction-stop", {"offer_id": "0"}
+    )
+
+    # then
+    assert (sender, is_identity) == ("tenant_gateway@localhost/tenant_1", True)
+    routed = {str(msg.to): msg.get_metadata(gateway.IDENTITY) for msg in behaviour.sent}
+    assert routed == {
+        "tenant_gateway@localhost": "tenant_1",
+        "future_tenant0@localhost": None,
+    }
+
+
+class RecordingPubSub:
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, jid, node):
+        self.calls.append(("create", node))
+
+    async def set_node_config(self, jid, config, node):
+        self.calls.append(("configure", node))
+
+    async def change_node_affiliations(self, jid, node, affiliations):
+        self.calls.append(("affiliate", node, len(affiliations)))
+
+    async def change_node_subscriptions(self, jid, node, subscriptions):
+        self.calls.append(("subscribe", node, len(subscriptions)))
+
+    async def publish(self, jid, node, event):
+        self.calls.append(("publish", node, event.conversation_id))
+
+    async def delete(self, jid, node):
+        self.calls.append(("delete", node))
+
+
+@pytest.mark.asyncio
+async def test_pubsub_outbox_publishes_large_auctions_once():
+    # given
+    outbox = PubSubOutbox(min_subscribers=3)
+    outbox.client = RecordingPubSub()
+    behaviour = RecordingBehaviour()
+    bidders = [f"future_tenant{i}@localhost" for i in range(3)]
+    start = {"offer_id": "0", "starting_price": 100, "location": [52.2, 21.0], "end_time": ""}
+    joined = {**start, "current_highest_bid": 110}
+    outbid = {"offer_id": "0", "current_highest_bid": 120}
+
+    # when
+    await outbox.deliver(
+        behaviour,
+        [
+            Notification(bidders, "auction-start", start),
+            Notification(["late@localhost"], "auction-start", joined),
+            Notification(bidders[:2], "outbid-notification", outbid),
+            Notification(["small@localhost"], "auction-start", {**start, "offer_id": "1"}),
+            Notification([*bidders, "late@localhost"], "auction-stop", {"offer_id": "0"}),
+        ],
+    )
+
+    # then
+    assert outbox.client.calls == [
+        ("create", "auction/0"),
+        ("configure", "auction/0"),
+        ("affiliate", "auction/0", 3),
+        ("subscribe", "auction/0", 3),
+        ("publish", "auction/0", "auction-start"),
+        ("affiliate", "auction/0", 1),
+        ("subscribe", "auction/0", 1),
+        ("publish", "auction/0", "outbid-notification"),
+        ("publish", "auction/0", "auction-stop"),
+        ("delete", "auction/0"),
+    ]
+    assert [str(msg.to) for msg in behaviour.sent] == ["late@localhost", "small@localhost"]
+    assert outbox.nodes == {}
+
+
+def test_demand_grid_counts_close_votes_per_service():
+    # given
+    demand = DemandGrid()
+    demand.add_vote("Pharmacy", (52.2297, 21.0117))
+    demand.add_vote("Pharmacy", (52.2350, 21.0150))
+    demand.add_vote("Bakery", (52.2297, 21.0117))
+    demand.add_vote("Pharmacy", (52.3000, 21.0117))
+
+    # when
+    pharmacy = demand.votes((52.2300, 21.0120), "Pharmacy")
+    total = demand.votes((52.2300, 21.0120))
+
+    # then
+    assert pharmacy == 2, "Close pharmacy votes should be counted"
+    assert total == 3, "Close votes of every service should be counted"
+    assert demand.votes((53.0, 22.0), "Pharmacy") == 0
+
+
+LOCATION = [52.2297700, 21.0117800]
+
+
+def run_auction_inputs(apply, start):
+    apply("rental-offer", {"starting_price": 100, "location": LOCATION, "sender": "landlord@localhost"}, start)
+    apply(
+        "register-rental",
+        {"min_price": 50, "max_price": 200, "location": LOCATION, "sender": "tenant1@localhost"},
+        start + timedelta(seconds=1),
+    )
+    apply(
+        "register-rental",
+        {"min_price": 50, "max_price": 200, "location": LOCATION, "sender": "tenant2@localhost"},
+        start + timedelta(seconds=2),
+    )
+    return apply(
+        "bid",
+        {"offer_id": "0", "amount": 120, "sender": "tenant1@localhost"},
+        start + timedelta(seconds=3),
+    )
+
+
+def test_market_auction_lifecycle():
+    # given
+    market = Market(auction_time=timedelta(seconds=10), extend_duration=timedelta(seconds=5))
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    outbid = run_auction_inputs(market.apply, start)
+
+    # when
+    closing = market.apply("advance", {}, start + timedelta(seconds=12))
+    completed = market.apply(
+        "confirmation-response",
+        {"offer_id": "0", "confirmed": True, "sender": "tenant1@localhost"},
+        start + timedelta(seconds=13),
+    )
+
+    # then
+    assert [n.recipients for n in outbid] == [["tenant2@localhost"]]
+    assert [n.conversation_id for n in closing] == ["auction-stop", "confirmation-request"]
+    assert closing[1].recipients == ["tenant1@localhost"]
+    assert [n.conversation_id for n in completed] == ["auction-lost", "auction-completed"]
+    assert completed[1].payload == {"offer_id": "0", "final_price": 120}
+    assert market.active_auctions == {}
+    assert "0" not in market.rental_offers, "Let offer should leave the store"
+    assert [r.agent_jid for r in market.rental_requests.values()] == ["tenant2@localhost"]
+
+
+def test_journal_recovers_snapshot_and_log_tail(tmp_path):
+    # given
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    market = Market()
+    journal = Journal(str(tmp_path), snapshot_every=2)
+
+    def apply(kind, data, now):
+        journal.append(kind, data, now)
+        notifications = market.apply(kind, data, now)
+        journal.maybe_snapshot(market)
+        return notifications
+
+    run_auction_inputs(apply, start)
+    journal.close()
+
+    # when
+    recovered = Market()
+    replayed = Journal(str(tmp_path), snapshot_every=2).recover(recovered)
+
+    # then
+    assert replayed == 0, "Last input should be covered by a snapshot"
+    assert recovered.rental_offers == market.rental_offers
+    assert recovered.rental_requests == market.rental_requests
+    auction = recovered.active_auctions["0"]
+    assert [(bid.bidder_jid, bid.amount) for bid in auction.bids] == [
+        ("tenant1@localhost", 120),
+        ("tenant2@localhost", 100),
+    ]
+    assert recovered.deadlines.next_deadline() == auction.end_time
+    assert len(list(recovered.store.requests_covering_price(tuple(LOCATION), 100))) == 2
+
+
+def test_journal_appends_after_torn_tail(tmp_path):
+    # given
+    start = datetime(2024, 1, 1, 12, 0, 0)
+
+    def register(journal, count):
+        for i in range(count):
+            journal.append(
+                "register-rental",
+                {"min_price": 50, "max_price": 200, "location": LOCATION, "sender": f"t{i}@localhost"},
+                start,
+            )
+        journal.close()
+
+    journal = Journal(str(tmp_path))
+    journal.recover(Market())
+    register(journal, 3)
+    with open(tmp_path / "events.log", "a", encoding="utf-8") as log:
+        log.write('{"seq": 4, "at": "2024-')
+
+    # when
+    journal = Journal(str(tmp_path))
+    journal.recover(Market())
+    register(journal, 3)
+    recovered = Market()
+    replayed = Journal(str(tmp_path)).recover(recovered)
+
+    # then
+    assert replayed == 6, "Inputs logged after the torn line should survive"
+    assert len(recovered.rental_requests) == 6
+
+
+def test_journal_skips_inputs_that_fail_to_replay(tmp_path):
+    # given
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    journal = Journal(str(tmp_path))
+    journal.recover(Market())
+    for max_price in (200, 10**20, 300):
+        journal.append(
+            "register-rental",
+            {"min_price": 50, "max_price": max_price, "location": LOCATION, "sender": "t@localhost"},
+            start,
+        )
+    journal.close()
+
+    # when
+    recovered = [Market(), Market()]
+    replayed = [Journal(str(tmp_path)).recover(market) for market in recovered]
+
+    # then
+    assert replayed == [2, 2]
+    assert [r.max_price for r in recovered[1].rental_requests.values()] == [200, 300]
+
+
+def test_hub_journals_only_inputs_the_market_accepts(tmp_path):
+    # given
+    hub = HubAgent("hub_agent@localhost", "password", state_dir=str(tmp_path))
+    request = {"min_price": 50, "max_price": 200, "location": LOCATION, "sender": "t@localhost"}
+
+    # when
+    with pytest.raises(ValueError):
+        hub.apply("register-rental", {**request, "max_price": 10**20})
+    hub.apply("register-rental", request)
+    hub.journal.close()
+    restarted = HubAgent("hub_agent@localhost", "password", state_dir=str(tmp_path))
+
+    # then
+    assert [r.max_price for r in restarted.rental_requests.values()] == [200]
+    restarted.journal.close()
+
+
+def make_store(kind, tmp_path):
+    if kind == "sqlite":
+        return SqliteStore(str(tmp_path / "hub.db"), batch_size=16)
+    return ColumnStore()
+
+
+@pytest.mark.parametrize("kind", ["sqlite", "columns"])
+def test_market_stores_float_prices_as_whole_units(tmp_path, kind):
+    # given
+    market = Market(store=make_store(kind, tmp_path))
+    start = datetime(2024, 1, 1, 12, 0, 0)
+
+    # when
+    market.apply(
+        "register-rental",
+        {"min_price": 50.4, "max_price": 200.0, "location": LOCATION, "sender": "t@localhost"},
+        start,
+    )
+    started = market.apply(
+        "rental-offer",
+        {"starting_price": 1500.5 / 10, "location": LOCATION, "sender": "l@localhost"},
+        start,
+    )
+
+    # then
+    assert started[0].payload["starting_price"] == 150
+    assert type(market.rental_offers["0"].starting_price) is int
+    assert market.rental_requests[0].min_price == 50
+
+
+@pytest.mark.parametrize("kind", ["sqlite", "columns"])
+def test_store_matches_like_memory_store(tmp_path, kind):
+    # given
+    rng = random.Random(7)
+    memory = MemoryStore()
+    other = make_store(kind, tmp_path)
+    for i in range(200):
+        location = (52.2 + rng.random() * 0.1, 21.0 + rng.random() * 0.1)
+        offer = get_offer(location, starting_price=rng.randint(50, 300))
+        low = rng.randint(50, 200)
+        request = get_request(location, min_price=low, max_price=low + rng.randint(0, 100))
+        for store in (memory, other):
+            store.add_offer(str(i), offer)
+            store.add_request(i, request)
+    for i in range(0, 200, 3):
+        for store in (memory, other):
+            store.remove_offer(str(i))
+            store.remove_request(i)
+
+    # when
+    probes = [(52.2 + rng.random() * 0.1, 21.0 + rng.random() * 0.1) for _ in range(50)]
+
+    # then
+    assert len(other.offers) == len(memory.offers)
+    assert other.offers["1"] == memory.offers["1"]
+    assert other.requests == memory.requests
+    for probe in probes:
+        assert sorted(other.offers_in_price_range(probe, 100, 200)) == sorted(
+            memory.offers_in_price_range(probe, 100, 200), key=lambda item: item[0]
+        )
+        assert sorted(other.requests_covering_price(probe, 150)) == sorted(
+            memory.requests_covering_price(probe, 150), key=lambda item: item[0]
+        )
+
+
+def test_column_store_narrows_dense_cell_by_price():
+    # given
+    rng = random.Random(11)
+    memory = MemoryStore()
+    columns = ColumnStore()
+    for i in range(400):
+        location = (52.2 + rng.random() * 0.002, 21.0 + rng.random() * 0.002)
+        offer = get_offer(location, starting_price=rng.randint(50, 300))
+        low = rng.randint(50, 250)
+        request = get_request(location, min_price=low, max_price=low + rng.randint(0, 60))
+        for store in (memory, columns):
+            store.add_offer(str(i), offer)
+            store.add_request(i, request)
+    for i in range(0, 400, 4):
+        for store in (memory, columns):
+            store.remove_offer(str(i))
+            store.remove_request(i)
+
+    # when
+    probe = (52.201, 21.001)
+    prices = list(range(40, 320, 7))
+
+    # then
+    for block in columns.offer_blocks.values():
+        assert list(block.starting_price) == sorted(block.starting_price)
+    for block in columns.request_blocks.values():
+        assert list(block.min_price) == sorted(block.min_price)
+    for price in prices:
+        assert sorted(columns.offers_in_price_range(probe, price, price + 20)) == sorted(
+            memory.offers_in_price_range(probe, price, price + 20), key=lambda item: item[0]
+        )
+        assert sorted(columns.requests_covering_price(probe, price)) == sorted(
+            memory.requests_covering_price(probe, price), key=lambda item: item[0]
+        )
+    offers = [get_offer(probe, starting_price=price) for price in prices]
+    assert [sorted(found) for found in columns.requests_covering_prices(offers)] == [
+        sorted(memory.requests_covering_price(probe, price), key=lambda item: item[0])
+        for price in prices
+    ]
+
+
+@pytest.mark.parametrize("kind", ["sqlite", "columns"])
+def test_store_looks_up_standing_requests_by_id(tmp_path, kind):
+    # given
+    memory = MemoryStore()
+    other = make_store(kind, tmp_path)
+    for i in range(100):
+        request = get_request((52.2 + i * 1e-5, 21.0), min_price=i, max_price=i + 50)
+        for store in (memory, other):
+            store.add_request(i, request)
+    for i in range(0, 100, 3):
+        for store in (memory, other):
+            store.remove_request(i)
+
+    # when
+    found = other.requests_by_id([0, 1, 50, 98, 99, 1000])
+
+    # then
+    assert found == memory.requests_by_id([0, 1, 50, 98, 99, 1000])
+    assert sorted(found) == [1, 50, 98]
+    assert found[50].min_price == 50
+
+
+def test_sqlite_store_continues_ids(tmp_path):
+    # given
+    path = str(tmp_path / "hub.db")
+    store = SqliteStore(path)
+    for i in range(3):
+        store.add_offer(str(i), get_offer((52.2, 21.0)))
+        store.add_request(i, get_request((52.2, 21.0)))
+    store.remove_offer("2")
+    store.close()
+
+    # when
+    market = Market(store=SqliteStore(path))
+
+    # then
+    assert (market.next_offer_id, market.next_request_id) == (2, 3)
+
+
+def test_column_store_is_compact():
+    # given
+    store = ColumnStore()
+    request = get_request((52.2, 21.0))
+
+    # when
+    for i in range(100):
+        store.add_request(i, get_request((52.2 + i * 1e-5, 21.0)))
+
+    # then
+    (block,) = store.request_blocks.values()
+    assert len(block.lat) == 100 and block.lat.typecode == "d"
+    assert len(store.jids) == 1, "Repeated JIDs should be interned once"
+    assert not hasattr(request, "__dict__"), "Dataclasses should be slotted"
+
+
+def test_sqlite_store_archives_completed_auction(tmp_path):
+    # given
+    path = str(tmp_path / "hub.db")
+    market = Market(
+        auction_time=timedelta(seconds=10),
+        extend_duration=timedelta(seconds=5),
+        store=SqliteStore(path),
+    )
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    run_auction_inputs(market.apply, start)
+    market.apply("advance", {}, start + timedelta(seconds=12))
+
+    # when
+    market.apply(
+        "confirmation-response",
+        {"offer_id": "0", "confirmed": True, "sender": "tenant1@localhost"},
+        start + timedelta(seconds=13),
+    )
+    market.store.close()
+
+    # then
+    reopened = SqliteStore(path)
+    assert reopened.conn.execute(
+        "SELECT winner_jid, final_price FROM completed_auctions WHERE offer_id = 0"
+    ).fetchone() == ("tenant1@localhost", 120)
+    assert reopened.conn.execute("SELECT count(*) FROM bids").fetchone() == (2,)
+    assert reopened.next_ids() == (1, 2)
+
+
+def test_journal_recovers_sqlite_store(tmp_path):
+    # given
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    path = str(tmp_path / "hub.db")
+    market = Market(store=SqliteStore(path))
+    journal = Journal(str(tmp_path), snapshot_every=3)
+    for kind, data, now in [
+        ("rental-offer", {"starting_price": 100, "location": LOCATION, "sender": "l@localhost"}, start),
+        ("rental-offer", {"starting_price": 150, "location": LOCATION, "sender": "l@localhost"}, start),
+        ("rental-offer", {"starting_price": 900, "location": LOCATION, "sender": "l@localhost"}, start),
+        ("register-rental", {"min_price": 50, "max_price": 200, "location": LOCATION, "sender": "t@localhost"}, start),
+    ]:
+        journal.append(kind, data, now)
+        market.apply(kind, data, now)
+        journal.maybe_snapshot(market)
+    journal.close()
+    market.store.close()
+
+    # when
+    recovered = Market(store=SqliteStore(path))
+    replayed = Journal(str(tmp_path), snapshot_every=3).recover(recovered)
+
+    # then
+    assert replayed == 1
+    assert len(recovered.rental_offers) == 3
+    assert len(recovered.rental_requests) == 1, "Replayed request should not be stored twice"
+    assert sorted(recovered.active_auctions) == ["0", "1"]
+
+
+def test_journal_recovers_sqlite_store_before_first_snapshot(tmp_path):
+    # given
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    path = str(tmp_path / "hub.db")
+    market = Market(store=SqliteStore(path))
+    journal = Journal(str(tmp_path))
+    journal.recover(market)
+    for price in (100, 150, 900):
+        data = {"starting_price": price, "location": LOCATION, "sender": "l@localhost"}
+        journal.append("rental-offer", data, start)
+        market.apply("rental-offer", data, start)
+    journal.close()
+    market.store.close()
+
+    # when
+    recovered = Market(store=SqliteStore(path))
+    replayed = Journal(str(tmp_path)).recover(recovered)
+
+    # then
+    assert replayed == 3
+    assert sorted(recovered.rental_offers) == ["0", "1", "2"], "Offers should not be stored twice"
+
+
+def test_journal_recovers_sqlite_store_not_flushed_at_last_snapshot(tmp_path, monkeypatch):
+    # given
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    path = str(tmp_path / "hub.db")
+    market = Market(store=SqliteStore(path, batch_size=1))
+    journal = Journal(str(tmp_path), snapshot_every=2)
+    journal.recover(market)
+    for price in (100, 150, 200, 250):
+        data = {"starting_price": price, "location": LOCATION, "sender": "l@localhost"}
+        market.apply("rental-offer", data, start)
+        journal.append("rental-offer", data, start)
+        if price < 250:
+            journal.maybe_snapshot(market)
+
+    def crash():
+        raise OSError("killed")
+
+    # Crash between writing the last snapshot and committing the store
+    monkeypatch.setattr(market.store, "flush", crash)
+    with pytest.raises(OSError):
+        journal.maybe_snapshot(market)
+    journal.close()
+    market.store.conn.close()
+
+    # when
+    recovered = Market(store=SqliteStore(path))
+    replayed = Journal(str(tmp_path)).recover(recovered)
+
+    # then
+    assert replayed == 2, "Inputs after the committed snapshot should be replayed"
+    assert sorted(recovered.rental_offers) == ["0", "1", "2", "3"]
+
+
+def test_journal_refuses_log_without_snapshot_on_filled_store(tmp_path):
+    # given
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    market = Market(store=SqliteStore(str(tmp_path / "hub.db")))
+    data = {"starting_price": 100, "location": LOCATION, "sender": "l@localhost"}
+    market.apply("rental-offer", data, start)
+    journal = Journal(str(tmp_path))
+    journal.append("rental-offer", data, start)
+    journal.close()
+
+    # when
+    reopened = Journal(str(tmp_path))
+
+    # then
+    with pytest.raises(RuntimeError):
+        reopened.recover(market)
+
+
+@pytest.mark.parametrize("sqlite", [False, True])
+def test_market_expires_offers_and_requests(tmp_path, sqlite):
+    # given
+    store = SqliteStore(str(tmp_path / "hub.db")) if sqlite else MemoryStore()
+    market = Market(
+        store=store, offer_ttl=timedelta(hours=2), request_ttl=timedelta(hours=1)
+    )
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    far_away = [10.0, 10.0]
+    market.apply(
+        "rental-offer",
+        {"starting_price": 100, "location": far_away, "sender": "l@localhost"},
+        start,
+    )
+    market.apply(
+        "register-rental",
+        {"min_price": 50, "max_price": 200, "location": LOCATION, "sender": "t@localhost"},
+        start + timedelta(minutes=30),
+    )
+
+    # when
+    first_sweep = market.apply("advance", {}, start + timedelta(hours=1))
+    offers_after_first_sweep = len(market.rental_offers)
+    second_sweep = market.apply("advance", {}, start + timedelta(hours=1, minutes=30))
+    requests_after_second_sweep = len(market.rental_requests)
+    third_sweep = market.apply("advance", {}, start + timedelta(hours=2))
+
+    # then
+    assert offers_after_first_sweep == 1
+    assert requests_after_second_sweep == 0
+    assert len(market.rental_offers) == 0
+    assert first_sweep == []
+    assert [(n.recipients, n.conversation_id) for n in second_sweep] == [
+        (["t@localhost"], "request-expired")
+    ]
+    assert second_sweep[0].payload["max_price"] == 200
+    assert [(n.recipients, n.conversation_id) for n in third_sweep] == [
+        (["l@localhost"], "offer-expired")
+    ]
+    assert third_sweep[0].payload["starting_price"] == 100
+    assert market.deadlines.next_deadline() is None, "Nothing is left to expire"
+
+
+def test_completed_auction_is_archived(tmp_path):
+    # given
+    archive = AuctionArchive(str(tmp_path / "auctions.jsonl"))
+    market = Market(
+        auction_time=timedelta(seconds=10),
+        extend_duration=timedelta(seconds=5),
+        store=MemoryStore(archive),
+    )
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    run_auction_inputs(market.apply, start)
+    market.apply("advance", {}, start + timedelta(seconds=12))
+
+    # when
+    market.apply(
+        "confirmation-response",
+        {"offer_id": "0", "confirmed": True, "sender": "tenant1@localhost"},
+        start + timedelta(seconds=13),
+    )
+
+    # then
+    (archived,) = archive.read()
+    assert archived["offer_id"] == "0"
+    assert (archived["winner_jid"], archived["final_price"]) == ("tenant1@localhost", 120)
+    assert [bid["bidder_jid"] for bid in archived["bids"]] == [
+        "tenant1@localhost",
+        "tenant2@localhost",
+    ]
+
+
+def test_batch_matching_agrees_with_scalar_matching():
+    # given
+    rng = random.Random(11)
+    memory = MemoryStore()
+    columns = ColumnStore()
+    for i in range(3000):
+        location = (52.2 + rng.random() * 0.03, 21.0 + rng.random() * 0.03)
+        low = rng.randint(50, 200)
+        request = get_request(location, min_price=low, max_price=low + rng.randint(0, 100))
+        memory.add_request(i, request)
+        columns.add_request(i, request)
+    offers = [
+        get_offer(
+            (52.2 + rng.random() * 0.03, 21.0 + rng.random() * 0.03),
+            starting_price=rng.randint(50, 300),
+        )
+        for _ in range(200)
+    ]
+
+    # when
+    batch = columns.requests_covering_prices(offers)
+    single = [list(columns.requests_covering_price(o.location, o.starting_price)) for o in offers]
+
+    # then
+    expected = memory.requests_covering_prices(offers)
+    assert [sorted(key for key, _ in found) for found in batch] == [
+        sorted(key for key, _ in found) for found in expected
+    ]
+    assert [sorted(key for key, _ in found) for found in single] == [
+        sorted(key for key, _ in found) for found in expected
+    ]
+    assert any(len(block) >= 32 for block in columns.request_blocks.values())
+
+
+def test_market_registers_offers_in_bulk():
+    # given
+    market = Market()
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    market.apply(
+        "register-rental",
+        {"min_price": 50, "max_price": 200, "location": LOCATION, "sender": "tenant@localhost"},
+        start,
+    )
+
+    # when
+    notifications = market.apply(
+        "rental-offers",
+        {
+            "offers": [
+                {"starting_price": 100, "location": LOCATION},
+                {"starting_price": 500, "location": LOCATION},
+                {"starting_price": 150, "location": [10.0, 10.0]},
+                {"starting_price": 120, "location": LOCATION},
+            ],
+            "sender": "landlord@localhost",
+        },
+        start,
+    )
+
+    # then
+    assert len(market.rental_offers) == 4
+    assert [n.payload["offer_id"] for n in notifications] == ["0", "3"]
+    assert all(n.recipients == ["tenant@localhost"] for n in notifications)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("store", [ColumnStore, MemoryStore])
+async def test_matching_workers_agree_with_market(store):
+    # given
+    rng = random.Random(5)
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    markets = [Market(store=store()), Market(store=store())]
+
+    def register(i):
+        low = rng.randint(50, 200)
+        data = {
+            "min_price": low,
+            "max_price": low + rng.randint(0, 100),
+            "location": (52.2 + rng.random() * 0.03, 21.0 + rng.random() * 0.03),
+            "sender": f"tenant{i}@localhost",
+        }
+        for market in markets:
+            market.apply("register-rental", data, start)
+
+    for i in range(2000):
+        register(i)
+    offers = {
+        "offers": [
+            {
+                "starting_price": rng.randint(50, 300),
+                "location": (52.2 + rng.random() * 0.03, 21.0 + rng.random() * 0.03),
+            }
+            for _ in range(300)
+        ],
+        "sender": "landlord@localhost",
+    }
+    pool = MatchingPool(workers=2, chunk_size=64)
+
+    # when
+    try:
+        pool.publish(markets[0])
+        for i in range(2000, 2200):
+            register(i)
+        for market in markets:
+            for request_id in range(0, 2000, 7):
+                market.remove_request(request_id)
+        matches = await pool.match_offers(
+            markets[0],
+            [(*offer["location"], offer["starting_price"]) for offer in offers["offers"]],
+        )
+    finally:
+        pool.close()
+    pooled = markets[0].apply("rental-offers", offers, start, matches)
+    expected = markets[1].apply("rental-offers", offers, start)
+
+    # then
+    assert matches.next_request_id == 2000
+    assert [(n.payload, n.recipients) for n in pooled] == [
+        (n.payload, n.recipients) for n in expected
+    ]
+    assert sum(len(n.recipients) for n in pooled) > 300
+
+
+def test_proxy_bidding_settles_at_once():
+    # given
+    market = Market(auction_time=timedelta(seconds=10), extend_duration=timedelta(seconds=5))
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    run_auction_inputs(market.apply, start)  # tenant1 bids 120, tenant2 stays at 100
+
+    def proxy(sender, max_amount, increment, seconds):
+        return market.apply(
+            "proxy-bid",
+            {"offer_id": "0", "max_amount": max_amount, "increment": increment, "sender": sender},
+            start + timedelta(seconds=seconds),
+        )
+
+    # when
+    first = proxy("tenant2@localhost", 300, 10, 4)
+    second = proxy("tenant1@localhost", 250, 5, 5)
+    manual = market.apply(
+        "bid",
+        {"offer_id": "0", "amount": 280, "sender": "tenant1@localhost"},
+        start + timedelta(seconds=6),
+    )
+
+    # then
+    bids = market.active_auctions["0"].bids
+    assert first == [
+        Notification(
+            ["tenant1@localhost"],
+            "outbid-notification",
+            {"offer_id": "0", "current_highest_bid": 130},
+        )
+    ]
+    assert second[0].payload["current_highest_bid"] == 260, "Proxy should beat 250 by one increment"
+    assert second[0].recipients == ["tenant1@localhost"]
+    assert manual[0].payload["current_highest_bid"] == 290
+    assert [(bid.bidder_jid, bid.amount) for bid in bids] == [
+        ("tenant2@localhost", 290),
+        ("tenant1@localhost", 280),
+    ]
+
+
+@pytest.mark.parametrize(
+    "first, second",
+    [("tenant2@localhost", "tenant1@localhost"), ("tenant1@localhost", "tenant2@localhost")],
+)
+def test_proxy_bidding_tie_goes_to_first_proxy(first, second):
+    # given
+    market = Market()
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    run_auction_inputs(market.apply, start)
+
+    # when
+    for seconds, sender in [(4, first), (5, second)]:
+        market.apply(
+            "proxy-bid",
+            {"offer_id": "0", "max_amount": 200, "increment": 10, "sender": sender},
+            start + timedelta(seconds=seconds),
+        )
+
+    # then
+    leader = market.active_auctions["0"].bids.highest()
+    assert (leader.bidder_jid, leader.amount) == (first, 200)
+
+
+def confirming_market(fanout):
+    market = Market(
+        auction_time=timedelta(seconds=10),
+        extend_duration=timedelta(seconds=5),
+        confirmation_time=timedelta(seconds=20),
+        confirmation_fanout=fanout,
+    )
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    market.apply(
+        "rental-offer",
+        {"starting_price": 100, "location": LOCATION, "sender": "landlord@localhost"},
+        start,
+    )
+    for i in range(4):
+        tenant = f"tenant{i}@localhost"
+        market.apply(
+            "register-rental",
+            {"min_price": 50, "max_price": 500, "location": LOCATION, "sender": tenant},
+            start,
+        )
+        market.apply(
+            "bid",
+            {"offer_id": "0", "amount": 400 - i * 10, "sender": tenant},
+            start,
+        )
+    return market, start + timedelta(seconds=10)
+
+
+def confirm(market, sender, confirmed, now):
+    return market.apply(
+        "confirmation-response",
+        {"offer_id": "0", "confirmed": confirmed, "sender": sender},
+        now,
+    )
+
+
+def test_top_k_confirmation_accepts_highest_ranked_yes():
+    # given
+    market, closed = confirming_market(fanout=3)
+
+    # when
+    requests = market.apply("advance", {}, closed)
+    early_yes = confirm(market, "tenant2@localhost", True, closed + timedelta(seconds=1))
+    yes = confirm(market, "tenant1@localhost", True, closed + timedelta(seconds=2))
+    completed = confirm(market, "tenant0@localhost", False, closed + timedelta(seconds=3))
+
+    # then
+    asked = [n.recipients[0] for n in requests if n.conversation_id == "confirmation-request"]
+    assert asked == ["tenant0@localhost", "tenant1@localhost", "tenant2@localhost"]
+    assert early_yes == [] and yes == [], "A higher-ranked bidder may still accept"
+    assert completed[-1].payload == {"offer_id": "0", "final_price": 390}
+    assert completed[0].recipients == ["tenant2@localhost", "tenant3@localhost"]
+    assert market.active_auctions == {}
+
+
+def test_top_k_confirmation_asks_next_round_after_deadline():
+    # given
+    market, closed = confirming_market(fanout=2)
+    market.apply("advance", {}, closed)
+    confirm(market, "tenant1@localhost", False, closed + timedelta(seconds=1))
+
+    # when
+    next_round = market.apply("advance", {}, closed + timedelta(seconds=20))
+    completed = confirm(market, "tenant3@localhost", True, closed + timedelta(seconds=21))
+    stale = confirm(market, "tenant0@localhost", True, closed + timedelta(seconds=22))
+
+    # then
+    assert [n.recipients[0] for n in next_round] == ["tenant2@localhost", "tenant3@localhost"]
+    assert completed == [], "tenant2 still outranks tenant3"
+    assert stale == []
+    final = market.apply("advance", {}, closed + timedelta(seconds=40))
+    assert final[-1].payload == {"offer_id": "0", "final_price": 370}
+
+
+def test_batch_clearing_assigns_each_tenant_one_offer():
+    # given
+    market = Market(auction_time=timedelta(seconds=10), clearing=True)
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    for tenant, max_price in (("a@localhost", 200), ("b@localhost", 110)):
+        market.apply(
+            "register-rental",
+            {"min_price": 50, "max_price": max_price, "location": LOCATION, "sender": tenant},
+            start,
+        )
+    market.apply(
+        "rental-offers",
+        {
+            "offers": [
+                {"starting_price": 100, "location": LOCATION},
+                {"starting_price": 120, "location": LOCATION},
+            ],
+            "sender": "landlord@localhost",
+        },
+        start,
+    )
+    market.apply("bid", {"offer_id": "0", "amount": 150, "sender": "a@localhost"}, start)
+    market.apply("bid", {"offer_id": "1", "amount": 140, "sender": "a@localhost"}, start)
+    stopped = market.apply("advance", {}, start + timedelta(seconds=10))
+
+    # when
+    problem = market.clearing_problem()
+    notifications = market.apply(
+        "clear-auctions",
+        {"offer_ids": problem.offer_ids, "assignment": solve(problem)},
+        start + timedelta(seconds=11),
+    )
+
+    # then
+    assert [n.conversation_id for n in stopped] == ["auction-stop", "auction-stop"]
+    assert sorted((n.payload["offer_id"], n.recipients) for n in notifications) == [
+        ("0", ["b@localhost"]),
+        ("1", ["a@localhost"]),
+    ]
+    assert market.clearing_problem() is None
+
+
+def test_auction_assignment_is_optimal():
+    rng = random.Random(3)
+    for _ in range(100):
+        # given
+        bidders, offers = rng.randint(1, 4), rng.randint(1, 4)
+        values = {
+            (bidder, offer): float(rng.choice([100, 120, 150, rng.randint(50, 200)]))
+            for bidder in range(bidders)
+            for offer in range(offers)
+            if rng.random() < 0.6
+        }
+        edges = list(values)
+
+        # when
+        assigned = auction_assignment(
+            [bidder for bidder, _ in edges],
+            [offer for _, offer in edges],
+            list(values.values()),
+            bidders,
+            offers,
+        ).tolist()
+
+        # then
+        taken = [offer for offer in assigned if offer >= 0]
+        assert len(taken) == len(set(taken))
+        best = max(
+            sum(values[bidder, offer] for bidder, offer in enumerate(choice) if offer >= 0)
+            for choice in itertools.product(range(-1, offers), repeat=bidders)
+            if all(offer < 0 or (bidder, offer) in values for bidder, offer in enumerate(choice))
+            and len({o for o in choice if o >= 0}) == sum(o >= 0 for o in choice)
+        )
+        total = sum(values[bidder, offer] for bidder, offer in enumerate(assigned) if offer >= 0)
+        assert total >= best - bidders * 0.15
+
+
+def test_request_near_shard_boundary_matches_offer_in_other_shard():
+    # given
+    shards = ShardMap(["west@localhost", "east@localhost"], [21.0])
+    hubs = {
+        jid: Market(offer_id_start=i, offer_id_step=len(shards))
+        for i, jid in enumerate(shards.hubs)
+    }
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    request_location = [52.2, 20.996]
+    for hub in shards.hubs_near(request_location):
+        hubs[hub].apply(
+            "register-rental",
+            {
+                "min_price": 50,
+                "max_price": 200,
+                "location": request_location,
+                "sender": "t@localhost",
+            },
+            start,
+        )
+
+    # when
+    offer_location = [52.2, 21.004]
+    owner = shards.hub_for(offer_location)
+    notifications = hubs[owner].apply(
+        "rental-offer",
+        {"starting_price": 100, "location": offer_location, "sender": "l@localhost"},
+        start,
+    )
+
+    # then
+    assert owner == "east@localhost"
+    assert [n.recipients for n in notifications] == [["t@localhost"]]
+    offer_id = notifications[0].payload["offer_id"]
+    assert offer_id == "1" and shards.hub_for_offer(offer_id) == owner
+
+
+def test_simulation_runs_market_on_virtual_clock():
+    # given
+    population = Population(tenants=500, offers=100, votes=50, duration=timedelta(minutes=10))
+
+    # when
+    reports = [
+        Simulation(Market(), population, seed=1).run(),
+        Simulation(Market(clearing=True), population, seed=1, clearing_interval=timedelta(seconds=5)).run(),
+    ]
+
+    # then
+    for report in reports:
+        assert report.inputs["register-rental"].count == 500
+        assert report.inputs["rental-offer"].count == 100
+        assert report.inputs["ServiceDemandRequest"].count == 50
+        assert 0 < report.auctions_let <= report.auctions_started <= 100
+        assert report.virtual_time >= timedelta(minutes=9)
+        assert "confirmation requests per let offer" in report.format()
+    assert "clear-auctions" in reports[1].inputs